@@ -0,0 +1,101 @@
+"""BM25 index: build time, size on disk, memory-mapped load, query latency, incremental adds.
+
+Documents are the windows → replies of the processed samples; --copies repeats
+the corpus (with distinct ids) to get to a realistic size. Queries are the last
+QUERY_CHARS characters of random windows, i.e. what a live chat looks like.
+
+Usage:
+    python benchmarks/bench_bm25.py [--copies 20] [samples.json ...]
+"""
+
+import argparse
+import json
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.bm25_index import BM25Index
+from src.inference.embed_job import window_and_reply
+from src.utils.json_stream import iter_json_records
+
+DEFAULT_PATHS = [REPO_ROOT / "data" / "processed" / "sft_val.json", REPO_ROOT / "data" / "processed" / "sft_test.json"]
+QUERY_CHARS = 120
+N_QUERIES = 500
+ADD_SIZES = (100, 1000)
+
+
+def load_docs(paths):
+    docs = []
+    for path in paths:
+        for sample in iter_json_records(path):
+            pair = window_and_reply(sample)
+            if pair and pair[0].strip():
+                docs.append(pair)
+    return docs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", default=DEFAULT_PATHS)
+    parser.add_argument("--copies", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    base = load_docs(args.paths)
+    corpus = [(f"{c}:{i}", f"{w}\n{r}") for c in range(args.copies) for i, (w, r) in enumerate(base)]
+    queries = [rng.choice(base)[0][-QUERY_CHARS:] for _ in range(N_QUERIES)]
+    tmp = Path(tempfile.mkdtemp(prefix="bm25_"))
+    try:
+        t0 = time.perf_counter()
+        index = BM25Index(tmp)
+        index.add(corpus)
+        index.save()
+        build_s = time.perf_counter() - t0
+        size_mb = sum(f.stat().st_size for f in tmp.rglob("*") if f.is_file()) / (1 << 20)
+        print(f"🔧 Indexed {len(corpus):,} docs in {build_s:.1f}s, {size_mb:.1f} MB on disk: {index.stats()}")
+
+        t0 = time.perf_counter()
+        index = BM25Index(tmp)
+        load_ms = 1000 * (time.perf_counter() - t0)
+        print(f"   reopen (memory-mapped): {load_ms:.0f} ms")
+
+        times = []
+        for q in queries:
+            t0 = time.perf_counter()
+            index.search(q, 10)
+            times.append(1000 * (time.perf_counter() - t0))
+        times.sort()
+        p50, p95 = statistics.median(times), times[int(0.95 * len(times))]
+        print(f"   query top-10: p50 {p50:.2f} ms, p95 {p95:.2f} ms")
+
+        adds = {}
+        for n in ADD_SIZES:
+            new = [(f"new{n}:{i}", text) for i, (_, text) in enumerate(rng.sample(corpus, n))]
+            t0 = time.perf_counter()
+            index.add(new)
+            index.save()
+            adds[n] = round(1000 * (time.perf_counter() - t0), 1)
+            print(f"   +{n} docs as a new segment (incl. save): {adds[n]} ms")
+        t0 = time.perf_counter()
+        index.merge()
+        index.save()
+        merge_s = time.perf_counter() - t0
+        print(f"   merge {index.stats()['segments']} segment(s): {merge_s:.1f}s")
+
+        print("\n" + json.dumps({"docs": len(corpus), "build_s": round(build_s, 2), "disk_mb": round(size_mb, 1),
+                                 "load_ms": round(load_ms, 1), "query_p50_ms": round(p50, 2),
+                                 "query_p95_ms": round(p95, 2), "add_ms": adds, "merge_s": round(merge_s, 2)},
+                                indent=1))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
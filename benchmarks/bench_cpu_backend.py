@@ -0,0 +1,122 @@
+"""CPU backends compared on real prompts: fp32 vs int8 dynamic quantization (± torch.compile).
+
+Each backend runs in its own forked process so peak RSS is comparable. Prompts
+are the conversations from sft_val_chatml.jsonl (without the final assistant
+turn); every backend generates exactly MAX_NEW_TOKENS greedy tokens per prompt.
+Token agreement with fp32 shows how much quantization changes the output.
+
+Usage:
+    python benchmarks/bench_cpu_backend.py <small_model_or_adapter_dir> [n_prompts] [--compile]
+"""
+
+import json
+import multiprocessing as mp
+import resource
+import sys
+import time
+from itertools import islice
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.model_loader import BASE_MODEL, adapter_base_model, get_model, has_adapter
+from src.utils.json_stream import iter_json_records
+
+PROMPTS_PATH = REPO_ROOT / "data" / "processed" / "sft_val_chatml.jsonl"
+MAX_NEW_TOKENS = 32
+
+
+def _rss_mb() -> float:
+    # Current (not peak) RSS: int8 weights replace fp32 ones after loading
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1 << 20)
+    except OSError:
+        return float("nan")
+
+
+def load_prompts(n: int):
+    return [s["messages"][:-1] for s in islice(iter_json_records(PROMPTS_PATH), n)]
+
+
+def _child(model_path: str, backend: str, compile: bool, prompts, conn):
+    try:
+        import torch
+
+        from src.inference.infer import encode_prompts
+
+        if has_adapter(model_path):
+            base, lora = adapter_base_model(model_path) or BASE_MODEL, model_path
+        else:
+            base, lora = model_path, None
+        loaded = get_model(base, lora, backend=backend, compile=compile)
+        model, tok = loaded.model, loaded.tokenizer
+        gen = {"do_sample": False, "max_new_tokens": MAX_NEW_TOKENS, "min_new_tokens": MAX_NEW_TOKENS,
+               "pad_token_id": tok.pad_token_id}
+        with torch.inference_mode():
+            # Warm-up (and, with compile, the first compilation) outside the timing
+            model.generate(**encode_prompts(tok, prompts[:1]), **gen)
+            outputs, t0, n_tokens = [], time.perf_counter(), 0
+            for p in prompts:
+                inputs = encode_prompts(tok, [p])
+                out = model.generate(**inputs, **gen)[0, inputs["input_ids"].shape[1]:].tolist()
+                outputs.append(out)
+                n_tokens += len(out)
+            seconds = time.perf_counter() - t0
+        conn.send({"tokens_per_s": n_tokens / seconds, "seconds": seconds, "load_s": loaded.load_seconds,
+                   "rss_mb": _rss_mb(), "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "outputs": outputs})
+    except Exception as e:
+        conn.send({"error": repr(e)})
+    finally:
+        conn.close()
+
+
+def run(model_path: str, backend: str, compile: bool, prompts) -> dict:
+    ctx = mp.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_child, args=(model_path, backend, compile, prompts, child))
+    p.start()
+    res = parent.recv()
+    p.join()
+    return res
+
+
+def _agreement(ref, out) -> float:
+    same = total = 0
+    for a, b in zip(ref, out):
+        total += len(a)
+        same += sum(x == y for x, y in zip(a, b))
+    return same / total if total else 0.0
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if not args:
+        print(__doc__)
+        sys.exit(2)
+    model_path = args[0]
+    prompts = load_prompts(int(args[1]) if len(args) > 1 else 20)
+    configs = [("cpu", False), ("cpu-int8", False)]
+    if "--compile" in sys.argv:
+        configs += [("cpu", True), ("cpu-int8", True)]
+
+    print(f"{len(prompts)} prompts from {PROMPTS_PATH.name}, {MAX_NEW_TOKENS} new tokens each\n")
+    print(f"{'backend':<18} {'tok/s':>8} {'speedup':>8} {'load s':>7} {'RSS MB':>7} {'peak RSS MB':>12} {'agree w/ fp32':>14}")
+    ref = None
+    results = {}
+    for backend, compile in configs:
+        name = backend + ("+compile" if compile else "")
+        r = run(model_path, backend, compile, prompts)
+        if "error" in r:
+            print(f"{name:<18} ERROR {r['error']}")
+            continue
+        ref = ref or r
+        print(f"{name:<18} {r['tokens_per_s']:>8.1f} {r['tokens_per_s'] / ref['tokens_per_s']:>7.2f}x "
+              f"{r['load_s']:>7.1f} {r['rss_mb']:>7.0f} {r['peak_rss_mb']:>12.0f} {_agreement(ref['outputs'], r['outputs']):>13.1%}")
+        results[name] = {k: v for k, v in r.items() if k != "outputs"}
+    print("\n" + json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
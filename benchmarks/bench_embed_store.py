@@ -0,0 +1,116 @@
+"""EmbedStore recall vs latency: exact search and IVF at several nprobe values.
+
+Builds a store of N synthetic embeddings (default 1M × 384, the
+sentence-transformers MiniLM size) on disk. The vectors are clustered like real
+sentence embeddings, not uniform noise, which no index can partition.
+Queries are fresh samples from the same topics. Exact top-k is the ground truth for
+recall@k.
+
+Usage:
+    python benchmarks/bench_embed_store.py [n_vectors] [dim] [--dir /tmp/bench_embed_store] [--queries 200]
+                                               [--lists N] [--dtype float32|float16]
+"""
+
+import argparse
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.embed_store import EmbedStore
+
+N_TOPICS = 5000
+K = 10
+NPROBES = (1, 4, 8, 16, 32, 64)
+ADD_BATCH = 100_000
+
+
+def synth(rng, centers, n, noise=0.7):
+    # Unit-norm topic centers + noise of norm ≈ `noise`: neighbours share a topic, but the
+    # exact top-10 within a topic is still decided by the noise
+    topic = rng.integers(0, len(centers), n)
+    return centers[topic] + noise / np.sqrt(centers.shape[1]) * rng.standard_normal((n, centers.shape[1]), dtype=np.float32)
+
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - t0
+
+
+def recall(result, truth) -> float:
+    return float(np.mean([len({i for i, _ in r} & {i for i, _ in t}) / max(len(t), 1) for r, t in zip(result, truth)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("n", nargs="?", type=int, default=1_000_000)
+    parser.add_argument("dim", nargs="?", type=int, default=384)
+    parser.add_argument("--dir", default="/tmp/bench_embed_store")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument("--dtype", default="float32")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((N_TOPICS, args.dim), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    shutil.rmtree(args.dir, ignore_errors=True)
+    store = EmbedStore(args.dir, dtype=args.dtype)
+    results = {"n": args.n, "dim": args.dim, "dtype": args.dtype}
+
+    t0 = time.perf_counter()
+    for start in range(0, args.n, ADD_BATCH):
+        n = min(ADD_BATCH, args.n - start)
+        store.add(synth(rng, centers, n), [f"v{i}" for i in range(start, start + n)])
+    store.save()
+    results["add_s"] = round(time.perf_counter() - t0, 1)
+    print(f"🔧 Added {args.n:,} × {args.dim} in {results['add_s']}s ({store.stats()['mb']} MB)")
+
+    store, results["open_s"] = timed(EmbedStore, args.dir)
+    print(f"   reopen (memory-mapped): {results['open_s'] * 1000:.0f} ms")
+
+    queries = synth(rng, centers, args.queries)
+    truth, t = timed(store.search, queries, K, exact=True)
+    results["exact_batch_ms_per_query"] = round(1000 * t / args.queries, 2)
+    _, t = timed(store.search, queries[0], K, exact=True)
+    results["exact_single_ms"] = round(1000 * t, 1)
+    print(f"   exact: {results['exact_single_ms']} ms single query, "
+          f"{results['exact_batch_ms_per_query']} ms/query in a batch of {args.queries}")
+
+    _, t = timed(store.build_ivf, args.lists)
+    results["ivf_build_s"] = round(t, 1)
+    results["ivf_lists"] = len(store.centroids)
+    print(f"🧮 IVF: {len(store.centroids)} lists trained + assigned in {t:.1f}s\n")
+
+    print(f"{'nprobe':>7} {'recall@' + str(K):>10} {'ms/query':>9} {'vs exact':>9} {'single ms':>10}")
+    results["ivf"] = {}
+    for nprobe in NPROBES:
+        if nprobe > len(store.centroids):
+            break
+        res, t = timed(store.search, queries, K, nprobe=nprobe)
+        ms = 1000 * t / args.queries
+        r = recall(res, truth)
+        t0 = time.perf_counter()
+        for q in queries[:20]:
+            store.search(q, K, nprobe=nprobe)
+        single = 1000 * (time.perf_counter() - t0) / 20
+        print(f"{nprobe:>7} {r:>10.3f} {ms:>9.2f} {results['exact_batch_ms_per_query'] / ms:>8.1f}x {single:>10.2f}")
+        results["ivf"][nprobe] = {"recall": round(r, 3), "ms_per_query": round(ms, 2), "single_ms": round(single, 2)}
+
+    # Incremental adds go straight into their nearest list, no retraining
+    _, t = timed(store.add, synth(rng, centers, 1000), [f"late{i}" for i in range(1000)])
+    results["add_1k_after_ivf_ms"] = round(1000 * t, 1)
+    print(f"   +1000 vectors after IVF: {results['add_1k_after_ivf_ms']} ms")
+    print("\n" + json.dumps(results, indent=1))
+    shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Micro-benchmark: legacy two-pass PII masking vs the single-pass PiiMasker.
+
+The legacy path ran two `re.sub` calls per normalize_text and called it twice
+per message (grouping + sample building). The new path compiles one
+alternation and masks each message once.
+
+Usage:
+    python benchmarks/bench_pii.py [n_messages] [seed]
+"""
+
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.utils.pii import PiiMasker, DEFAULT_KINDS, PII_PATTERNS
+
+WORDS = "ok lol haha can i think u the later wanna eat where ah leh sia tmr meet at 7 sure".split()
+
+
+def synthetic_corpus(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(1, 20))]
+        r = rng.random()
+        if r < 0.03:
+            words.insert(rng.randrange(len(words) + 1), f"+65 9{rng.randint(1000000, 9999999)}")
+        elif r < 0.06:
+            words.insert(rng.randrange(len(words) + 1), f"user{rng.randint(1, 999)}@gmail.com")
+        elif r < 0.08:
+            words.insert(rng.randrange(len(words) + 1), f"https://t.me/c/{rng.randint(1, 10**6)}")
+        out.append(" ".join(words))
+    return out
+
+
+def legacy_normalize(text: str) -> str:
+    text = re.sub(r'\+?\d[\d\-\s]{7,}\d', '[PHONE]', text)
+    text = re.sub(r'\S+@\S+', '[EMAIL]', text)
+    return text.strip()
+
+
+def bench(label, fn, corpus, calls_per_msg):
+    t0 = time.perf_counter()
+    for text in corpus:
+        for _ in range(calls_per_msg):
+            fn(text)
+    dt = time.perf_counter() - t0
+    rate = len(corpus) / dt
+    print(f"{label:<36} {dt:8.3f}s  {rate:12,.0f} msgs/s")
+    return rate
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    corpus = synthetic_corpus(n, seed)
+    default = PiiMasker(DEFAULT_KINDS)
+    full = PiiMasker(PII_PATTERNS)
+
+    mismatches = sum(legacy_normalize(t) != default.mask(t).strip() for t in corpus)
+    print(f"{n:,} synthetic messages; default-kind output differs from legacy on {mismatches} messages\n")
+
+    base = bench("legacy (2 passes x 2 calls/msg)", legacy_normalize, corpus, 2)
+    new = bench("PiiMasker default (1 pass x 1 call)", lambda t: default.mask(t).strip(), corpus, 1)
+    bench("PiiMasker all kinds (1 pass x 1 call)", lambda t: full.mask(t).strip(), corpus, 1)
+    print(f"\nspeedup (default kinds): {new / base:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
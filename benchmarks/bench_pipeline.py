@@ -0,0 +1,223 @@
+"""Data-pipeline benchmark suite on a synthetic corpus.
+
+Each stage runs in its own forked process so its peak RSS is measured in
+isolation. The results are written as JSON (throughput, wall time, peak RSS,
+plus the corpus parameters and git revision) and can be compared against a
+previous run to catch regressions.
+
+Usage:
+    python benchmarks/bench_pipeline.py run [n_messages] [--out results.json] [--seed N]
+    python benchmarks/bench_pipeline.py compare base.json new.json [--tolerance 0.10]
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.data.synth_corpus import SynthConfig, write_corpus
+
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+# ---------------------------------------------------------------- stages
+# Each returns (items processed, seconds); loading inputs is excluded from the timing.
+
+def stage_normalize_text(work: Path):
+    from src.data.build_dataset import normalize_text
+    from src.utils.json_stream import iter_json_records
+
+    texts = [m.get("text", "") for m in iter_json_records(work / "raw.jsonl")]
+    t0 = time.perf_counter()
+    for t in texts:
+        normalize_text(t)
+    return len(texts), time.perf_counter() - t0
+
+
+def stage_group_by_time_and_tokens(work: Path):
+    from src.data.build_dataset import group_by_time_and_tokens
+    from src.utils.json_stream import iter_json_records
+
+    raw = list(iter_json_records(work / "raw.jsonl"))
+    t0 = time.perf_counter()
+    group_by_time_and_tokens(raw)
+    return len(raw), time.perf_counter() - t0
+
+
+def stage_build_streaming(work: Path):
+    from src.data.build_dataset import build_dataset_streaming
+
+    n = sum(1 for _ in open(work / "raw.jsonl", encoding="utf-8"))
+    t0 = time.perf_counter()
+    build_dataset_streaming(work / "raw.jsonl", work / "samples.jsonl")
+    return n, time.perf_counter() - t0
+
+
+def stage_grouped_random_split(work: Path):
+    from src.data.split_dataset import grouped_random_split
+    from src.utils.json_stream import iter_json_records
+
+    samples = list(iter_json_records(work / "samples.jsonl"))
+    t0 = time.perf_counter()
+    grouped_random_split(samples)
+    return len(samples), time.perf_counter() - t0
+
+
+def stage_convert_sample(work: Path):
+    from src.data.convert_template import convert_sample
+    from src.utils.json_stream import iter_json_records
+
+    # Reshape to the {"messages": context, "output": reply} form convert_sample is written for
+    samples = [{"messages": s["messages"][:-1], "output": s["messages"][-1]["content"] or "x"}
+               for s in iter_json_records(work / "samples.jsonl")]
+    t0 = time.perf_counter()
+    with open(work / "chatml.jsonl", "w", encoding="utf-8") as f:
+        for s in samples:
+            f.write(json.dumps(convert_sample(s), ensure_ascii=False) + "\n")
+    return len(samples), time.perf_counter() - t0
+
+
+def _sampling_stage(fn_name: str):
+    def stage(work: Path):
+        from src.data import scale_down
+
+        path = work / "chatml.jsonl"
+        n = sum(1 for _ in open(path, encoding="utf-8"))
+        t0 = time.perf_counter()
+        getattr(scale_down, fn_name)(path, max(1, n // 10), 0)
+        return n, time.perf_counter() - t0
+    return stage
+
+
+# Order matters: later stages read files written by earlier ones
+STAGES = {
+    "normalize_text": stage_normalize_text,
+    "group_by_time_and_tokens": stage_group_by_time_and_tokens,
+    "build_streaming": stage_build_streaming,
+    "grouped_random_split": stage_grouped_random_split,
+    "convert_sample": stage_convert_sample,
+    "reservoir_sample_lines": _sampling_stage("reservoir_sample_lines"),
+    "skip_reservoir_sample_lines": _sampling_stage("skip_reservoir_sample_lines"),
+}
+
+
+def _child(name: str, work: Path, conn):
+    try:
+        t0 = time.perf_counter()
+        items, seconds = STAGES[name](work)
+        conn.send({"items": items, "seconds": seconds, "wall_seconds": time.perf_counter() - t0,
+                   "peak_rss_mb": _peak_rss_mb()})
+    except Exception as e:
+        conn.send({"error": repr(e)})
+    finally:
+        conn.close()
+
+
+def run_stage(name: str, work: Path) -> dict:
+    ctx = mp.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_child, args=(name, work, child))
+    p.start()
+    res = parent.recv()
+    p.join()
+    if "items" in res:
+        res["items_per_s"] = res["items"] / res["seconds"] if res["seconds"] else float("inf")
+    return res
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def run(n_messages: int, seed: int, out: Path, stages=None) -> dict:
+    cfg = SynthConfig(n_messages=n_messages, n_chats=max(10, n_messages // 2000), seed=seed)
+    results = {
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "corpus": {"n_messages": cfg.n_messages, "n_chats": cfg.n_chats, "seed": seed},
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as tmp:
+        work = Path(tmp)
+        t0 = time.perf_counter()
+        write_corpus(work / "raw.jsonl", cfg)
+        print(f"Generated {n_messages:,} messages in {time.perf_counter() - t0:.1f}s\n")
+        print(f"{'stage':<30} {'items':>10} {'items/s':>12} {'seconds':>9} {'peak RSS MB':>12}")
+        for name in stages or STAGES:
+            r = run_stage(name, work)
+            results["stages"][name] = r
+            if "error" in r:
+                print(f"{name:<30} ERROR {r['error']}")
+                continue
+            print(f"{name:<30} {r['items']:>10,} {r['items_per_s']:>12,.0f} {r['seconds']:>9.2f} {r['peak_rss_mb']:>12.1f}")
+
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2))
+    print(f"\nResults → {out}")
+    return results
+
+
+def compare(base_path: Path, new_path: Path, tolerance: float = 0.10) -> int:
+    """Print per-stage deltas; non-zero exit if any stage lost more than `tolerance` throughput."""
+    base = json.loads(base_path.read_text())
+    new = json.loads(new_path.read_text())
+    if base["corpus"] != new["corpus"]:
+        print(f"⚠️ Different corpora: {base['corpus']} vs {new['corpus']}")
+    regressions = 0
+    print(f"{'stage':<30} {'base/s':>12} {'new/s':>12} {'Δ thrpt':>9} {'Δ RSS MB':>9}")
+    for name, b in base["stages"].items():
+        n = new["stages"].get(name)
+        if not n or "items_per_s" not in b or "items_per_s" not in n:
+            continue
+        delta = n["items_per_s"] / b["items_per_s"] - 1
+        flag = ""
+        if delta < -tolerance:
+            flag = "  ← regression"
+            regressions += 1
+        print(f"{name:<30} {b['items_per_s']:>12,.0f} {n['items_per_s']:>12,.0f} {delta:>+8.1%} "
+              f"{n['peak_rss_mb'] - b['peak_rss_mb']:>+9.1f}{flag}")
+    return 1 if regressions else 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Data pipeline benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run")
+    r.add_argument("n_messages", type=int, nargs="?", default=200_000)
+    r.add_argument("--seed", type=int, default=0)
+    r.add_argument("--out", type=Path, default=None)
+    r.add_argument("--stage", action="append", choices=list(STAGES), help="run only these stages")
+    c = sub.add_parser("compare")
+    c.add_argument("base", type=Path)
+    c.add_argument("new", type=Path)
+    c.add_argument("--tolerance", type=float, default=0.10)
+    args = ap.parse_args()
+
+    if args.cmd == "run":
+        out = args.out or RESULTS_DIR / f"pipeline-{_git_rev()}-{args.n_messages}.json"
+        run(args.n_messages, args.seed, out, args.stage)
+    else:
+        sys.exit(compare(args.base, args.new, args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Prefill cost per turn of a long conversation, with and without the prefix KV-cache.
+
+Each turn appends a user message and the model's reply, then times a 1-token
+generation (≈ prefill) for the whole conversation so far.
+
+Usage:
+    python benchmarks/bench_prefix_cache.py [model_or_adapter_path] [turns]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.data.synth_corpus import SynthConfig, _text
+from src.inference import infer
+from src.inference.model_loader import adapter_base_model, get_model, has_adapter
+from src.inference.prefix_cache import get_prefix_cache
+
+REPLY_TOKENS = 16
+
+
+def run(turns: int, use_cache: bool):
+    import random
+
+    infer.USE_PREFIX_CACHE = use_cache
+    rng, cfg = random.Random(0), SynthConfig(mean_words=20, short_reply_rate=0)
+    conv, times, lengths = [], [], []
+    for _ in range(turns):
+        conv.append({"role": "user", "content": "\n".join(_text(cfg, rng) for _ in range(3))})
+        t0 = time.perf_counter()
+        infer.chat(conv, max_new_tokens=1)
+        times.append(time.perf_counter() - t0)
+        # The reply that becomes part of the history (timed separately from prefill above)
+        conv.append({"role": "assistant", "content": infer.chat(conv, max_new_tokens=REPLY_TOKENS)})
+        lengths.append(len(infer.encode_prompts(get_model(infer.base_model, infer.lora_path, backend=infer.backend).tokenizer,
+                                                [conv])["input_ids"][0]))
+    return times, lengths
+
+
+def main():
+    args = sys.argv[1:]
+    if args:
+        if has_adapter(args[0]):
+            infer.base_model, infer.lora_path = adapter_base_model(args[0]) or infer.base_model, args[0]
+        else:
+            infer.base_model, infer.lora_path = args[0], None
+    turns = int(args[1]) if len(args) > 1 else 20
+    infer.chat("warmup", max_new_tokens=1)
+
+    off, lengths = run(turns, use_cache=False)
+    on, _ = run(turns, use_cache=True)
+    loaded = get_model(infer.base_model, infer.lora_path, backend=infer.backend)
+    print(f"{'turn':>4} {'tokens':>7} {'no cache ms':>12} {'cache ms':>9} {'speedup':>8}")
+    for i, (a, b, n) in enumerate(zip(off, on, lengths)):
+        if i % max(1, turns // 10) == 0 or i == turns - 1:
+            print(f"{i + 1:>4} {n:>7} {1000 * a:>12.1f} {1000 * b:>9.1f} {a / b:>7.1f}x")
+    print(f"\ntotal {sum(off):.2f}s → {sum(on):.2f}s; cache {get_prefix_cache(loaded.key).stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Prompt assembly latency and budget accuracy with hundreds of candidate fragments.
+
+Candidates are real windows → replies from sft_val_chatml.jsonl (as retrieved
+examples, with random relevance scores and timestamps) plus short memory lines;
+the conversation is one sample's window split into turns. For each candidate
+count the assembler runs REPEATS times with a warm token cache (the steady
+state: retrieved fragments repeat across turns); the first, cold call is
+reported separately.
+
+Every assembled prompt is rendered with the ChatML template and re-counted as
+one string, to check the hard budget holds despite per-fragment counting.
+
+Usage:
+    python benchmarks/bench_prompt_assembly.py [--tokenizer path/to/hf_tokenizer] [--budget 768]
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from itertools import islice
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.retrieval_pipeline import PROMPT_BUDGET, Fragment, assemble_prompt
+from src.utils.json_stream import iter_json_records
+from src.utils.token_counter import TokenCounter
+
+PROMPTS_PATH = REPO_ROOT / "data" / "processed" / "sft_val_chatml.jsonl"
+CANDIDATES = (50, 200, 500, 1000)
+REPEATS = 200
+CHATML = "<|im_start|>{role}\n{content}<|im_end|>\n"
+
+
+def load_fragments(n: int, rng: random.Random):
+    now = time.time()
+    frags = []
+    for s in islice(iter_json_records(PROMPTS_PATH), n):
+        msgs = [m for m in s["messages"] if m["role"] != "system"]
+        window, reply = "\n".join(m["content"] for m in msgs[:-1]), msgs[-1]["content"]
+        if rng.random() < 0.2:
+            frags.append(Fragment(reply, "memory", rng.random(), now - rng.random() * 60 * 86400))
+        else:
+            frags.append(Fragment(window, "example", rng.random(), now - rng.random() * 365 * 86400, reply))
+    return frags
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default=None, help="local HF tokenizer dir (default: tiktoken or heuristic)")
+    parser.add_argument("--budget", type=int, default=PROMPT_BUDGET)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    pool = load_fragments(max(CANDIDATES) + 50, rng)
+    conversation = [{"role": "user" if i % 2 else "assistant", "content": line}
+                    for i, line in enumerate(pool[-1].text.split("\n") * 6)]
+    results = {}
+    print(f"Budget {args.budget} tokens, conversation of {len(conversation)} turns\n")
+    print(f"{'candidates':>10} {'cold ms':>8} {'warm µs p50':>12} {'p95':>8} {'used':>6} {'actual':>7} "
+          f"{'frags in':>9} {'turns in':>9} {'flat prompt':>12}")
+    for n in CANDIDATES:
+        counter = TokenCounter(tokenizer_path=args.tokenizer)
+        counter.tokenizer  # load outside the timing: "cold" = nothing counted yet
+        frags = pool[:n]
+        t0 = time.perf_counter()
+        res = assemble_prompt(conversation, examples=frags, budget=args.budget, counter=counter)
+        cold_ms = 1000 * (time.perf_counter() - t0)
+        times = []
+        for _ in range(REPEATS):
+            t0 = time.perf_counter()
+            assemble_prompt(conversation, examples=frags, budget=args.budget, counter=counter)
+            times.append(1e6 * (time.perf_counter() - t0))
+        times.sort()
+        rendered = "".join(CHATML.format(**m) for m in res.messages) + "<|im_start|>assistant\n"
+        actual = counter.count(rendered)
+        flat = counter.count("\n".join(f.render() for f in frags) + "".join(m["content"] for m in conversation))
+        print(f"{n:>10} {cold_ms:>8.1f} {statistics.median(times):>12.0f} {times[int(0.95 * len(times))]:>8.0f} "
+              f"{res.tokens:>6} {actual:>7} {len(res.used):>9} {len(conversation) - res.dropped_turns:>9} {flat:>12}")
+        results[n] = {"cold_ms": round(cold_ms, 2), "warm_us_p50": round(statistics.median(times)),
+                      "warm_us_p95": round(times[int(0.95 * len(times))]), "tokens_counted": res.tokens,
+                      "tokens_actual": actual, "fragments_used": len(res.used), "flat_prompt_tokens": flat}
+        if actual > args.budget:
+            print(f"⚠️ Rendered prompt is {actual} tokens, over the {args.budget} budget")
+    print("\n" + json.dumps({"backend": counter.backend, "budget": args.budget, "results": results}, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Load test for serve_model.py: throughput with and without dynamic batching.
+
+Starts the server in-process for each MAX_BATCH setting, fires CONCURRENCY
+concurrent /chat requests over plain asyncio sockets and reports requests/s,
+latency percentiles and the average batch size the server actually formed.
+
+Usage:
+    python benchmarks/bench_serve.py [model_or_adapter_path] [n_requests] [concurrency]
+"""
+
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference import serve_model
+
+PORT = 8765
+MAX_BATCHES = (1, 4, 8, 16)
+MAX_NEW_TOKENS = 32
+PROMPTS = ["hello", "how are you", "where u now", "lunch later?", "ok", "what time tmr"]
+
+
+async def _post(path: str, body: dict) -> dict:
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    payload = json.dumps(body).encode()
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: x\r\nContent-Length: {len(payload)}\r\n"
+                 f"Connection: close\r\n\r\n".encode() + payload)
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    return json.loads(raw.split(b"\r\n\r\n", 1)[1])
+
+
+async def _load(n: int, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with sem:
+            t0 = time.perf_counter()
+            await _post("/chat", {"prompt": PROMPTS[i % len(PROMPTS)], "max_new_tokens": MAX_NEW_TOKENS})
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return time.perf_counter() - t0, latencies
+
+
+async def bench(generate_fn, max_batch: int, n: int, concurrency: int) -> dict:
+    ready = asyncio.Event()
+    server = asyncio.create_task(serve_model.serve(generate_fn, port=PORT, max_batch=max_batch,
+                                                   max_queue=max(serve_model.MAX_QUEUE, concurrency), ready=ready))
+    await ready.wait()
+    try:
+        seconds, lat = await _load(n, concurrency)
+        reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+        writer.write(b"GET /health HTTP/1.1\r\nConnection: close\r\n\r\n")
+        health = json.loads((await reader.read()).split(b"\r\n\r\n", 1)[1])
+        writer.close()
+    finally:
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+    lat.sort()
+    return {"max_batch": max_batch, "req_per_s": n / seconds, "p50_ms": 1000 * statistics.median(lat),
+            "p95_ms": 1000 * lat[int(0.95 * (len(lat) - 1))], "avg_batch": health["avg_batch_size"]}
+
+
+def main():
+    args = sys.argv[1:]
+    model_path = args[0] if len(args) > 0 else None
+    n = int(args[1]) if len(args) > 1 else 64
+    concurrency = int(args[2]) if len(args) > 2 else 16
+    generate_fn = serve_model.default_generate_fn(model_path)
+    generate_fn(["warmup"], [1], serve_model.DEFAULT_TEMPERATURE, serve_model.DEFAULT_TOP_P)
+
+    print(f"{n} requests, concurrency {concurrency}, max_new_tokens {MAX_NEW_TOKENS}\n")
+    print(f"{'max_batch':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'avg batch':>10}")
+    base = None
+    for mb in MAX_BATCHES:
+        r = asyncio.run(bench(generate_fn, mb, n, concurrency))
+        base = base or r["req_per_s"]
+        print(f"{mb:>9} {r['req_per_s']:>8.2f} {r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} {r['avg_batch']:>10.2f}"
+              f"   ({r['req_per_s'] / base:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Speculative decoding vs plain generate on real prompts.
+
+Prompts are the conversations from sft_val_chatml.jsonl (without the final
+assistant turn). For each draft, every prompt is answered once with
+model.generate() and once speculatively, with the same sampling parameters and
+token budget; both stop at EOS. Reports the draft's acceptance rate, tokens per
+target forward and the wall-clock speedup in tokens/s.
+
+--check-dist N first checks that sampling is unchanged: on the first prompt it
+draws N first tokens with generate(do_sample=True) and N speculatively per draft,
+and reports each histogram's total variation distance from the target's exact
+(temperature / top-k / top-p) distribution. Both should be sampling noise only.
+
+Usage:
+    python benchmarks/bench_speculative.py <model_or_adapter_dir> [n_prompts] [--draft layers:2 --draft <small_model> ...]
+                                           [--k 4] [--temperature 0.7] [--backend cpu] [--check-dist 300]
+"""
+
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+from itertools import islice
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.model_loader import BASE_MODEL, adapter_base_model, get_model, has_adapter
+from src.inference.speculative import (DRAFT_TOKENS, SpecStats, _probs, load_draft, sampling_top_k,
+                                      speculative_generate)
+from src.utils.json_stream import iter_json_records
+
+PROMPTS_PATH = REPO_ROOT / "data" / "processed" / "sft_val_chatml.jsonl"
+MAX_NEW_TOKENS = 64
+TOP_P = 0.9
+
+
+def load_prompts(n: int):
+    return [s["messages"][:-1] for s in islice(iter_json_records(PROMPTS_PATH), n)]
+
+
+def _plain(model, tok, inputs, temperature, eos_ids):
+    gen = {"max_new_tokens": MAX_NEW_TOKENS, "pad_token_id": tok.pad_token_id, "eos_token_id": sorted(eos_ids)}
+    if temperature > 0:
+        gen.update(do_sample=True, temperature=temperature, top_p=TOP_P)
+    else:
+        gen.update(do_sample=False)
+    out = model.generate(**inputs, **gen)[0, inputs["input_ids"].shape[1]:]
+    return len(out)
+
+
+def _tv(counts: Counter, probs) -> float:
+    """Total variation distance between a histogram of sampled ids and a distribution."""
+    n = sum(counts.values())
+    support = set(counts) | set(probs.nonzero().flatten().tolist())
+    return 0.5 * sum(abs(counts[t] / n - probs[t].item()) for t in support)
+
+
+def check_distribution(model, tok, drafts, inputs, temperature, k, n):
+    """First-token histograms of plain vs speculative sampling against the target's exact distribution."""
+    import torch
+
+    with torch.inference_mode():
+        exact = _probs(model(**inputs).logits[0, -1:], temperature, TOP_P, sampling_top_k(model))[0]
+    gen = {"max_new_tokens": 1, "pad_token_id": tok.pad_token_id, "do_sample": True, "temperature": temperature,
+           "top_p": TOP_P}
+    plain = Counter(int(model.generate(**inputs, **gen)[0, -1]) for _ in range(n))
+    results = {"plain": {"distinct": len(plain), "tv": round(_tv(plain, exact), 3)}}
+    for spec, draft in drafts.items():
+        spec_counts = Counter(speculative_generate(model, draft, inputs["input_ids"], 1, temperature, TOP_P, k=k)[0][0]
+                              for _ in range(n))
+        results[spec] = {"distinct": len(spec_counts), "tv": round(_tv(spec_counts, exact), 3)}
+    print(f"First-token distribution over {n} samples (support {int((exact > 0).sum())} tokens):")
+    for name, r in results.items():
+        print(f"   {name:<21} {r['distinct']:>4} distinct, TV from exact {r['tv']:.3f}")
+    print()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model")
+    parser.add_argument("n_prompts", nargs="?", type=int, default=20)
+    parser.add_argument("--draft", action="append", help="draft model path or layers:N (repeatable)")
+    parser.add_argument("--k", type=int, default=DRAFT_TOKENS)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--backend", default=None)
+    parser.add_argument("--check-dist", type=int, default=0, metavar="N",
+                        help="first compare N sampled first tokens, plain vs speculative")
+    args = parser.parse_args()
+
+    import torch
+
+    from src.inference.infer import _eos_ids, encode_prompts
+
+    if has_adapter(args.model):
+        base, lora = adapter_base_model(args.model) or BASE_MODEL, args.model
+    else:
+        base, lora = args.model, None
+    loaded = get_model(base, lora, backend=args.backend)
+    model, tok = loaded.model, loaded.tokenizer
+    eos_ids = _eos_ids(model, tok)
+    prompts = [encode_prompts(tok, [p]).to(model.device) for p in load_prompts(args.n_prompts)]
+    drafts = args.draft or ["layers:1", "layers:2"]
+    torch.manual_seed(0)
+    results = {}
+    if args.check_dist and args.temperature > 0:
+        loaded_drafts = {spec: load_draft(spec, loaded, backend=args.backend) for spec in drafts}
+        results["distribution"] = check_distribution(model, tok, loaded_drafts, prompts[0], args.temperature, args.k,
+                                                     args.check_dist)
+
+    print(f"{len(prompts)} prompts from {PROMPTS_PATH.name}, ≤{MAX_NEW_TOKENS} new tokens, "
+          f"temperature {args.temperature}, k={args.k}\n")
+    with torch.inference_mode():
+        _plain(model, tok, prompts[0], args.temperature, eos_ids)  # warm-up
+        t0, n_plain = time.perf_counter(), 0
+        for inputs in prompts:
+            n_plain += _plain(model, tok, inputs, args.temperature, eos_ids)
+        plain_tps = n_plain / (time.perf_counter() - t0)
+
+    print(f"{'draft':<24} {'tok/s':>8} {'speedup':>8} {'accept':>7} {'tok/fwd':>8}")
+    print(f"{'(plain generate)':<24} {plain_tps:>8.1f} {1.0:>7.2f}x {'':>7} {1.0:>8.2f}")
+    results["plain"] = {"tokens_per_s": round(plain_tps, 1)}
+    for spec in drafts:
+        draft = load_draft(spec, loaded, backend=args.backend)
+        speculative_generate(model, draft, prompts[0]["input_ids"], 8, args.temperature, TOP_P, k=args.k)
+        stats = SpecStats()
+        for inputs in prompts:
+            speculative_generate(model, draft, inputs["input_ids"], MAX_NEW_TOKENS, args.temperature, TOP_P,
+                                 k=args.k, eos_ids=eos_ids, stats=stats)
+        tps = stats.emitted / stats.seconds
+        print(f"{spec:<24} {tps:>8.1f} {tps / plain_tps:>7.2f}x {stats.acceptance_rate:>7.1%} "
+              f"{stats.tokens_per_round:>8.2f}")
+        results[spec] = {"tokens_per_s": round(tps, 1), "speedup": round(tps / plain_tps, 2), **stats.as_dict()}
+    print("\n" + json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,67 @@
 import json
-import re
-import math
+import hashlib
+import itertools
+import sys
+import heapq
+import tempfile
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from pathlib import Path
-from typing import Union, List, Any, Optional
+from typing import Union, List, Any, Optional, Iterable, Iterator, Tuple
 from datetime import datetime
 
+# Make `src.*` importable when this file is run directly as a script
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.utils.json_stream import iter_json_records
+from src.utils.token_counter import get_token_counter
+from src.utils.pii import PiiMasker
+
 load_dotenv()
 
 # Time window (seconds) and token budget per group
 TIME_WINDOW_SECONDS = 10 * 60  # 10 minutes
 MAX_TOKENS = 768
 
+# PII kinds masked in one pass (available: url, email, handle, nric, phone)
+PII_KINDS = ("email", "phone")
+
+# Messages normalized + token-counted per batched tokenizer call
+COUNT_BATCH_SIZE = 1024
+
+# Streaming mode: messages held in memory per sorted run, and max runs merged at once
+SPILL_RUN_SIZE = 200_000
+MERGE_FAN_IN = 64
+
 # Paths (edit as needed)
 # Resolve paths relative to repository root so running the script from any CWD works
-REPO_ROOT = Path(__file__).resolve().parents[2]
 RAW_PATH = REPO_ROOT / "data" / "raw" / "messages.json"
 OUT_PATH = REPO_ROOT / "data" / "processed" / "cleaned_messages.json"
+# Streaming mode writes JSONL, which is what split_dataset.py reads
+OUT_JSONL_PATH = REPO_ROOT / "data" / "processed" / "cleaned_messages.jsonl"
+# Incremental mode: per-chat watermarks + trailing open groups
+MANIFEST_PATH = REPO_ROOT / "data" / "processed" / "build_manifest.json"
+MANIFEST_TAIL_BYTES = 1 << 16  # bytes before open_offset fingerprinted to detect a rewritten output
 MY_ID = 495290408
 
+_masker = PiiMasker(PII_KINDS)
+
+
 def normalize_text(text: str) -> str:
-    # Mask obvious PII
-    text = re.sub(r'\+?\d[\d\-\s]{7,}\d', '[PHONE]', text)
-    text = re.sub(r'\S+@\S+', '[EMAIL]', text)
-    return text.strip()
+    # Mask obvious PII (single compiled pass over all enabled kinds)
+    return _masker.mask(text).strip()
+
+
+def _normalized(m: dict) -> str:
+    """Normalized text of a message, computed once and cached on the message as `_text`."""
+    text = m.get("_text")
+    if text is None:
+        text = m["_text"] = normalize_text(m.get("text", "") or "")
+    return text
 
 
 def pseudo(sender_id: int, my_id: int) -> str:
@@ -52,16 +90,8 @@ def _parse_date(v) -> float:
 
 
 def _token_count(text: str) -> int:
-    """Estimate token count. Prefer tiktoken if available, else fallback to simple heuristic."""
-    try:
-        import tiktoken
-
-        enc = tiktoken.get_encoding("cl100k_base")
-        return len(enc.encode(text))
-    except Exception:
-        # Fallback: conservative estimate: token ~= words * 1.3, at least 1
-        words = len(text.split())
-        return max(1, math.ceil(words * 1.3))
+    """Token count via the shared cached counter (HF tokenizer if TOKENIZER_PATH is set, else tiktoken/heuristic)."""
+    return get_token_counter().count(text)
 
 
 def group_by_time_and_tokens(raw: List[dict], time_window_seconds: int = TIME_WINDOW_SECONDS, max_tokens: int = MAX_TOKENS) -> List[List[dict]]:
@@ -71,32 +101,31 @@ def group_by_time_and_tokens(raw: List[dict], time_window_seconds: int = TIME_WI
     raw: list of message dicts with at least keys: 'date' (epoch or ISO), 'text', 'is_out', 'sender_id'
     Returns a list of groups (each group is a list of messages in chronological order).
     """
-    # Sort by timestamp ascending
-    items = sorted(raw, key=lambda m: _parse_date(m.get("date")))
+    # Parse each date once, then sort by timestamp ascending
+    items = sorted(((_parse_date(m.get("date")), m) for m in raw), key=lambda p: p[0])
+    return list(_iter_groups(items, time_window_seconds, max_tokens))
 
-    groups: List[List[dict]] = []
+
+def _iter_groups(items: Iterable[Tuple[Optional[float], dict]], time_window_seconds: int = TIME_WINDOW_SECONDS,
+                 max_tokens: int = MAX_TOKENS, by_chat: bool = False) -> Iterator[List[dict]]:
+    """Yield groups from already-sorted (timestamp, message) pairs.
+
+    With `by_chat=True` the input is expected sorted by (chat_id, timestamp) and a
+    group never spans two chats. Only the current group is held in memory.
+    """
     cur_group: List[dict] = []
     cur_tokens = 0
     prev_ts: Optional[float] = None
+    prev_chat = None
 
-    for m in items:
-        try:
-            ts = _parse_date(m.get("date"))
-        except Exception:
-            # If no parseable date, treat as separate message far apart
-            ts = None
-
-        text = normalize_text(m.get("text", "") or "")
-        if not text:
-            # Skip empty messages entirely
-            continue
-
-        tcount = _token_count(text)
-
+    counter = get_token_counter()
+    for ts, m, tcount in _with_token_counts(items, counter):
         # Determine if we should start a new group
         start_new = False
         if prev_ts is None:
             start_new = True
+        elif by_chat and m.get("chat_id") != prev_chat:
+            start_new = True
         else:
             if ts is None or (ts - prev_ts) > time_window_seconds:
                 start_new = True
@@ -105,7 +134,7 @@ def group_by_time_and_tokens(raw: List[dict], time_window_seconds: int = TIME_WI
 
         if start_new:
             if cur_group:
-                groups.append(cur_group)
+                yield cur_group
             cur_group = [m]
             cur_tokens = tcount
         else:
@@ -113,11 +142,322 @@ def group_by_time_and_tokens(raw: List[dict], time_window_seconds: int = TIME_WI
             cur_tokens += tcount
 
         prev_ts = ts if ts is not None else prev_ts
+        prev_chat = m.get("chat_id")
 
     if cur_group:
-        groups.append(cur_group)
+        yield cur_group
+
+
+def _with_token_counts(items: Iterable[Tuple[Optional[float], dict]], counter) -> Iterator[Tuple[Optional[float], dict, int]]:
+    """Normalize and count tokens in batches of COUNT_BATCH_SIZE; messages with empty text are dropped."""
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, COUNT_BATCH_SIZE))
+        if not chunk:
+            return
+        block = []
+        for ts, m in chunk:
+            text = _normalized(m)
+            # Skip empty messages entirely
+            if text:
+                block.append((ts, m, text))
+        counts = counter.count_batch([text for _, _, text in block])
+        for (ts, m, _), n in zip(block, counts):
+            yield ts, m, n
+
+
+def group_to_sample(group: List[dict], my_id: int = MY_ID, with_metadata: bool = False) -> Optional[dict]:
+    """Turn one group into a training sample, or None if the group does not end on my message."""
+    # We only create a sample when the last message in the group is an outgoing message
+    last = group[-1]
+    if not last.get("is_out"):
+        return None
+
+    # Build context: all messages before the last one
+    convo = []
+    for m in group:
+        text = _normalized(m)
+        if not text:
+            continue
+        convo.append({"role": pseudo(m.get("sender_id"), my_id), "content": text})
+    # Sample format: {"messages": [{"role": "...", "content": "..."}, ...]}
+    sample = {"messages": convo}
+    if with_metadata:
+        # split_dataset.py groups on chat_id and orders on timestamp
+        sample["metadata"] = {"chat_id": last.get("chat_id"), "timestamp": last.get("date")}
+    return sample
+
+
+def _sort_key(m: dict) -> tuple:
+    # Missing chat ids / dates sort last instead of failing on None comparisons
+    cid = m.get("chat_id")
+    ts = m.get("_ts")
+    return (cid is None, cid if cid is not None else 0, ts is None, ts if ts is not None else 0.0)
+
+
+def _with_timestamp(records: Iterable[dict]) -> Iterator[dict]:
+    """Attach the parsed date as `_ts` so it is parsed exactly once per message."""
+    for m in records:
+        try:
+            m["_ts"] = _parse_date(m.get("date"))
+        except Exception:
+            m["_ts"] = None
+        yield m
+
+
+def _write_run(items: Iterable[dict], tmp_dir: Path, idx: int) -> Path:
+    path = tmp_dir / f"run_{idx:06d}.jsonl"
+    with path.open("w", encoding="utf-8") as f:
+        for m in items:
+            f.write(json.dumps(m, ensure_ascii=False) + "\n")
+    return path
+
+
+def _read_run(path: Path) -> Iterator[dict]:
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
 
-    return groups
+
+def external_sort(records: Iterable[dict], tmp_dir: Path, run_size: int = SPILL_RUN_SIZE,
+                  fan_in: int = MERGE_FAN_IN) -> Iterator[dict]:
+    """Sort messages by (chat_id, timestamp) using sorted runs spilled to `tmp_dir`.
+
+    At most `run_size` messages are in memory while spilling, and at most `fan_in`
+    runs are open while merging (larger inputs are merged in several passes).
+    """
+    runs: List[Path] = []
+    buf: List[dict] = []
+    for m in records:
+        buf.append(m)
+        if len(buf) >= run_size:
+            buf.sort(key=_sort_key)
+            runs.append(_write_run(buf, tmp_dir, len(runs)))
+            buf = []
+
+    buf.sort(key=_sort_key)
+    if not runs:
+        # Everything fit in a single run; no need to touch disk
+        yield from buf
+        return
+    if buf:
+        runs.append(_write_run(buf, tmp_dir, len(runs)))
+        buf = []
+
+    next_idx = len(runs)
+    while len(runs) > fan_in:
+        merged: List[Path] = []
+        for i in range(0, len(runs), fan_in):
+            batch = runs[i:i + fan_in]
+            merged.append(_write_run(heapq.merge(*(_read_run(r) for r in batch), key=_sort_key), tmp_dir, next_idx))
+            next_idx += 1
+            for r in batch:
+                r.unlink()
+        runs = merged
+
+    yield from heapq.merge(*(_read_run(r) for r in runs), key=_sort_key)
+
+
+def _iter_sample_lines(sorted_msgs: Iterable[dict], my_id: int) -> Iterator[str]:
+    """Serialized JSONL sample lines for messages sorted by (chat_id, timestamp) carrying `_ts`."""
+    groups = _iter_groups(((m.pop("_ts"), m) for m in sorted_msgs), by_chat=True)
+    for group in groups:
+        sample = group_to_sample(group, my_id, with_metadata=True)
+        if sample is not None:
+            yield json.dumps(sample, ensure_ascii=False) + "\n"
+
+
+def build_dataset_streaming(raw_path: Union[str, Path] = RAW_PATH, out_path: Union[str, Path] = OUT_JSONL_PATH,
+                            my_id: int = MY_ID, run_size: int = SPILL_RUN_SIZE) -> int:
+    """Out-of-core build: stream raw messages, external-sort by (chat_id, date),
+    group as they stream past and append samples to JSONL as they are produced.
+
+    Memory is bounded by `run_size` messages regardless of corpus size.
+    """
+    out_p = Path(out_path)
+    out_p.parent.mkdir(parents=True, exist_ok=True)
+    n_samples = 0
+    with tempfile.TemporaryDirectory(prefix="build_runs_", dir=out_p.parent) as tmp:
+        items = external_sort(_with_timestamp(iter_json_records(raw_path)), Path(tmp), run_size=run_size)
+        with out_p.open("w", encoding="utf-8") as f:
+            for line in _iter_sample_lines(items, my_id):
+                f.write(line)
+                n_samples += 1
+    print(f"✅ Built {n_samples} samples → {out_p}")
+    return n_samples
+
+
+def _build_chat_shard(msgs: List[dict], my_id: int) -> List[str]:
+    """Worker: sort one chat's messages and return its serialized sample lines."""
+    items = sorted(_with_timestamp(msgs), key=_sort_key)
+    return list(_iter_sample_lines(items, my_id))
+
+
+def build_dataset_parallel(raw_path: Union[str, Path] = RAW_PATH, out_path: Union[str, Path] = OUT_JSONL_PATH,
+                           my_id: int = MY_ID, workers: Optional[int] = None, mp_context=None, pool=None) -> int:
+    """Chat-sharded build on a process pool (`pool`, or a new one with `workers` processes).
+
+    Groups never span chats, so each chat is an independent shard. Shards are
+    submitted largest-first for load balancing but written in (chat_id) order,
+    so the output is byte-identical to `build_dataset_streaming`.
+    """
+    shards = defaultdict(list)
+    for m in iter_json_records(raw_path):
+        shards[m.get("chat_id")].append(m)
+    # Same chat ordering as _sort_key (None last)
+    chat_order = sorted(shards, key=lambda c: (c is None, c if c is not None else 0))
+
+    out_p = Path(out_path)
+    out_p.parent.mkdir(parents=True, exist_ok=True)
+    n_samples = 0
+    own_pool = pool is None
+    if own_pool:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+    try:
+        futures = {cid: pool.submit(_build_chat_shard, shards[cid], my_id)
+                   for cid in sorted(shards, key=lambda c: len(shards[c]), reverse=True)}
+        shards.clear()
+        with out_p.open("w", encoding="utf-8") as f:
+            for cid in chat_order:
+                lines = futures.pop(cid).result()
+                f.writelines(lines)
+                n_samples += len(lines)
+    finally:
+        if own_pool:
+            pool.shutdown()
+    print(f"✅ Built {n_samples} samples from {len(chat_order)} chats → {out_p}")
+    return n_samples
+
+
+def _tail_digest(path: Path, offset: int) -> str:
+    """sha1 of the last MANIFEST_TAIL_BYTES of `path` before `offset`."""
+    with path.open("rb") as f:
+        f.seek(max(0, offset - MANIFEST_TAIL_BYTES))
+        return hashlib.sha1(f.read(offset - f.tell())).hexdigest()
+
+
+def _load_manifest(path: Path, out_p: Path) -> dict:
+    if path.exists() and out_p.exists():
+        manifest = json.loads(path.read_text(encoding="utf-8"))
+        # A full build (stream / parallel) rewrites the output without touching the manifest:
+        # its offsets are only valid for the exact file the last incremental run left behind
+        if manifest.get("out_path") == str(out_p) and manifest.get("out_size") == out_p.stat().st_size \
+                and manifest.get("tail_sha1") == _tail_digest(out_p, manifest.get("open_offset", 0)):
+            return manifest
+        print(f"⚠️ Manifest {path} does not match {out_p}; rebuilding from scratch.")
+    # A new build_id tells `split_dataset.py incremental` its consumed offset is void
+    return {"version": 2, "build_id": uuid.uuid4().hex, "out_path": str(out_p), "open_offset": 0, "chats": {}}
+
+
+def _is_new(m: dict, state: Optional[dict]) -> bool:
+    if state is None:
+        return True
+    if state.get("last_id") is not None and m.get("id") is not None:
+        return m["id"] > state["last_id"]
+    # Without a message id, fall back to the timestamp watermark (undated messages can't be placed)
+    return m["_ts"] is not None and state.get("last_ts") is not None and m["_ts"] > state["last_ts"]
+
+
+def build_dataset_incremental(raw_path: Union[str, Path] = RAW_PATH, out_path: Union[str, Path] = OUT_JSONL_PATH,
+                              manifest_path: Union[str, Path] = MANIFEST_PATH, my_id: int = MY_ID) -> int:
+    """Append-only rebuild driven by a manifest of per-chat watermarks.
+
+    Only messages newer than a chat's watermark (message id, else timestamp) are
+    processed. Each chat's trailing group is kept open in the manifest because new
+    messages may still extend it; its sample lives after `open_offset` in the output
+    and is truncated + re-emitted on every run. Everything before `open_offset` is
+    final, which is what `split_dataset.py incremental` consumes. A trailing group
+    of a chat present in this pull that ended more than TIME_WINDOW_SECONDS before
+    the pull's newest message can no longer be extended, so it is closed and
+    written before `open_offset`; chats missing from the pull stay open.
+    Messages older than the watermark that show up late are ignored; run a full
+    `stream` build to pick those up.
+
+    The manifest records the output's size and a digest of the bytes before
+    `open_offset`; if the output no longer matches (e.g. a full build rewrote it),
+    the run starts over from scratch instead of appending to a foreign file.
+    """
+    out_p = Path(out_path)
+    manifest_p = Path(manifest_path)
+    out_p.parent.mkdir(parents=True, exist_ok=True)
+    manifest = _load_manifest(manifest_p, out_p)
+    chats = manifest["chats"]
+
+    # Collect only new messages, per chat, and which chats this pull covers up to when
+    new_msgs = defaultdict(list)
+    pulled = set()
+    horizon = None
+    for m in _with_timestamp(iter_json_records(raw_path)):
+        key = str(m.get("chat_id"))
+        pulled.add(key)
+        if m["_ts"] is not None and (horizon is None or m["_ts"] > horizon):
+            horizon = m["_ts"]
+        if _is_new(m, chats.get(key)):
+            new_msgs[key].append(m)
+
+    n_closed = 0
+    # Binary mode so offsets are plain byte positions (split_dataset.py seeks to them too)
+    mode = "r+b" if out_p.exists() and manifest["open_offset"] else "wb"
+    with out_p.open(mode) as f:
+        # Drop previously emitted open-group samples; they are re-emitted below
+        f.seek(manifest["open_offset"])
+        f.truncate()
+
+        for key in sorted(new_msgs, key=lambda k: (k == "None", k)):
+            state = chats.get(key) or {"last_ts": None, "last_id": None, "open_group": []}
+            msgs = new_msgs[key]
+            items = sorted(list(_with_timestamp(state["open_group"])) + msgs, key=_sort_key)
+
+            open_group: List[dict] = []
+            for group in _iter_groups(((m["_ts"], m) for m in items), by_chat=True):
+                if open_group:
+                    sample = group_to_sample(open_group, my_id, with_metadata=True)
+                    if sample is not None:
+                        f.write((json.dumps(sample, ensure_ascii=False) + "\n").encode("utf-8"))
+                        n_closed += 1
+                open_group = group
+
+            ts_vals = [m["_ts"] for m in msgs if m.get("_ts") is not None]
+            ids = [m["id"] for m in msgs if m.get("id") is not None]
+            if state.get("last_ts") is not None:
+                ts_vals.append(state["last_ts"])
+            if state.get("last_id") is not None:
+                ids.append(state["last_id"])
+            chats[key] = {
+                "last_ts": max(ts_vals) if ts_vals else None,
+                "last_id": max(ids) if ids else None,
+                "open_group": open_group,
+            }
+
+        # Close trailing groups no message can extend any more: the chat was pulled up to
+        # the horizon and stayed quiet for longer than the window
+        for key in sorted(chats, key=lambda k: (k == "None", k)):
+            state = chats[key]
+            if state["open_group"] and key in pulled and horizon is not None \
+                    and state.get("last_ts") is not None and horizon - state["last_ts"] > TIME_WINDOW_SECONDS:
+                sample = group_to_sample(state["open_group"], my_id, with_metadata=True)
+                if sample is not None:
+                    f.write((json.dumps(sample, ensure_ascii=False) + "\n").encode("utf-8"))
+                    n_closed += 1
+                state["open_group"] = []
+
+        manifest["open_offset"] = f.tell()
+        n_open = 0
+        for key in sorted(chats, key=lambda k: (k == "None", k)):
+            group = chats[key]["open_group"]
+            sample = group_to_sample(group, my_id, with_metadata=True) if group else None
+            if sample is not None:
+                f.write((json.dumps(sample, ensure_ascii=False) + "\n").encode("utf-8"))
+                n_open += 1
+            # Drop cached working fields (_ts, _text) before persisting
+            chats[key]["open_group"] = [{k: v for k, v in m.items() if not k.startswith("_")} for m in group]
+        manifest["out_size"] = f.tell()
+
+    manifest["tail_sha1"] = _tail_digest(out_p, manifest["open_offset"])
+    manifest_p.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    n_new = sum(len(v) for v in new_msgs.values())
+    print(f"✅ Incremental: {n_new} new messages in {len(new_msgs)} chats → {n_closed} new samples, {n_open} open (re-emitted)")
+    return n_closed
 
 
 def build_dataset():
@@ -128,26 +468,11 @@ def build_dataset():
     samples = []
 
     for gi, group in enumerate(groups):
-        # We only create a sample when the last message in the group is an outgoing message
-        last = group[-1]
-        if not last.get("is_out"):
+        sample = group_to_sample(group, my_id)
+        if sample is None:
             continue
-
-        # Build context: all messages before the last one
-        convo = []
-        for m in group:
-            reply = {}
-            role = pseudo(m.get("sender_id"), my_id)
-            text = normalize_text(m.get("text", "") or "")
-            if not text:
-                continue
-            reply["role"] = role
-            reply["content"] = text
-            convo.append(reply)
-        # Sample format: {"messages": [{"role": "...", "content": "..."}, ...]}
-        # convo is already a list of message dicts, so use it directly
-        samples.append({"messages": convo})
-        print(f"Group {gi} ({len(group)} msgs): {convo}")
+        samples.append(sample)
+        print(f"Group {gi} ({len(group)} msgs): {sample['messages']}")
 
     out_p = Path(OUT_PATH)
     out_p.parent.mkdir(parents=True, exist_ok=True)
@@ -188,4 +513,16 @@ def load_json_robust(path: Union[str, Path], *, allow_ndjson: bool = True, repla
         raise
 
 if __name__ == "__main__":
-    build_dataset()
+    # Usage: python build_dataset.py                 -> in-memory build to cleaned_messages.json
+    #        python build_dataset.py stream [raw]    -> out-of-core build to cleaned_messages.jsonl
+    #        python build_dataset.py parallel [raw] [workers] -> chat-sharded build, same output as `stream`
+    #        python build_dataset.py incremental [raw] -> only new messages since build_manifest.json, appended
+    if len(sys.argv) > 1 and sys.argv[1] == "stream":
+        build_dataset_streaming(sys.argv[2] if len(sys.argv) > 2 else RAW_PATH)
+    elif len(sys.argv) > 1 and sys.argv[1] == "incremental":
+        build_dataset_incremental(sys.argv[2] if len(sys.argv) > 2 else RAW_PATH)
+    elif len(sys.argv) > 1 and sys.argv[1] == "parallel":
+        build_dataset_parallel(sys.argv[2] if len(sys.argv) > 2 else RAW_PATH,
+                               workers=int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    else:
+        build_dataset()
@@ -1,8 +1,23 @@
 import json
+import os
 import pathlib
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
-INPUT_PATH = pathlib.Path("data/processed/sft_val.json")
-OUTPUT_PATH = pathlib.Path("data/processed/sft_val_chatml.jsonl")
+REPO_ROOT = pathlib.Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.utils.json_stream import iter_json_records
+
+INPUT_PATH = REPO_ROOT / "data" / "processed" / "sft_val.json"
+OUTPUT_PATH = REPO_ROOT / "data" / "processed" / "sft_val_chatml.jsonl"
+
+# Streaming conversion: samples per worker task, and output write buffer (bytes)
+CHUNK_SIZE = 2000
+WRITE_BUFFER = 1 << 20
 
 def convert_sample(original):
     # Expect original format:
@@ -13,72 +28,120 @@ def convert_sample(original):
     #   ],
     #   "output": "<assistant reply>"
     # }
+    #
+    # Samples straight from build_dataset/split_dataset already end with the
+    # assistant turn and have no "output"; those pass through unchanged.
+    # Their metadata (chat_id, timestamp, dedup weight) is carried over for
+    # scale_down.py's chat_id strata; the trainer only reads "messages".
     msgs = original.get("messages", [])
+    meta = {"metadata": original["metadata"]} if original.get("metadata") else {}
+    if "output" not in original and msgs and msgs[-1].get("role") == "assistant":
+        return {"messages": list(msgs), **meta}
     output = original.get("output", "").strip()
     if not output:
         raise ValueError("No output field in sample: {}".format(original))
-    # Append assistant turn
+    # Append assistant turn (to a copy; the input sample is left untouched)
+    msgs = list(msgs)
     msgs.append({
         "role": "assistant",
         "content": output
     })
     # Build new sample
     return {
-        "messages": msgs
+        "messages": msgs,
+        **meta,
     }
 
-def main():
-    print("Reading from:", INPUT_PATH)
-    with open(INPUT_PATH, "r", encoding="utf-8") as f_in:
-        text = f_in.read().strip()
+def _convert_element(original):
+    """Convert one parsed element; returns (jsonl line or None, skip reason or None)."""
+    # If the parsed element itself is a list (unexpected), assume it's a list of messages already
+    is_list = isinstance(original, list)
+    try:
+        new_sample = convert_sample({"messages": original} if is_list else original)
+    except Exception as e:
+        return None, ("Skipping element (list) due to: " if is_list else "Skipping sample due to: ") + str(e)
+    return json.dumps(new_sample, ensure_ascii=False) + "\n", None
 
-    # Determine whether input is a JSON array (single-file) or JSONL (one JSON object per line)
-    samples = []
-    if not text:
-        print("Input file is empty:", INPUT_PATH)
-        return
 
-    try:
-        data = json.loads(text)
-        # If the file contains a top-level list, treat each element as a sample
-        if isinstance(data, list):
-            samples = data
-        elif isinstance(data, dict):
-            # single dict: maybe one sample
-            samples = [data]
+def _convert_chunk(chunk):
+    lines, skipped = [], []
+    for original in chunk:
+        line, reason = _convert_element(original)
+        if line is None:
+            skipped.append(reason)
         else:
-            raise ValueError("Unexpected JSON root type: {}".format(type(data)))
-    except json.JSONDecodeError:
-        # Fallback: try to parse as JSONL (one JSON object per line)
-        samples = []
-        for line in text.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            samples.append(json.loads(line))
-
-    # Convert and write out as JSONL
-    with open(OUTPUT_PATH, "w", encoding="utf-8") as f_out:
-        for original in samples:
-            # If the parsed element itself is a list (unexpected), skip or handle
-            if isinstance(original, list):
-                # assume it's a list of messages already
-                sample_obj = {"messages": original}
-                try:
-                    new_sample = convert_sample(sample_obj)
-                except Exception as e:
-                    print("Skipping element (list) due to:", e)
-                    continue
-            else:
-                try:
-                    new_sample = convert_sample(original)
-                except Exception as e:
-                    print("Skipping sample due to:", e)
-                    continue
-
-            f_out.write(json.dumps(new_sample, ensure_ascii=False) + "\n")
-
-    print("Wrote converted file to:", OUTPUT_PATH)
+            lines.append(line)
+    return "".join(lines), len(lines), skipped
+
+
+def _chunks(iterable, n):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _ordered_map(pool, fn, iterable, max_in_flight):
+    """Like pool.map but only keeps `max_in_flight` tasks queued, so a huge input
+    is never fully materialized. Results come back in input order."""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def default_output_path(in_path):
+    # sft_val.json → sft_val_chatml.jsonl
+    p = pathlib.Path(in_path)
+    return p.with_name(p.name.split(".")[0] + "_chatml.jsonl")
+
+
+def convert_file(in_path, out_path=None, pool=None, chunk_size=CHUNK_SIZE, max_in_flight=8):
+    """Stream `in_path` (JSON array or JSONL) to ChatML JSONL at `out_path`.
+
+    Chunks are converted on `pool` (in order) when given, else inline. Memory
+    stays at a few chunks regardless of file size.
+    """
+    out_path = pathlib.Path(out_path or default_output_path(in_path))
+    print("Reading from:", in_path)
+    chunks = _chunks(iter_json_records(in_path), chunk_size)
+    if pool is None:
+        results = map(_convert_chunk, chunks)
+    else:
+        results = _ordered_map(pool, _convert_chunk, chunks, max_in_flight)
+
+    n_written = n_skipped = 0
+    with open(out_path, "w", encoding="utf-8", buffering=WRITE_BUFFER) as f_out:
+        for text, n, skipped in results:
+            f_out.write(text)
+            n_written += n
+            n_skipped += len(skipped)
+            for reason in skipped:
+                print(reason)
+
+    print(f"Wrote {n_written} samples ({n_skipped} skipped) to: {out_path}")
+    return n_written, n_skipped
+
+
+def convert_files(in_paths, workers=None, chunk_size=CHUNK_SIZE):
+    """Convert several inputs (e.g. train/val/test) sharing one process pool."""
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [convert_file(p, pool=pool, chunk_size=chunk_size, max_in_flight=2 * workers) for p in in_paths]
+
+
+def main():
+    convert_file(INPUT_PATH, OUTPUT_PATH)
 
 if __name__ == "__main__":
-    main()
+    # Usage: python convert_template.py                       -> INPUT_PATH → OUTPUT_PATH (single process)
+    #        python convert_template.py a.json b.json ...     -> stream + convert in parallel, each → <name>_chatml.jsonl
+    if len(sys.argv) > 1:
+        convert_files(sys.argv[1:])
+    else:
+        main()
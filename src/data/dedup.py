@@ -0,0 +1,254 @@
+"""Near-duplicate removal with MinHash + banded LSH (between build_dataset and split_dataset).
+
+Group chats produce lots of near-identical samples (forwards, "ok"/"lol"
+replies, stickers rendered as text). This stage finds them without comparing
+every pair:
+
+  pass 1  stream samples → MinHash signature of the normalized conversation text
+          → one 64-bit hash per LSH band, stored in an on-disk memmap [n, BANDS]
+  link    per band, samples with equal band hashes are linked; connected
+          components are found by vectorized min-label propagation (O(n log n) per round)
+  pass 2  stream samples again and drop duplicates (keep the first of each
+          cluster) or keep them with metadata.weight = 1 / cluster size
+
+In "weight" mode duplicates stay in the data, and split_dataset.py must keep
+both every chat and every cluster on one side. Chats linked by a cluster are
+merged (connected components over chat + cluster), and all samples of a merged
+group, duplicates or not, get the group's metadata.split_key. A cluster
+spanning more than MAX_CLUSTER_CHATS chats links nothing: those are common
+replies like "ok" or "lol", which would chain almost every chat into one
+group, so they may appear on both sides. Chats that link to nothing keep
+grouping by chat_id. Cluster and group names are the smallest content / chat
+hash among their members, not row numbers, so they are the same on every run
+and for hash-stable incremental splits.
+
+Usage:
+    python dedup.py [in.jsonl] [out.jsonl] [drop|weight]
+"""
+
+import hashlib
+import json
+import re
+import sys
+import tempfile
+import zlib
+from array import array
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.data.split_dataset import get_chat_id
+from src.utils.json_stream import iter_json_records
+
+IN_PATH = REPO_ROOT / "data" / "processed" / "cleaned_messages.jsonl"
+OUT_PATH = REPO_ROOT / "data" / "processed" / "cleaned_messages.dedup.jsonl"
+
+NUM_PERM = 128
+BANDS = 8             # 8 bands x 16 rows → ~0.88 Jaccard threshold (sliding-window samples overlap ~0.7)
+SHINGLE = 5           # character n-grams (conversations are short; word shingles are too coarse)
+MAX_CHARS = 4000      # only shingle the head of very long conversations
+BATCH = 2048          # samples per pass-1 batch
+MODE = "drop"         # "drop" or "weight"
+MAX_CLUSTER_CHATS = 16  # weight mode: clusters spread over more chats don't merge them
+SEED = 1
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_MASK32 = np.uint64(0xFFFFFFFF)
+_NON_WORD = re.compile(r"[^\w\s\[\]]+")
+_SPACES = re.compile(r"\s+")
+
+
+def _perm_params(num_perm: int = NUM_PERM, seed: int = SEED):
+    rng = np.random.RandomState(seed)
+    # a < 2^31 and 32-bit hashes keep a*x + b inside uint64
+    a = rng.randint(1, 1 << 31, size=num_perm, dtype=np.int64).astype(np.uint64)
+    b = rng.randint(0, 1 << 31, size=num_perm, dtype=np.int64).astype(np.uint64)
+    band_mul = rng.randint(1, 1 << 62, size=num_perm // BANDS, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+    return a, b, band_mul
+
+
+def conversation_text(sample: dict) -> str:
+    """Lowercased, punctuation-stripped, whitespace-collapsed text of the whole conversation."""
+    parts = [m.get("content", "") for m in sample.get("messages", [])]
+    if sample.get("output"):
+        parts.append(sample["output"])
+    text = _NON_WORD.sub(" ", " ".join(parts).lower())
+    return _SPACES.sub(" ", text).strip()[:MAX_CHARS]
+
+
+def shingle_hashes(text: str, n: int = SHINGLE) -> np.ndarray:
+    if len(text) <= n:
+        grams = {text}
+    else:
+        grams = {text[i:i + n] for i in range(len(text) - n + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash(text: str, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    hv = shingle_hashes(text)
+    return (((np.outer(hv, a) + b) % _MERSENNE) & _MASK32).min(axis=0)
+
+
+def band_hashes(sigs: np.ndarray, band_mul: np.ndarray) -> np.ndarray:
+    """[n, NUM_PERM] signatures → [n, BANDS] 64-bit band keys (wrapping multiply-add)."""
+    rows = sigs.shape[1] // BANDS
+    banded = sigs.reshape(sigs.shape[0], BANDS, rows)
+    with np.errstate(over="ignore"):
+        return (banded * band_mul).sum(axis=2, dtype=np.uint64)
+
+
+def _propagate_min_labels(keys: np.ndarray) -> np.ndarray:
+    """Connected components where samples sharing a key in any column are linked.
+
+    Each round, every sample takes the smallest label among samples that share
+    one of its keys; repeated until nothing changes. Labels end up as the index
+    of the first sample of each component.
+    """
+    n = keys.shape[0]
+    labels = np.arange(n, dtype=np.int64)
+    idx_dtype = np.int32 if n < 2**31 else np.int64
+    orders = [np.argsort(keys[:, j], kind="stable").astype(idx_dtype) for j in range(keys.shape[1])]
+    while True:
+        changed = False
+        for j, order in enumerate(orders):
+            col = keys[order, j]
+            starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+            group_min = np.minimum.reduceat(labels[order], starts)
+            sizes = np.diff(np.r_[starts, n])
+            new = np.repeat(group_min, sizes)
+            if (new < labels[order]).any():
+                labels[order] = np.minimum(labels[order], new)
+                changed = True
+        if not changed:
+            break
+        # Pointer jumping shortens chains between rounds
+        labels = labels[labels]
+    return labels
+
+
+def _content_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _cluster_names(labels: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """Per sample, the smallest content hash in its cluster: a name that doesn't depend on row order."""
+    order = np.argsort(labels, kind="stable")
+    starts = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]])
+    names = np.empty_like(hashes)
+    names[order] = np.repeat(np.minimum.reduceat(hashes[order], starts), np.diff(np.r_[starts, len(labels)]))
+    return names
+
+
+def _split_groups(dup_labels: np.ndarray, cluster_size: np.ndarray, chat_nodes: np.ndarray,
+                  node_hashes: np.ndarray):
+    """Per sample, a split group name (0 = keep grouping by chat) and the number of spread clusters.
+
+    Components over (chat, linking cluster): a cluster links its chats unless it
+    spans more than MAX_CLUSTER_CHATS of them.
+    """
+    n = len(dup_labels)
+    pairs = np.unique(np.column_stack([dup_labels, chat_nodes]), axis=0)
+    chats_per_cluster = np.bincount(pairs[:, 0], minlength=n)
+    linking = (cluster_size[dup_labels] > 1) & (chats_per_cluster[dup_labels] <= MAX_CLUSTER_CHATS)
+    # Non-linking samples get a key of their own in the cluster column
+    cluster_col = np.where(linking, dup_labels, n + np.arange(n))
+    groups = _propagate_min_labels(np.column_stack([chat_nodes, cluster_col]))
+    names = _cluster_names(groups, node_hashes[chat_nodes])
+    # Only groups that merged more than one chat need a key
+    group_pairs = np.unique(np.column_stack([groups, chat_nodes]), axis=0)
+    merged = np.bincount(group_pairs[:, 0], minlength=n)[groups] > 1
+    spread = int(((cluster_size > 1) & (chats_per_cluster > MAX_CLUSTER_CHATS)).sum())
+    return np.where(merged, names, np.uint64(0)), spread
+
+
+def dedup(in_path=IN_PATH, out_path=OUT_PATH, mode: str = MODE) -> dict:
+    if mode not in ("drop", "weight"):
+        raise ValueError(f"Unknown mode: {mode}")
+    a, b, band_mul = _perm_params()
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix="dedup_", dir=out_path.parent) as tmp:
+        # Pass 1: signatures → band keys on disk (+ content hashes and chats for weight mode)
+        keys_path = Path(tmp) / "bands.u64"
+        hashes = array("Q")
+        chat_nodes, node_hashes, chat_index = array("q"), array("Q"), {}
+        n = 0
+        with open(keys_path, "wb") as f:
+            records = iter_json_records(in_path)
+            while True:
+                batch = list(islice(records, BATCH))
+                if not batch:
+                    break
+                texts = [conversation_text(s) for s in batch]
+                sigs = np.stack([minhash(t, a, b) for t in texts])
+                band_hashes(sigs, band_mul).tofile(f)
+                if mode == "weight":
+                    hashes.extend(_content_hash(t) for t in texts)
+                    for sample, text in zip(batch, texts):
+                        chat = get_chat_id(sample)
+                        if chat is None or chat not in chat_index:
+                            # A sample without a chat is a node of its own, named by its content
+                            node_hashes.append(_content_hash(text) if chat is None else _content_hash(f"chat:{chat}"))
+                            if chat is not None:
+                                chat_index[chat] = len(node_hashes) - 1
+                        chat_nodes.append(len(node_hashes) - 1 if chat is None else chat_index[chat])
+                n += len(batch)
+        if n == 0:
+            out_path.write_text("")
+            return {"n": 0}
+
+        bands = np.memmap(keys_path, dtype=np.uint64, mode="r", shape=(n, BANDS))
+        dup_labels = _propagate_min_labels(bands)
+        cluster_size = np.bincount(dup_labels, minlength=n)
+        del bands
+        if mode == "weight":
+            names = _cluster_names(dup_labels, np.frombuffer(hashes, dtype=np.uint64))
+            groups, spread = _split_groups(dup_labels, cluster_size, np.frombuffer(chat_nodes, dtype=np.int64),
+                                           np.frombuffer(node_hashes, dtype=np.uint64))
+
+    # Pass 2: stream again and write
+    kept = 0
+    with open(out_path, "w", encoding="utf-8") as f:
+        for i, sample in enumerate(iter_json_records(in_path)):
+            rep = dup_labels[i]
+            if mode == "drop":
+                if rep != i:
+                    continue
+            else:
+                meta = dict(sample.get("metadata") or {})
+                meta["weight"] = 1.0 / float(cluster_size[rep])
+                if cluster_size[rep] > 1:
+                    meta["dup_cluster"] = f"{int(names[i]):016x}"
+                if groups[i]:
+                    meta["split_key"] = f"dup:{int(groups[i]):016x}"
+                sample["metadata"] = meta
+            f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+            kept += 1
+
+    n_clusters = int((cluster_size > 1).sum())
+    n_dups = int(n - (cluster_size > 0).sum())
+    stats = {"n": n, "written": kept, "dup_clusters": n_clusters, "duplicates": n_dups, "mode": mode}
+    if mode == "weight":
+        stats["merged_chat_samples"] = int((groups > 0).sum())
+        stats["spread_clusters"] = spread
+        keyed = groups[groups > 0]
+        biggest = int(np.unique(keyed, return_counts=True)[1].max()) if len(keyed) else 0
+        stats["largest_split_group"] = biggest
+        if biggest > 0.5 * n:
+            print(f"⚠️ One split group of merged chats holds {biggest}/{n} samples; train/val ratios will be coarse.")
+    print(f"✅ Dedup ({mode}): {n} samples, {n_dups} near-duplicates in {n_clusters} clusters → "
+          f"{kept} written to {out_path}")
+    return stats
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    dedup(args[0] if len(args) > 0 else IN_PATH,
+          args[1] if len(args) > 1 else OUT_PATH,
+          args[2] if len(args) > 2 else MODE)
@@ -0,0 +1,265 @@
+"""Pre-tokenize ChatML JSONL into packed, memory-mapped NumPy shards.
+
+Runs after convert_template.py. Each conversation is rendered with the ChatML
+template and the whole text is tokenized in one go (BOS added as at training
+time), so the ids are exactly what axolotl and inference see; the loss mask comes
+from the tokens' character offsets. Conversations are packed into fixed-length
+rows so short Telegram samples don't waste most of a padded batch.
+
+Per shard (`shard_XXXXX.*.npy`):
+  tokens     uint32 [rows, SEQ_LEN]   token ids (pad after the last conversation)
+  loss_mask  uint8  [rows, SEQ_LEN]   1 on assistant content + <|im_end|>, not the "\n" after it
+                                      (roles_to_train: assistant, train_on_eos: turn)
+  doc_ptr    int64  [rows + 1]        CSR pointer into doc_starts for each row
+  doc_starts int32  [n_docs]          start position of every conversation inside its row
+
+Output goes to data/processed/packed/<input>-<tokenizer hash>-L<SEQ_LEN>/, so a
+different tokenizer or sequence length never reuses stale shards, and an
+unchanged input is not re-tokenized.
+
+Usage:
+    python pack_shards.py [input.jsonl ...]
+"""
+
+import hashlib
+import json
+import os
+import sys
+from itertools import islice
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.utils.json_stream import iter_json_records
+
+INPUT_PATHS = [REPO_ROOT / "data" / "processed" / "sft_train_chatml.jsonl"]
+PACKED_DIR = REPO_ROOT / "data" / "processed" / "packed"
+# Matches sequence_len in configs/simple_axolotl.yaml
+SEQ_LEN = 1024
+ROWS_PER_SHARD = 4096
+TOKENIZE_BATCH = 512  # conversations per batched tokenizer call
+BASE_MODEL = os.getenv("TOKENIZER_PATH") or "mistralai/Mistral-7B-v0.1"
+
+IM_START = "<|im_start|>"
+IM_END = "<|im_end|>"
+
+
+def load_tokenizer(name_or_path: str = BASE_MODEL, local_files_only: bool = True):
+    from transformers import AutoTokenizer
+
+    # Like token_counter.py: never hit the network from the data pipeline unless asked to
+    return AutoTokenizer.from_pretrained(name_or_path, local_files_only=local_files_only)
+
+
+def tokenizer_fingerprint(tok) -> str:
+    """Stable hash of everything that changes token ids: vocab, special tokens and class."""
+    h = hashlib.sha256()
+    h.update(type(tok).__name__.encode())
+    h.update(json.dumps(sorted(tok.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps(tok.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _render(sample: dict):
+    """ChatML text of a conversation (as infer.CHATML_TEMPLATE renders it) and the
+    character spans trained on: assistant content + <|im_end|>, not the headers and
+    not the newline after <|im_end|>."""
+    parts, spans, pos = [], [], 0
+    for m in sample.get("messages", []):
+        header = f"{IM_START}{m.get('role')}\n"
+        body = f"{m.get('content', '')}{IM_END}"
+        if m.get("role") == "assistant":
+            spans.append((pos + len(header), pos + len(header) + len(body)))
+        parts.append(f"{header}{body}\n")
+        pos += len(parts[-1])
+    return "".join(parts), spans
+
+
+def _tokenize_batch(tok, samples: List[dict]):
+    """Tokenize a batch of rendered conversations in one tokenizer call; returns [(ids, mask)].
+
+    A token is trained on if its characters overlap a trainable span; special
+    tokens added by the tokenizer (BOS) have empty offsets and never are.
+    """
+    if not samples:
+        return []
+    if not tok.is_fast:
+        raise ValueError("pack_shards needs a fast tokenizer (offset mapping) to build the loss mask")
+    texts, spans = zip(*(_render(s) for s in samples))
+    enc = tok(list(texts), return_offsets_mapping=True)
+    out = []
+    for ids, offsets, sample_spans in zip(enc["input_ids"], enc["offset_mapping"], spans):
+        mask = [int(e > s and any(s < end and e > start for start, end in sample_spans)) for s, e in offsets]
+        out.append((list(ids), mask))
+    return out
+
+
+class _ShardWriter:
+    def __init__(self, out_dir: Path, seq_len: int, pad_id: int, rows_per_shard: int = ROWS_PER_SHARD):
+        self.out_dir = out_dir
+        self.seq_len = seq_len
+        self.pad_id = pad_id
+        self.rows_per_shard = rows_per_shard
+        self.shards: List[dict] = []
+        self._reset()
+
+    def _reset(self):
+        self.tokens = np.full((self.rows_per_shard, self.seq_len), self.pad_id, dtype=np.uint32)
+        self.mask = np.zeros((self.rows_per_shard, self.seq_len), dtype=np.uint8)
+        self.doc_ptr = [0]
+        self.doc_starts: List[int] = []
+        self.rows = 0
+
+    def add_row(self, ids: List[int], mask: List[int], starts: List[int]):
+        self.tokens[self.rows, :len(ids)] = ids
+        self.mask[self.rows, :len(mask)] = mask
+        self.doc_starts.extend(starts)
+        self.doc_ptr.append(len(self.doc_starts))
+        self.rows += 1
+        if self.rows == self.rows_per_shard:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        name = f"shard_{len(self.shards):05d}"
+        np.save(self.out_dir / f"{name}.tokens.npy", self.tokens[:self.rows])
+        np.save(self.out_dir / f"{name}.loss_mask.npy", self.mask[:self.rows])
+        np.save(self.out_dir / f"{name}.doc_ptr.npy", np.asarray(self.doc_ptr, dtype=np.int64))
+        np.save(self.out_dir / f"{name}.doc_starts.npy", np.asarray(self.doc_starts, dtype=np.int32))
+        self.shards.append({"name": name, "rows": self.rows})
+        self._reset()
+
+
+def _source_key(path: Path) -> dict:
+    st = path.stat()
+    return {"path": str(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def pack_file(in_path, tok=None, seq_len: int = SEQ_LEN, out_root: Path = PACKED_DIR, force: bool = False) -> Path:
+    """Tokenize + pack one ChatML JSONL file; returns the shard directory (reused if up to date)."""
+    in_path = Path(in_path)
+    tok = tok or load_tokenizer()
+    fp = tokenizer_fingerprint(tok)
+    out_dir = Path(out_root) / f"{in_path.name.split('.')[0]}-{fp[:12]}-L{seq_len}"
+    manifest_path = out_dir / "manifest.json"
+    source = _source_key(in_path)
+    if not force and manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("source") == source and manifest.get("tokenizer_hash") == fp:
+            print(f"✅ Up to date: {out_dir}")
+            return out_dir
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    pad_id = tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id
+    writer = _ShardWriter(out_dir, seq_len, pad_id)
+    row_ids: List[int] = []
+    row_mask: List[int] = []
+    row_starts: List[int] = []
+    n_docs = n_truncated = n_tokens = n_trainable = 0
+
+    records = iter_json_records(in_path)
+    while True:
+        batch = list(islice(records, TOKENIZE_BATCH))
+        if not batch:
+            break
+        for ids, mask in _tokenize_batch(tok, batch):
+            if not any(mask):
+                continue
+            if len(ids) > seq_len:
+                # Keep the tail: the reply being trained on is at the end
+                ids, mask = ids[-seq_len:], mask[-seq_len:]
+                n_truncated += 1
+            if len(row_ids) + len(ids) > seq_len:
+                writer.add_row(row_ids, row_mask, row_starts)
+                row_ids, row_mask, row_starts = [], [], []
+            # Never train on the first token of a packed conversation (it would be predicted
+            # from the previous conversation's context)
+            mask = [0] + mask[1:]
+            row_starts.append(len(row_ids))
+            row_ids.extend(ids)
+            row_mask.extend(mask)
+            n_docs += 1
+            n_tokens += len(ids)
+            n_trainable += sum(mask)
+    if row_ids:
+        writer.add_row(row_ids, row_mask, row_starts)
+    writer.flush()
+
+    n_rows = sum(s["rows"] for s in writer.shards)
+    manifest = {
+        "source": source,
+        "tokenizer": getattr(tok, "name_or_path", None),
+        "tokenizer_hash": fp,
+        "seq_len": seq_len,
+        "pad_id": int(pad_id),
+        "shards": writer.shards,
+        "n_rows": n_rows,
+        "n_docs": n_docs,
+        "n_tokens": n_tokens,
+        "n_trainable_tokens": n_trainable,
+        "n_truncated": n_truncated,
+    }
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    fill = n_tokens / (n_rows * seq_len) if n_rows else 0.0
+    print(f"✅ Packed {n_docs} conversations into {n_rows} rows of {seq_len} ({fill:.1%} filled, "
+          f"{n_truncated} truncated) → {out_dir}")
+    return out_dir
+
+
+class PackedDataset:
+    """Random-access view over packed shards, memory-mapped (nothing is read until indexed).
+
+    Items have input_ids, labels (-100 where not trained), position_ids (restart at
+    every packed conversation) and the row's conversation start offsets.
+    """
+
+    def __init__(self, shard_dir):
+        self.dir = Path(shard_dir)
+        self.manifest = json.loads((self.dir / "manifest.json").read_text())
+        self._shards = []
+        self._row_offsets = [0]
+        for s in self.manifest["shards"]:
+            name = s["name"]
+            self._shards.append({
+                "tokens": np.load(self.dir / f"{name}.tokens.npy", mmap_mode="r"),
+                "loss_mask": np.load(self.dir / f"{name}.loss_mask.npy", mmap_mode="r"),
+                "doc_ptr": np.load(self.dir / f"{name}.doc_ptr.npy", mmap_mode="r"),
+                "doc_starts": np.load(self.dir / f"{name}.doc_starts.npy", mmap_mode="r"),
+            })
+            self._row_offsets.append(self._row_offsets[-1] + s["rows"])
+
+    def __len__(self) -> int:
+        return self._row_offsets[-1]
+
+    def __getitem__(self, i: int) -> dict:
+        if i < 0:
+            i += len(self)
+        shard_idx = int(np.searchsorted(self._row_offsets, i, side="right")) - 1
+        sh = self._shards[shard_idx]
+        r = i - self._row_offsets[shard_idx]
+        tokens = np.asarray(sh["tokens"][r], dtype=np.int64)
+        mask = np.asarray(sh["loss_mask"][r], dtype=bool)
+        starts = np.asarray(sh["doc_starts"][sh["doc_ptr"][r]:sh["doc_ptr"][r + 1]], dtype=np.int64)
+
+        # Position ids restart at each conversation; padding continues the last one
+        positions = np.arange(len(tokens), dtype=np.int64)
+        seg = np.searchsorted(starts, positions, side="right") - 1
+        position_ids = positions - starts[np.maximum(seg, 0)]
+        labels = np.where(mask, tokens, -100)
+        return {"input_ids": tokens, "labels": labels, "position_ids": position_ids, "doc_starts": starts}
+
+
+def main(paths: Optional[List[str]] = None):
+    tok = load_tokenizer()
+    for p in paths or INPUT_PATHS:
+        pack_file(p, tok)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or None)
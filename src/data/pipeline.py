@@ -0,0 +1,345 @@
+"""Single entry point for the data pipeline: pull → build → (dedup) → split → convert → sample.
+
+Stages run as a DAG. Each stage's output lives in
+data/.cache/pipeline/<stage>-<key>/, where <key> hashes the stage's input file
+contents, its parameters, the source of the module implementing it plus every
+src/ module that module imports, and the environment variables that change its
+output (TOKENIZER_PATH: token counts decide grouping). If that directory is
+already complete the stage is skipped. Stages whose inputs are ready run in
+parallel; train/val conversion is one example. Stages that need worker
+processes submit to one shared pool, so concurrent stages split its workers
+instead of each starting a pool that spans every core. The workers are
+spawned, not forked from a threaded process. Finished outputs are
+copied to their usual places under data/processed/ so the rest of the repo
+(axolotl config, inference benchmarks) keeps working.
+
+Usage:
+    python src/data/pipeline.py [--pull] [--force] [--dedup drop|weight] [--workers N] [--streaming]
+"""
+
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+# The stages read .env (e.g. TOKENIZER_PATH); load it before their keys are computed
+load_dotenv()
+
+RAW_PATH = REPO_ROOT / "data" / "raw" / "messages.json"
+PROCESSED = REPO_ROOT / "data" / "processed"
+CACHE_DIR = REPO_ROOT / "data" / ".cache" / "pipeline"
+
+# A stage input is either an external file or (upstream stage, output file name)
+Input = Union[Path, Tuple[str, str]]
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[..., None]              # fn(inputs: Dict[str, Path], out_dir: Path, **params)
+    inputs: Dict[str, Input]
+    outputs: List[str]
+    params: dict = field(default_factory=dict)
+    publish: Dict[str, Path] = field(default_factory=dict)  # output name → copy destination
+    modules: List[str] = field(default_factory=list)        # src/data modules whose code the output depends on
+    env: List[str] = field(default_factory=list)            # environment variables the output depends on
+    processes: bool = False                                 # fn also takes pool= (the shared process pool)
+
+    @property
+    def deps(self) -> List[str]:
+        return sorted({v[0] for v in self.inputs.values() if isinstance(v, tuple)})
+
+
+# ---------------------------------------------------------------- stage bodies
+
+def _stage_build(inputs, out_dir, workers=None, streaming=False, pool=None):
+    from src.data.build_dataset import build_dataset_parallel, build_dataset_streaming
+
+    # Both modes write identical bytes; streaming keeps memory bounded, parallel uses all cores
+    if streaming:
+        build_dataset_streaming(inputs["raw"], out_dir / "cleaned_messages.jsonl")
+    else:
+        build_dataset_parallel(inputs["raw"], out_dir / "cleaned_messages.jsonl", workers=workers,
+                               mp_context=multiprocessing.get_context("spawn"), pool=pool)
+
+
+def _stage_dedup(inputs, out_dir, mode="drop"):
+    from src.data.dedup import dedup
+
+    dedup(inputs["samples"], out_dir / "cleaned_messages.dedup.jsonl", mode=mode)
+
+
+def _stage_split(inputs, out_dir, time_split=False):
+    from src.data import split_dataset
+
+    fn = split_dataset.streaming_time_split if time_split else split_dataset.streaming_split
+    fn(inputs["samples"], out_dir / "sft_train.jsonl", out_dir / "sft_val.jsonl")
+
+
+def _stage_convert(inputs, out_dir, workers=None, pool=None):
+    from src.data.convert_template import convert_file
+
+    workers = workers or os.cpu_count() or 1
+    own_pool = pool is None
+    with (ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) if own_pool
+          else nullcontext(pool)) as pool:
+        convert_file(inputs["samples"], out_dir / "chatml.jsonl", pool=pool, max_in_flight=2 * workers)
+
+
+def _stage_sample(inputs, out_dir, k=20000, seed=42, stratify=None):
+    from src.data import scale_down
+
+    path = inputs["chatml"]
+    if stratify:
+        samples = scale_down.stratified_sample_lines(path, k, scale_down.STRATA_KEYS[stratify], seed, use_index=False)
+    else:
+        # Same sampler as scale_down.py's default, so the published subset is the one it would write
+        samples = scale_down.reservoir_sample_lines(path, k, seed)
+    random.Random(seed).shuffle(samples)
+    with open(out_dir / "sample.jsonl", "w", encoding="utf-8") as f:
+        f.writelines(samples)
+
+
+def _count_label(k: int) -> str:
+    """20000 → "20k", 500 → "500" (the published sample's file name)."""
+    return f"{k // 1000}k" if k >= 1000 and k % 1000 == 0 else str(k)
+
+
+def default_stages(raw_path: Path = RAW_PATH, dedup_mode: Optional[str] = None, workers: Optional[int] = None,
+                   sample_k: int = 20000, streaming: bool = False) -> List[Stage]:
+    stages = [
+        Stage("build", _stage_build, {"raw": Path(raw_path)}, ["cleaned_messages.jsonl"],
+              {"workers": workers, "streaming": streaming},
+              publish={"cleaned_messages.jsonl": PROCESSED / "cleaned_messages.jsonl"},
+              modules=["build_dataset"], env=["TOKENIZER_PATH"], processes=not streaming),
+    ]
+    samples: Input = ("build", "cleaned_messages.jsonl")
+    if dedup_mode:
+        stages.append(Stage("dedup", _stage_dedup, {"samples": samples}, ["cleaned_messages.dedup.jsonl"],
+                            {"mode": dedup_mode}, modules=["dedup"]))
+        samples = ("dedup", "cleaned_messages.dedup.jsonl")
+    stages += [
+        Stage("split", _stage_split, {"samples": samples}, ["sft_train.jsonl", "sft_val.jsonl"],
+              publish={"sft_train.jsonl": PROCESSED / "sft_train_new.jsonl",
+                       "sft_val.jsonl": PROCESSED / "sft_val_new.jsonl"},
+              modules=["split_dataset"]),
+        Stage("convert_train", _stage_convert, {"samples": ("split", "sft_train.jsonl")}, ["chatml.jsonl"],
+              {"workers": workers}, publish={"chatml.jsonl": PROCESSED / "sft_train_chatml.jsonl"},
+              modules=["convert_template"], processes=True),
+        Stage("convert_val", _stage_convert, {"samples": ("split", "sft_val.jsonl")}, ["chatml.jsonl"],
+              {"workers": workers}, publish={"chatml.jsonl": PROCESSED / "sft_val_chatml.jsonl"},
+              modules=["convert_template"], processes=True),
+        Stage("sample_train", _stage_sample, {"chatml": ("convert_train", "chatml.jsonl")}, ["sample.jsonl"],
+              {"k": sample_k, "seed": 42},
+              publish={"sample.jsonl": PROCESSED / f"sft_train_chatml.{_count_label(sample_k)}.jsonl"},
+              modules=["scale_down"]),
+    ]
+    return stages
+
+
+# ---------------------------------------------------------------- caching
+
+_hash_lock = threading.Lock()
+
+
+def _file_digest(path: Path) -> str:
+    """sha256 of a file's contents, memoized on (size, mtime) so unchanged files aren't re-read."""
+    path = Path(path).resolve()
+    st = path.stat()
+    memo_path = CACHE_DIR / "file_hashes.json"
+    with _hash_lock:
+        memo = json.loads(memo_path.read_text()) if memo_path.exists() else {}
+        hit = memo.get(str(path))
+        if hit and hit["size"] == st.st_size and hit["mtime_ns"] == st.st_mtime_ns:
+            return hit["sha256"]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    with _hash_lock:
+        memo = json.loads(memo_path.read_text()) if memo_path.exists() else {}
+        memo[str(path)] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+        memo_path.parent.mkdir(parents=True, exist_ok=True)
+        memo_path.write_text(json.dumps(memo, indent=1))
+    return digest
+
+
+def _src_imports(path: Path) -> List[Path]:
+    """Files of the src.* modules `path` imports (at top level or inside functions)."""
+    found = []
+    for node in ast.walk(ast.parse(path.read_text(encoding="utf-8"))):
+        if isinstance(node, ast.Import):
+            names = [a.name for a in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            # `from src.data import split_dataset` names a module, `from src.utils.pii import X` doesn't
+            names = [node.module] + [f"{node.module}.{a.name}" for a in node.names]
+        else:
+            continue
+        for name in names:
+            if name.split(".")[0] == "src":
+                candidate = REPO_ROOT.joinpath(*name.split(".")).with_suffix(".py")
+                if candidate.exists():
+                    found.append(candidate)
+    return found
+
+
+def _module_files(modules: List[str]) -> List[Path]:
+    """The src/data modules plus everything under src/ they import, transitively."""
+    todo = [REPO_ROOT / "src" / "data" / f"{mod}.py" for mod in modules]
+    seen: Dict[Path, None] = {}
+    while todo:
+        path = todo.pop()
+        if path not in seen:
+            seen[path] = None
+            todo.extend(_src_imports(path))
+    return sorted(seen)
+
+
+def _code_digest(stage: Stage) -> str:
+    # Editing the stage body, the data module it calls or any src/ module that one imports
+    # (pii, token_counter, json_stream, ...) invalidates cached outputs
+    h = hashlib.sha256(inspect.getsource(stage.fn).encode("utf-8"))
+    for path in _module_files(stage.modules):
+        h.update(str(path.relative_to(REPO_ROOT)).encode())
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def _stage_key(stage: Stage, inputs: Dict[str, Path]) -> str:
+    h = hashlib.sha256()
+    h.update(stage.name.encode())
+    h.update(_code_digest(stage).encode())
+    # Worker counts and build mode change speed, not results
+    params = {k: v for k, v in stage.params.items() if k not in ("workers", "streaming")}
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    h.update(json.dumps({k: os.getenv(k) for k in stage.env}, sort_keys=True).encode())
+    for name in sorted(inputs):
+        h.update(name.encode())
+        h.update(_file_digest(inputs[name]).encode())
+    return h.hexdigest()[:16]
+
+
+def _publish(src: Path, dst: Path):
+    # Copy, not hardlink: published files may be edited in place (e.g. incremental builds)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(src, dst)
+
+
+def _run_stage(stage: Stage, inputs: Dict[str, Path], force: bool,
+               procs: ProcessPoolExecutor) -> Tuple[Path, str, float]:
+    t0 = time.perf_counter()
+    key = _stage_key(stage, inputs)
+    out_dir = CACHE_DIR / f"{stage.name}-{key}"
+    status = "cached"
+    if force or not (out_dir / "_stage.json").exists():
+        status = "ran"
+        tmp = out_dir.with_name(out_dir.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        if stage.processes:
+            stage.fn(inputs, tmp, pool=procs, **stage.params)
+        else:
+            stage.fn(inputs, tmp, **stage.params)
+        missing = [o for o in stage.outputs if not (tmp / o).exists()]
+        if missing:
+            raise RuntimeError(f"Stage {stage.name} did not produce {missing}")
+        (tmp / "_stage.json").write_text(json.dumps({
+            "stage": stage.name, "key": key, "params": stage.params,
+            "inputs": {k: str(v) for k, v in inputs.items()},
+        }, indent=2, default=str))
+        shutil.rmtree(out_dir, ignore_errors=True)
+        # Rename last, so an interrupted stage never looks complete
+        tmp.rename(out_dir)
+    for name, dst in stage.publish.items():
+        _publish(out_dir / name, dst)
+    return out_dir, status, time.perf_counter() - t0
+
+
+def run_pipeline(stages: List[Stage], workers: int = 4, force: bool = False,
+                 processes: Optional[int] = None) -> Dict[str, dict]:
+    """Run stages as soon as their upstream stages finish; returns per-stage status + timing.
+
+    `workers` threads run stages; `processes` (default: all cores) is the size of
+    the process pool that process stages share.
+    """
+    by_name = {s.name: s for s in stages}
+    pending = dict(by_name)
+    done: Dict[str, Path] = {}
+    report: Dict[str, dict] = {}
+    t_start = time.perf_counter()
+    # Workers start on first submit, so a fully cached run spawns nothing
+    procs = ProcessPoolExecutor(max_workers=processes or os.cpu_count() or 1,
+                                mp_context=multiprocessing.get_context("spawn"))
+    with procs, ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while pending or running:
+            for name, st in list(pending.items()):
+                if all(d in done for d in st.deps):
+                    inputs = {k: (done[v[0]] / v[1] if isinstance(v, tuple) else v) for k, v in st.inputs.items()}
+                    running[pool.submit(_run_stage, st, inputs, force, procs)] = name
+                    del pending[name]
+            if not running:
+                raise RuntimeError(f"Unresolvable stage dependencies: {sorted(pending)}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                out_dir, status, seconds = fut.result()
+                done[name] = out_dir
+                report[name] = {"status": status, "seconds": seconds, "out_dir": str(out_dir)}
+                print(f"[{name}] {status} in {seconds:.2f}s → {out_dir}")
+
+    total = time.perf_counter() - t_start
+    print("\nStage            status   seconds")
+    for st in stages:
+        r = report[st.name]
+        print(f"{st.name:<16} {r['status']:<8} {r['seconds']:8.2f}")
+    print(f"{'total (wall)':<16} {'':<8} {total:8.2f}")
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--raw", type=Path, default=RAW_PATH)
+    ap.add_argument("--pull", action="store_true", help="pull new Telegram messages first")
+    ap.add_argument("--force", action="store_true", help="ignore cached stage outputs")
+    ap.add_argument("--dedup", choices=["drop", "weight"], default=None)
+    ap.add_argument("--workers", type=int, default=None, help="processes shared by the parallel stages")
+    ap.add_argument("--streaming", action="store_true", help="out-of-core build (bounded memory) instead of parallel")
+    ap.add_argument("--sample-k", type=int, default=20000)
+    args = ap.parse_args()
+
+    if args.pull:
+        # The remote side can't be content-hashed, so pulling always runs; its output is then hashed like any file
+        import asyncio
+        from src.data.pull_telegram import pull_messages
+
+        t0 = time.perf_counter()
+        asyncio.run(pull_messages())
+        print(f"[pull] ran in {time.perf_counter() - t0:.2f}s")
+
+    run_pipeline(default_stages(args.raw, args.dedup, args.workers, args.sample_k, args.streaming), force=args.force,
+                 processes=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,9 +25,20 @@ DATA_RAW = REPO_ROOT / "data" / "raw"
 DATA_RAW.mkdir(parents=True, exist_ok=True)
 CANDIDATES_PATH = DATA_RAW / "chat_candidates.json"
 FILTER_PATH = DATA_RAW / "chat_candidates.json"
+# Per-chat NDJSON written as messages arrive + resume checkpoints (last pulled message id per chat);
+# messages.json is their merge, a JSON array
+CHATS_DIR = DATA_RAW / "chats"
+CHECKPOINT_PATH = DATA_RAW / "pull_checkpoints.json"
+MESSAGES_PATH = DATA_RAW / "messages.json"
+# Per-dialog scan results, keyed by dialog id + top message id
+SCAN_CACHE_PATH = DATA_RAW / "dialog_stats_cache.json"
 
-from telethon import TelegramClient
-client = TelegramClient('anon', api_id, api_hash)
+# Pull settings
+PULL_CONCURRENCY = 4       # chats pulled at once
+PULL_LIMIT = 5000          # max messages per chat per run (re-run to continue)
+CHECKPOINT_EVERY = 500     # messages between checkpoint flushes
+MAX_RETRIES = 5
+SCAN_CONCURRENCY = 8       # dialogs scanned at once
 
 def get_chat_name(entity):
     if hasattr(entity, "title") and entity.title:
@@ -39,11 +50,67 @@ def get_chat_name(entity):
     return str(entity.id)
 
 
-async def get_chat_filter_list(client):
-    dialogs = await client.get_dialogs()
+def _dialog_cache_key(dialog) -> str:
+    # A dialog whose newest message hasn't changed can't have new messages from me
+    top = getattr(getattr(dialog, "message", None), "id", None)
+    if top is None:
+        top = getattr(getattr(dialog, "dialog", None), "top_message", None)
+    return f"{dialog.entity.id}:{top}"
 
-    candidates = []
 
+def load_scan_cache(path: Path = SCAN_CACHE_PATH) -> dict:
+    params = {"target_year": TARGET_YEAR, "min_my_msgs": MIN_MY_MSGS}
+    if path.exists():
+        cache = json.loads(path.read_text())
+        # Counts depend on the selection params; drop the cache if they changed
+        if cache.get("params") == params:
+            return cache
+    return {"params": params, "dialogs": {}}
+
+
+async def _scan_dialog(client, entity) -> dict:
+    """Count my messages (up to MIN_MY_MSGS) since TARGET_YEAR and get the last message date."""
+    my_msg_count = 0
+    last_date = None
+    CUTOFF = datetime(TARGET_YEAR, 1, 1, tzinfo=pytz.UTC)
+    async for msg in client.iter_messages(entity.id, from_user="me", limit=2000):
+        if getattr(msg, "date", None):
+            last_date = msg.date
+            if msg.date < CUTOFF:
+                continue
+        my_msg_count += 1
+        if my_msg_count >= MIN_MY_MSGS:
+            break
+    return {
+        "my_msg_count": my_msg_count,
+        "last_my_message_date": last_date.isoformat() if last_date else None,
+    }
+
+
+async def _scan_dialog_cached(client, dialog, sem: asyncio.Semaphore, cache: dict):
+    key = _dialog_cache_key(dialog)
+    if key in cache["dialogs"]:
+        return cache["dialogs"][key], True
+    attempt = 0
+    async with sem:
+        while True:
+            try:
+                stats = await _scan_dialog(client, dialog.entity)
+                break
+            except Exception as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None or attempt >= MAX_RETRIES:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+    cache["dialogs"][key] = stats
+    return stats, False
+
+
+async def get_chat_filter_list(client, concurrency: int = SCAN_CONCURRENCY, cache_path: Path = SCAN_CACHE_PATH):
+    dialogs = await client.get_dialogs()
+
+    scan = []
     for dialog in dialogs:
         entity = dialog.entity
 
@@ -55,31 +122,43 @@ async def get_chat_filter_list(client):
         participants = getattr(entity, "participants_count", None)
         if participants and participants > MAX_MEMBERS:
             continue
+        scan.append(dialog)
 
-        # Count my messages to determine relevance + get last message date
-        my_msg_count = 0
-        last_date = None
-        CUTOFF = datetime(TARGET_YEAR, 1, 1, tzinfo=pytz.UTC)
-        async for msg in client.iter_messages(entity.id, from_user="me", limit=2000):
-            if getattr(msg, "date", None):
-                last_date = msg.date
-                if msg.date < CUTOFF:
-                    continue
-            my_msg_count += 1
-            # Only add if more than 100
-            if my_msg_count >= MIN_MY_MSGS:
-                candidate = {
-					"id": int(entity.id),
-					"name": get_chat_name(entity),
-					"participants_count": participants,
-					"my_msg_count": my_msg_count,
-					"last_my_message_date": last_date.isoformat() if last_date else None,
-					"type": type(entity).__name__,
-				}
-                print(type(entity), candidate["name"], participants, candidate["my_msg_count"])
-                candidates.append(candidate)
-                break
+    # Count my messages per dialog concurrently; unchanged dialogs come from the cache
+    cache = load_scan_cache(cache_path)
+    sem = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(_scan_dialog_cached(client, d, sem, cache) for d in scan), return_exceptions=True)
+
+    # Drop entries for dialogs that have moved on (their top message id changed)
+    live = {_dialog_cache_key(d) for d in scan}
+    cache["dialogs"] = {k: v for k, v in cache["dialogs"].items() if k in live}
+    cache_path.write_text(json.dumps(cache, indent=2))
+
+    candidates = []
+    n_cached = 0
+    for dialog, res in zip(scan, results):
+        entity = dialog.entity
+        if isinstance(res, Exception):
+            print(f"❌ Failed to scan {get_chat_name(entity)}: {res!r}")
+            continue
+        stats, cached = res
+        n_cached += cached
+        # Only add if more than MIN_MY_MSGS
+        if stats["my_msg_count"] < MIN_MY_MSGS:
+            continue
+        participants = getattr(entity, "participants_count", None)
+        candidate = {
+            "id": int(entity.id),
+            "name": get_chat_name(entity),
+            "participants_count": participants,
+            "my_msg_count": stats["my_msg_count"],
+            "last_my_message_date": stats["last_my_message_date"],
+            "type": type(entity).__name__,
+        }
+        print(type(entity), candidate["name"], participants, candidate["my_msg_count"])
+        candidates.append(candidate)
 
+    print(f"Scanned {len(scan)} dialogs ({n_cached} from cache)")
 
     # Write candidates to JSON so the user can manually filter/edit it.
     with open(CANDIDATES_PATH, "w") as fh:
@@ -90,6 +169,151 @@ async def get_chat_filter_list(client):
     return candidates
 
 
+def _msg_record(chat_id, msg) -> dict:
+    return {
+        "id": getattr(msg, "id", None),
+        "chat_id": int(chat_id),
+        "sender_id": getattr(msg, "sender_id", None),
+        "text": msg.text,
+        "date": str(getattr(msg, "date", None)),
+        "is_out": getattr(msg, "out", False),
+    }
+
+
+def load_checkpoints(path: Path = CHECKPOINT_PATH) -> dict:
+    if path.exists():
+        return json.loads(path.read_text())
+    return {}
+
+
+def save_checkpoints(checkpoints: dict, path: Path = CHECKPOINT_PATH):
+    # Write-then-rename so a crash never leaves a half-written checkpoint file
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(checkpoints, indent=2))
+    os.replace(tmp, path)
+
+
+def _last_id_in_file(path: Path):
+    """Id of the last complete record in a chat NDJSON file; drops a torn trailing line."""
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        block = min(size, 64 * 1024)
+        f.seek(size - block)
+        tail = f.read(block)
+        if not tail.endswith(b"\n"):
+            # Crash mid-write: cut back to the last full line
+            cut = tail.rfind(b"\n") + 1
+            f.truncate(size - block + cut)
+            tail = tail[:cut]
+        lines = tail.splitlines()
+        if not lines:
+            return None
+        try:
+            return json.loads(lines[-1]).get("id")
+        except json.JSONDecodeError:
+            return None
+
+
+def _retry_delay(e: Exception, attempt: int):
+    """Seconds to back off for a retryable error, or None if it should propagate."""
+    # Telethon's FloodWaitError carries the server-mandated wait in `.seconds`
+    seconds = getattr(e, "seconds", None)
+    if seconds is not None:
+        return seconds + 1
+    if isinstance(e, (ConnectionError, asyncio.TimeoutError)):
+        return min(60, 2 ** attempt)
+    return None
+
+
+async def pull_chat(client, chat_id: int, sem: asyncio.Semaphore, checkpoints: dict,
+                    chats_dir: Path = CHATS_DIR, checkpoint_path: Path = CHECKPOINT_PATH,
+                    limit: int = PULL_LIMIT) -> int:
+    """Pull one chat oldest → newest, appending to `<chats_dir>/<chat_id>.jsonl`.
+
+    Resumes after max(checkpoint, last id on disk), so a crash or re-run continues
+    where it stopped. Flood waits and dropped connections are retried in place.
+    """
+    key = str(chat_id)
+    path = chats_dir / f"{chat_id}.jsonl"
+    min_id = max(checkpoints.get(key, 0), _last_id_in_file(path) or 0)
+    seen = written = 0
+    attempt = 0
+
+    async with sem:
+        print(f"📥 Pulling chat_id: {chat_id} (after id {min_id})")
+        while True:
+            try:
+                with open(path, "a", encoding="utf-8") as f:
+                    async for msg in client.iter_messages(chat_id, reverse=True, min_id=min_id, limit=limit - seen):
+                        seen += 1
+                        min_id = max(min_id, getattr(msg, "id", 0) or 0)
+                        if not getattr(msg, "text", None):
+                            continue
+                        f.write(json.dumps(_msg_record(chat_id, msg), ensure_ascii=False) + "\n")
+                        written += 1
+                        if written % CHECKPOINT_EVERY == 0:
+                            f.flush()
+                            checkpoints[key] = min_id
+                            save_checkpoints(checkpoints, checkpoint_path)
+                break
+            except Exception as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None or attempt >= MAX_RETRIES:
+                    raise
+                attempt += 1
+                print(f"⏳ chat {chat_id}: {type(e).__name__}, retrying in {delay}s ({attempt}/{MAX_RETRIES})")
+                await asyncio.sleep(delay)
+
+    checkpoints[key] = min_id
+    save_checkpoints(checkpoints, checkpoint_path)
+    print(f"✅ chat {chat_id}: +{written} messages")
+    return written
+
+
+def merge_chat_files(chat_ids, out_path: Path = MESSAGES_PATH, chats_dir: Path = CHATS_DIR) -> int:
+    """Stream the per-chat NDJSON files, in `chat_ids` order, into one JSON array at `out_path`."""
+    n = 0
+    tmp = out_path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as out:
+        out.write("[\n")
+        for chat_id in chat_ids:
+            path = chats_dir / f"{chat_id}.jsonl"
+            if not path.exists():
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if n:
+                        out.write(",\n")
+                    out.write(line.rstrip("\n"))
+                    n += 1
+        out.write("\n]\n")
+    os.replace(tmp, out_path)
+    return n
+
+
+async def pull_selected(client, selected_ids, concurrency: int = PULL_CONCURRENCY,
+                        chats_dir: Path = CHATS_DIR, checkpoint_path: Path = CHECKPOINT_PATH) -> dict:
+    """Pull all selected chats concurrently (bounded by `concurrency`). Works with any client
+    exposing Telethon's `iter_messages(chat_id, reverse=, min_id=, limit=)` async iterator."""
+    chats_dir.mkdir(parents=True, exist_ok=True)
+    checkpoints = load_checkpoints(checkpoint_path)
+    sem = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *(pull_chat(client, cid, sem, checkpoints, chats_dir, checkpoint_path) for cid in selected_ids),
+        return_exceptions=True,
+    )
+    out = {}
+    for cid, r in zip(selected_ids, results):
+        if isinstance(r, Exception):
+            print(f"❌ chat {cid} failed: {r!r} (re-run to resume)")
+        out[cid] = r
+    return out
+
+
 async def pull_messages():
     client = TelegramClient("session", api_id, api_hash)
     await client.start()
@@ -120,27 +344,13 @@ async def pull_messages():
 
     print(f"✅ Using {len(selected_ids)} chat ids from {FILTER_PATH}")
 
-    all_msgs = []
-
-    for chat_id in selected_ids:
-        print(f"📥 Pulling chat_id: {chat_id}")
-        async for msg in client.iter_messages(chat_id, reverse=True, limit=5000):
-            if not getattr(msg, "text", None):
-                continue
-
-            all_msgs.append({
-                "chat_id": int(chat_id),
-                "sender_id": getattr(msg, "sender_id", None),
-                "text": msg.text,
-                "date": str(getattr(msg, "date", None)),
-                "is_out": getattr(msg, "out", False),
-            })
-
-    out_path = DATA_RAW / "messages.json"
-    json.dump(all_msgs, open(out_path, "w"), ensure_ascii=False, indent=2)
-    print(f"✅ Saved {len(all_msgs)} messages → {out_path}")
+    try:
+        await pull_selected(client, selected_ids)
+    finally:
+        await client.disconnect()
 
-    await client.disconnect()
+    n = merge_chat_files(selected_ids, MESSAGES_PATH)
+    print(f"✅ Saved {n} messages → {MESSAGES_PATH}")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,11 @@
+import json
+import math
 import random
 import sys
+from array import array
+from itertools import islice
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 #!/usr/bin/env python3
 """
@@ -10,33 +14,195 @@ scale_down.py
 Randomly sample K lines from a JSONL file using reservoir sampling (memory O(K)).
 Usage:
 	python scale_down.py --input sft_train_chatml.jsonl --output sft_train_chatml.20k.jsonl --k 20000 --seed 42
+
+Samplers:
+	reservoir_sample_lines       Algorithm R, one random draw per line (the default)
+	skip_reservoir_sample_lines  Algorithm L, draws only O(k log(n/k)) randoms by skipping ahead
+	indexed_sample_lines         picks line numbers up front and seeks via a cached byte-offset index
+	stratified_sample_lines      keeps the per-stratum (chat_id / length bucket) proportions of the input
+
+All of them see the same lines: split on "\n" only, blank (whitespace-only) lines
+skipped, so line ordinals agree between the index and the streaming passes.
 """
 
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+# Cached line index: <input>.idx = [file size, mtime_ns, offset of each non-empty line...] as uint64
+INDEX_SUFFIX = ".idx"
+
+
+def iter_line_records(path: Path) -> Iterator[Tuple[int, bytes]]:
+	"""(byte offset, raw line) of every non-blank line: the one line definition all samplers share."""
+	with path.open("rb") as f:
+		pos = 0
+		for line in f:
+			if line.strip():
+				yield pos, line
+			pos += len(line)
+
+
+def _iter_lines(path: Path) -> Iterator[str]:
+	return (line.decode("utf-8") for _, line in iter_line_records(path))
 
 
 def reservoir_sample_lines(path: Path, k: int, seed: int | None = None) -> List[str]:
 	rng = random.Random(seed)
 	reservoir: List[str] = []
-	with path.open("r", encoding="utf-8") as f:
-		for i, line in enumerate(f):
-			if not line.strip():
-				continue  # skip empty lines
-			if i < k:
-				reservoir.append(line)
-			else:
-				j = rng.randint(0, i)
-				if j < k:
-					reservoir[j] = line
+	# Count only non-empty lines so blank lines don't skew the replacement odds
+	for i, line in enumerate(_iter_lines(path)):
+		if i < k:
+			reservoir.append(line)
+		else:
+			j = rng.randint(0, i)
+			if j < k:
+				reservoir[j] = line
 	return reservoir
 
 
+def _uniform(rng: random.Random) -> float:
+	# (0, 1): log() of the draw must be finite
+	return rng.random() or 5e-324
+
+
+def skip_reservoir_sample_lines(path: Path, k: int, seed: int | None = None) -> List[str]:
+	"""Algorithm L (Li, 1994): same distribution as Algorithm R, but computes how many
+	lines to skip before the next replacement instead of drawing for every line."""
+	rng = random.Random(seed)
+	# Skipped lines are never decoded
+	lines = (line for _, line in iter_line_records(path))
+	reservoir = list(islice(lines, k))
+	if len(reservoir) < k or k == 0:
+		return [line.decode("utf-8") for line in reservoir]
+	w = math.exp(math.log(_uniform(rng)) / k)
+	while True:
+		skip = int(math.log(_uniform(rng)) / math.log(1.0 - w))
+		nxt = next(islice(lines, skip, skip + 1), None)
+		if nxt is None:
+			return [line.decode("utf-8") for line in reservoir]
+		reservoir[rng.randrange(k)] = nxt
+		w *= math.exp(math.log(_uniform(rng)) / k)
+
+
+def build_line_index(path: Path) -> array:
+	"""Byte offsets of every non-empty line, saved next to the input for reuse."""
+	st = path.stat()
+	index = array("Q", [st.st_size, st.st_mtime_ns])
+	index.extend(pos for pos, _ in iter_line_records(path))
+	with open(str(path) + INDEX_SUFFIX, "wb") as out:
+		index.tofile(out)
+	return index
+
+
+def load_line_index(path: Path) -> array:
+	"""Load the cached index if it still matches the file (size + mtime), else rebuild it."""
+	idx_path = Path(str(path) + INDEX_SUFFIX)
+	st = path.stat()
+	if idx_path.exists():
+		index = array("Q")
+		with idx_path.open("rb") as f:
+			index.frombytes(f.read())
+		if len(index) >= 2 and index[0] == st.st_size and index[1] == st.st_mtime_ns:
+			return index
+	return build_line_index(path)
+
+
+def _read_lines_at(path: Path, ordinals: Iterable[int], index: Optional[array] = None) -> List[str]:
+	"""Lines at the given non-empty-line ordinals (in ascending order); seeks when indexed."""
+	wanted = sorted(ordinals)
+	out: List[str] = []
+	if index is not None:
+		with path.open("rb") as f:
+			for i in wanted:
+				f.seek(index[i + 2])
+				out.append(f.readline().decode("utf-8"))
+		return out
+	want = set(wanted)
+	for i, (_, line) in enumerate(iter_line_records(path)):
+		if i in want:
+			out.append(line.decode("utf-8"))
+			if len(out) == len(want):
+				break
+	return out
+
+
+def indexed_sample_lines(path: Path, k: int, seed: int | None = None) -> List[str]:
+	"""Uniform sample of k lines by choosing line numbers up front and seeking to them.
+	After the first run the index is cached, so repeated subsampling skips the full read."""
+	rng = random.Random(seed)
+	index = load_line_index(path)
+	n = len(index) - 2
+	return _read_lines_at(path, rng.sample(range(n), min(k, n)), index)
+
+
+def chat_id_key(line: str) -> str:
+	# ChatML lines only carry a chat id if metadata was kept through conversion
+	try:
+		obj = json.loads(line)
+	except json.JSONDecodeError:
+		return "unknown"
+	meta = obj.get("metadata") or {}
+	cid = meta.get("chat_id", obj.get("chat_id"))
+	return "unknown" if cid is None else str(cid)
+
+
+def length_bucket_key(line: str) -> str:
+	# Power-of-two buckets of line length (chars): 64-127, 128-255, ...
+	return str(len(line).bit_length())
+
+
+STRATA_KEYS: Dict[str, Callable[[str], str]] = {
+	"chat_id": chat_id_key,
+	"length": length_bucket_key,
+}
+
+
+def _allocate(counts: Dict[str, int], k: int) -> Dict[str, int]:
+	"""Proportional quotas per stratum that sum to k (largest remainder)."""
+	n = sum(counts.values())
+	exact = {s: k * c / n for s, c in counts.items()}
+	quotas = {s: int(v) for s, v in exact.items()}
+	short = k - sum(quotas.values())
+	for s in sorted(exact, key=lambda s: (exact[s] - quotas[s], s), reverse=True)[:short]:
+		quotas[s] += 1
+	return quotas
+
+
+def stratified_sample_lines(path: Path, k: int, key: Callable[[str], str], seed: int | None = None,
+		use_index: bool = False) -> List[str]:
+	"""Sample k lines so each stratum keeps its share of the full file.
+
+	Pass 1 records each line's stratum (O(n) small ints); the chosen lines are then
+	read back by seeking through the offset index, or by a second streaming pass.
+	"""
+	rng = random.Random(seed)
+	members: Dict[str, array] = {}
+	for i, line in enumerate(_iter_lines(path)):
+		members.setdefault(key(line), array("Q")).append(i)
+	n = sum(len(v) for v in members.values())
+	if n == 0:
+		return []
+	if key is chat_id_key and list(members) == ["unknown"]:
+		print(f"⚠️ No line in {path} has metadata.chat_id (converted before convert_template kept metadata?); "
+			"chat_id strata collapse into one", file=sys.stderr)
+	quotas = _allocate({s: len(v) for s, v in members.items()}, min(k, n))
+	chosen: List[int] = []
+	for s in sorted(members):
+		chosen.extend(rng.sample(list(members[s]), quotas[s]))
+	return _read_lines_at(path, chosen, load_line_index(path) if use_index else None)
+
+
 def main() -> None:
 	# Hardcoded parameters (edit these values as needed)
-	INPUT_PATH = Path("data/processed/sft_train_chatml.jsonl")
-	OUTPUT_PATH = Path("data/processed/sft_train_chatml.20k.jsonl")
+	INPUT_PATH = REPO_ROOT / "data" / "processed" / "sft_train_chatml.jsonl"
+	OUTPUT_PATH = REPO_ROOT / "data" / "processed" / "sft_train_chatml.20k.jsonl"
 	K = 20000
 	SEED = 42
 	SHUFFLE_OUTPUT = True
+	STRATIFY = None  # None, "chat_id" or "length"
+	# "reservoir" (Algorithm R), "skip" (Algorithm L: faster, but a different subset for the same seed)
+	# or "indexed" (writes <input>.idx next to the data for fast repeated subsampling)
+	SAMPLER = "reservoir"
+	USE_INDEX = SAMPLER == "indexed"
 
 	input_path = INPUT_PATH
 	if not input_path.exists():
@@ -44,7 +210,14 @@ def main() -> None:
 		sys.exit(2)
 
 	out_path = OUTPUT_PATH
-	samples = reservoir_sample_lines(input_path, K, SEED)
+	if STRATIFY:
+		samples = stratified_sample_lines(input_path, K, STRATA_KEYS[STRATIFY], SEED, use_index=USE_INDEX)
+	elif SAMPLER == "indexed":
+		samples = indexed_sample_lines(input_path, K, SEED)
+	elif SAMPLER == "skip":
+		samples = skip_reservoir_sample_lines(input_path, K, SEED)
+	else:
+		samples = reservoir_sample_lines(input_path, K, SEED)
 
 	if not samples:
 		print("No samples found in input file.", file=sys.stderr)
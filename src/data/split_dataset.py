@@ -1,15 +1,26 @@
-import json, os, random
-from datetime import datetime
+import json, os, random, hashlib, sys
+from array import array
+from datetime import datetime, timezone
 from collections import defaultdict
 
 from pathlib import Path
 
 # Resolve paths from repo root (so script can be run from any CWD)
 REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.utils.json_stream import iter_json_records
+
 IN_PATH = REPO_ROOT / "data" / "processed" / "cleaned_messages.jsonl"
 OUT_DIR = REPO_ROOT / "data" / "processed"
 TRAIN_OUT = OUT_DIR / "sft_train_new.json"
 VAL_OUT = OUT_DIR / "sft_val_new.json"
+# Incremental mode appends JSONL (the format the axolotl config trains on)
+TRAIN_OUT_JSONL = OUT_DIR / "sft_train_new.jsonl"
+VAL_OUT_JSONL = OUT_DIR / "sft_val_new.jsonl"
+BUILD_MANIFEST = OUT_DIR / "build_manifest.json"
+SPLIT_MANIFEST = OUT_DIR / "split_manifest.json"
 
 RNG_SEED = 42
 SPLITS = (0.90, 0.10)  # train / val
@@ -22,6 +33,8 @@ def parse_ts(sample):
     ts = meta.get("timestamp") or sample.get("timestamp")
     if not ts:
         return None
+    if isinstance(ts, (int, float)):
+        return datetime.fromtimestamp(ts, tz=timezone.utc)
     try:
         # Handle both naive and tz-aware
         dt = datetime.fromisoformat(ts.replace("Z", "+00:00")) if "Z" in ts else datetime.fromisoformat(ts)
@@ -33,22 +46,42 @@ def get_chat_id(sample):
     meta = sample.get("metadata", {})
     return meta.get("chat_id") or sample.get("chat_id")
 
+def get_group_key(sample):
+    # dedup.py (weight mode) sets split_key on every sample of chats merged through near-duplicates;
+    # everything else groups by chat
+    meta = sample.get("metadata", {})
+    return meta.get("split_key") or get_chat_id(sample)
+
+def hash_fraction(key) -> float:
+    """Stable value in [0, 1) for a split key; same key → same side on every run/machine."""
+    h = hashlib.sha1(str(key).encode("utf-8")).digest()
+    return int.from_bytes(h[:8], "big") / 2**64
+
+def hash_split_key(sample):
+    # Samples without a chat id are keyed on their own content
+    key = get_group_key(sample)
+    if key is not None:
+        return f"chat:{key}"
+    return "sample:" + json.dumps(sample.get("messages"), ensure_ascii=False, sort_keys=True)
+
 def write_json(path, data):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
     with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False)
 
 def time_based_split(samples):
-    # Require timestamps; fall back if missing
-    with_ts = [s for s in samples if parse_ts(s) is not None]
-    without_ts = [s for s in samples if parse_ts(s) is None]
+    # Parse each timestamp once; require timestamps, fall back if missing
+    parsed = [(parse_ts(s), s) for s in samples]
+    with_ts = [(dt, s) for dt, s in parsed if dt is not None]
+    without_ts = [s for dt, s in parsed if dt is None]
 
     if len(with_ts) < int(0.8 * len(samples)):
         print("⚠️ Not enough timestamps to do robust time split. Falling back to grouped random.")
         return grouped_random_split(samples)
 
-    # Sort by time
-    with_ts.sort(key=lambda s: parse_ts(s))
+    # Sort by time (as epoch seconds, so naive and tz-aware values compare)
+    with_ts.sort(key=lambda p: p[0].timestamp())
+    with_ts = [s for _, s in with_ts]
     n = len(with_ts)
     n_train = int(SPLITS[0] * n)
     # Put the remainder into val so train+val == n
@@ -71,7 +104,7 @@ def grouped_random_split(samples):
     buckets = defaultdict(list)
     unknown_bucket = []
     for s in samples:
-        cid = get_chat_id(s)
+        cid = get_group_key(s)
         if cid is None:
             unknown_bucket.append(s)
         else:
@@ -103,6 +136,111 @@ def grouped_random_split(samples):
 
     return train, val
 
+def _ts_seconds(sample):
+    dt = parse_ts(sample)
+    return dt.timestamp() if dt is not None else None
+
+def report_ratios(n_train, n_val):
+    total = n_train + n_val
+    if not total:
+        print("No samples written.")
+        return
+    print(f"Split sizes → train={n_train} ({n_train / total:.1%}), val={n_val} ({n_val / total:.1%}) "
+          f"(target {SPLITS[0]:.0%}/{SPLITS[1]:.0%}, total {total})")
+
+def streaming_split(in_path=IN_PATH, train_out=TRAIN_OUT_JSONL, val_out=VAL_OUT_JSONL, cutoff=None, timestamps=None):
+    """One-pass split with O(1) memory, writing JSONL as it reads.
+
+    Default: stable hash of chat_id, so every chat lands wholly on one side (leak-free).
+    With `cutoff` (epoch seconds): samples before it → train, at/after → val,
+    undated → train (same rule as time_based_split). `timestamps` may supply
+    per-sample seconds precomputed in input order so nothing is parsed twice.
+    """
+    for out in (train_out, val_out):
+        Path(out).parent.mkdir(parents=True, exist_ok=True)
+    n_train = n_val = 0
+    with open(train_out, "w", encoding="utf-8") as f_train, open(val_out, "w", encoding="utf-8") as f_val:
+        for i, sample in enumerate(iter_json_records(in_path)):
+            if cutoff is None:
+                to_train = hash_fraction(hash_split_key(sample)) < SPLITS[0]
+            else:
+                ts = timestamps[i] if timestamps is not None else _ts_seconds(sample)
+                to_train = ts is None or ts != ts or ts < cutoff  # NaN marks "no timestamp"
+            line = json.dumps(sample, ensure_ascii=False) + "\n"
+            if to_train:
+                f_train.write(line)
+                n_train += 1
+            else:
+                f_val.write(line)
+                n_val += 1
+    report_ratios(n_train, n_val)
+    print(f"✅ Saved:\n  {train_out}\n  {val_out}")
+    return n_train, n_val
+
+def streaming_time_split(in_path=IN_PATH, train_out=TRAIN_OUT_JSONL, val_out=VAL_OUT_JSONL):
+    """Two-pass time split: pass 1 parses every timestamp exactly once into a compact
+    float array and picks the SPLITS[0] quantile as cutoff; pass 2 streams and routes."""
+    timestamps = array("d")
+    for sample in iter_json_records(in_path):
+        ts = _ts_seconds(sample)
+        timestamps.append(float("nan") if ts is None else ts)
+
+    dated = sorted(t for t in timestamps if t == t)
+    if not dated or len(dated) < int(0.8 * len(timestamps)):
+        print("⚠️ Not enough timestamps to do robust time split. Falling back to chat-hash split.")
+        return streaming_split(in_path, train_out, val_out)
+
+    cutoff = dated[min(int(SPLITS[0] * len(dated)), len(dated) - 1)]
+    print(f"Time cutoff: {datetime.fromtimestamp(cutoff, tz=timezone.utc).isoformat()}")
+    return streaming_split(in_path, train_out, val_out, cutoff=cutoff, timestamps=timestamps)
+
+def incremental_split():
+    """Append newly finalized samples from cleaned_messages.jsonl to the train/val JSONL files.
+
+    Reads only the byte range between the last consumed offset and the build
+    manifest's `open_offset` (samples after it may still change). Assignment is a
+    stable hash of chat_id, so a chat always lands on the same side (leak-free)
+    without needing to see the rest of the data.
+    """
+    if not BUILD_MANIFEST.exists():
+        print(f"No build manifest at {BUILD_MANIFEST}; run `build_dataset.py incremental` first.")
+        return
+    build_manifest = json.load(open(BUILD_MANIFEST, encoding="utf-8"))
+    end = build_manifest.get("open_offset", 0)
+
+    build_id = build_manifest.get("build_id")
+
+    state = json.load(open(SPLIT_MANIFEST, encoding="utf-8")) if SPLIT_MANIFEST.exists() else {}
+    start = state.get("consumed_offset", 0)
+    # A new build_id means the build output was rewritten from scratch: old offsets are void
+    if state.get("in_path") != str(IN_PATH) or state.get("build_id") != build_id or start > end:
+        if state:
+            print("⚠️ Split manifest does not match current build output; re-splitting from the start.")
+        start = 0
+        for p in (TRAIN_OUT_JSONL, VAL_OUT_JSONL):
+            if p.exists():
+                p.unlink()
+
+    n_train = n_val = 0
+    os.makedirs(OUT_DIR, exist_ok=True)
+    with open(IN_PATH, "rb") as f_in, open(TRAIN_OUT_JSONL, "ab") as f_train, open(VAL_OUT_JSONL, "ab") as f_val:
+        f_in.seek(start)
+        while f_in.tell() < end:
+            line = f_in.readline()
+            if not line.strip():
+                continue
+            sample = json.loads(line)
+            if hash_fraction(hash_split_key(sample)) < SPLITS[0]:
+                f_train.write(line)
+                n_train += 1
+            else:
+                f_val.write(line)
+                n_val += 1
+
+    json.dump({"in_path": str(IN_PATH), "build_id": build_id, "consumed_offset": end},
+              open(SPLIT_MANIFEST, "w", encoding="utf-8"))
+    print(f"✅ Appended train={n_train}, val={n_val} →\n  {TRAIN_OUT_JSONL}\n  {VAL_OUT_JSONL}")
+
 def main():
     # Support both JSON array and JSONL input
     with open(IN_PATH, "r", encoding="utf-8") as f:
@@ -130,4 +268,17 @@ def main():
     print(f"✅ Saved:\n  {TRAIN_OUT}\n  {VAL_OUT}")
 
 if __name__ == "__main__":
-    main()
+    # Usage: python split_dataset.py              -> full split to sft_{train,val}_new.json
+    #        python split_dataset.py incremental  -> append new samples to sft_{train,val}_new.jsonl
+    #        python split_dataset.py stream [cutoff_iso] -> one-pass split to sft_{train,val}_new.jsonl
+    #                                                     (chat hash, or time cutoff if given)
+    #        python split_dataset.py stream-time  -> two-pass time split at the SPLITS[0] quantile
+    if len(sys.argv) > 1 and sys.argv[1] == "incremental":
+        incremental_split()
+    elif len(sys.argv) > 1 and sys.argv[1] == "stream":
+        cutoff = datetime.fromisoformat(sys.argv[2]).timestamp() if len(sys.argv) > 2 else None
+        streaming_split(cutoff=cutoff)
+    elif len(sys.argv) > 1 and sys.argv[1] == "stream-time":
+        streaming_time_split()
+    else:
+        main()
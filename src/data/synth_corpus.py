@@ -0,0 +1,136 @@
+"""Seeded generator for realistic synthetic Telegram exports.
+
+Writes the same record shape pull_telegram.py produces (id, chat_id, sender_id,
+text, date, is_out), so every data stage can be exercised and benchmarked
+without sharing real chats. Output is streamed, so tens of millions of
+messages only cost disk.
+
+Realism knobs:
+  - chat sizes follow a Zipf-like law (a few very active chats, a long tail)
+  - senders per chat (2 = DM, more = small group); MY_ID is always a member
+  - burstiness: probability the next message follows within seconds rather than
+    after a long idle gap (drives group_by_time_and_tokens' window logic)
+  - message length: log-normal word counts, plus a share of one-word replies
+    ("ok", "lol") and occasional PII (phones, emails, URLs)
+
+Usage:
+    python synth_corpus.py out.jsonl [n_messages] [n_chats] [seed] [--array]
+"""
+
+import json
+import math
+import random
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator
+
+MY_ID = 495290408
+
+_WORDS = ("i u the can later eat where ah leh sia tmr meet at sure wanna think got no yes what "
+          "why how so like just one time go home now then work class lunch dinner gym sleep "
+          "tired bro hahaha idk nvm shag walao bus mrt late early done send pic see").split()
+_SHORT = ["ok", "lol", "haha", "ya", "k", "ohh", "nice", "lmao", "sure", "same", "[STICKER]"]
+
+
+@dataclass
+class SynthConfig:
+    n_messages: int = 100_000
+    n_chats: int = 50
+    max_senders: int = 6          # per chat, including me
+    zipf_s: float = 1.1           # chat-size skew
+    burstiness: float = 0.8       # P(next message is part of the current burst)
+    burst_gap_s: float = 20.0     # mean gap inside a burst
+    idle_gap_s: float = 6 * 3600  # mean gap between bursts
+    mean_words: float = 6.0
+    short_reply_rate: float = 0.2
+    pii_rate: float = 0.01
+    my_share: float = 0.45        # fraction of messages sent by me
+    seed: int = 0
+    start: datetime = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+def _chat_sizes(cfg: SynthConfig, rng: random.Random):
+    weights = [1.0 / (i + 1) ** cfg.zipf_s for i in range(cfg.n_chats)]
+    total = sum(weights)
+    sizes = [int(cfg.n_messages * w / total) for w in weights]
+    # Hand out the rounding remainder to the biggest chats
+    for i in range(cfg.n_messages - sum(sizes)):
+        sizes[i % cfg.n_chats] += 1
+    rng.shuffle(sizes)
+    return sizes
+
+
+def _text(cfg: SynthConfig, rng: random.Random) -> str:
+    if rng.random() < cfg.short_reply_rate:
+        return rng.choice(_SHORT)
+    sigma = 0.8
+    n = max(1, int(rng.lognormvariate(math.log(cfg.mean_words) - sigma ** 2 / 2, sigma)))
+    words = [rng.choice(_WORDS) for _ in range(n)]
+    if rng.random() < cfg.pii_rate:
+        pii = rng.choice((
+            f"+65 {rng.randint(8000, 9999)} {rng.randint(1000, 9999)}",
+            f"{rng.choice(_WORDS)}{rng.randint(1, 99)}@gmail.com",
+            f"https://t.me/{rng.choice(_WORDS)}{rng.randint(1, 999)}",
+        ))
+        words.insert(rng.randrange(len(words) + 1), pii)
+    return " ".join(words)
+
+
+def iter_messages(cfg: SynthConfig) -> Iterator[dict]:
+    """Yield messages chat by chat (the order pull_telegram.py's merged output has)."""
+    rng = random.Random(cfg.seed)
+    msg_id = 0
+    for chat_idx, size in enumerate(_chat_sizes(cfg, rng)):
+        chat_id = 1_000_000 + chat_idx
+        n_senders = rng.randint(2, max(2, cfg.max_senders))
+        others = [rng.randint(10_000_000, 2_000_000_000) for _ in range(n_senders - 1)]
+        ts = cfg.start + timedelta(seconds=rng.uniform(0, 30 * 86400))
+        for _ in range(size):
+            if rng.random() < cfg.burstiness:
+                ts += timedelta(seconds=rng.expovariate(1.0 / cfg.burst_gap_s))
+            else:
+                ts += timedelta(seconds=rng.expovariate(1.0 / cfg.idle_gap_s))
+            mine = rng.random() < cfg.my_share
+            msg_id += 1
+            yield {
+                "id": msg_id,
+                "chat_id": chat_id,
+                "sender_id": MY_ID if mine else rng.choice(others),
+                "text": _text(cfg, rng),
+                "date": str(ts.replace(microsecond=0)),
+                "is_out": mine,
+            }
+
+
+def write_corpus(path, cfg: SynthConfig, as_array: bool = False) -> int:
+    """Stream a corpus to `path` as NDJSON (default) or a JSON array like messages.json."""
+    n = 0
+    with open(path, "w", encoding="utf-8", buffering=1 << 20) as f:
+        if as_array:
+            f.write("[\n")
+        for m in iter_messages(cfg):
+            if as_array and n:
+                f.write(",\n")
+            f.write(json.dumps(m, ensure_ascii=False))
+            if not as_array:
+                f.write("\n")
+            n += 1
+        if as_array:
+            f.write("\n]\n")
+    return n
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if not args:
+        print(__doc__)
+        sys.exit(2)
+    cfg = SynthConfig(
+        n_messages=int(args[1]) if len(args) > 1 else SynthConfig.n_messages,
+        n_chats=int(args[2]) if len(args) > 2 else SynthConfig.n_chats,
+        seed=int(args[3]) if len(args) > 3 else SynthConfig.seed,
+    )
+    n = write_corpus(Path(args[0]), cfg, as_array="--array" in sys.argv)
+    print(f"✅ Wrote {n} synthetic messages → {args[0]}")
@@ -0,0 +1,362 @@
+"""BM25 retriever over past windows → replies, for lexical style few-shots.
+
+Each processed sample is one document: its window and Anselm's reply, indexed
+together, so a query matches on the situation and on his own wording. Doc ids
+are embed_job's window ids (window + reply), so hits line up with EmbedStore
+results for hybrid fusion (retrieval_pipeline.Retriever).
+
+An index is a directory (BM25_PATH):
+  meta.json      doc count, k1, b, generation, segment list; written last, so an
+                 interrupted save leaves the previous index intact
+  vocab.json     term → term id
+  df.npy         int32 [V]      documents containing each term
+  doc_len.npy    int32 [N]      tokens per document
+  norms.npy      float32 [N]    k1 · (1 - b + b · len / avgdl), each document's BM25 length norm
+  alive.npy      bool [N]       False = deleted or replaced
+  ids.json       doc number → doc id
+  docs.jsonl     id → window + reply, for prompt building
+  seg_NNNNN/     immutable CSR postings: ptr int64 [V_seg + 1], doc int32, tf uint16
+
+Every save() writes vocab.json through ids.json as a new generation
+(df.<gen>.npy, ids.<gen>.json, ...), since merges renumber documents. Older
+generations and merged-away segments are removed only after meta.json points
+at the new ones.
+
+Arrays are memory-mapped at load. add() turns a batch of documents into a new
+segment without touching existing postings. Beyond MAX_SEGMENTS, all segments
+are merged into one, which also drops deleted documents and refreshes df
+(until then deleted documents still count in df and N, as in Lucene).
+
+A query scores each term's postings slice in one vectorized expression. The
+per-document sums come from bincount.
+"""
+
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.embed_job import DOCS_NAME, window_and_reply, window_id
+from src.inference.response_cache import normalize
+from src.utils.json_stream import iter_json_records
+
+BM25_PATH = Path(os.getenv("BM25_PATH", REPO_ROOT / "data" / "embeddings" / "bm25"))
+INPUT_PATHS = [REPO_ROOT / "data" / "processed" / "sft_train.json"]
+K1 = 1.2
+B = 0.75
+MAX_SEGMENTS = 8
+ADD_BATCH = 200_000      # documents per new segment in update_from_samples()
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    # Same normalization as the response cache: lowercase, no punctuation, "loooool" == "lool"
+    return _TOKEN.findall(normalize(text))
+
+
+class BM25Index:
+    def __init__(self, path: Optional[str] = None, k1: float = K1, b: float = B):
+        self.path = Path(path) if path else None
+        self.k1 = k1
+        self.b = b
+        self.ids: List[str] = []
+        self._vocab: Dict[str, int] = {}
+        self._df = np.zeros(0, np.int32)
+        self._doc_len = np.zeros(0, np.int32)
+        self._norms = np.zeros(0, np.float32)
+        self._alive = np.zeros(0, bool)
+        self._row_of: Dict[str, int] = {}
+        self._segments: List[Tuple[str, np.ndarray, np.ndarray, np.ndarray]] = []  # (name, ptr, doc, tf)
+        self._unsaved: set = set()
+        self._next_segment = 0
+        self._generation = 0
+        self._lock = threading.RLock()
+        if self.path and (self.path / "meta.json").exists():
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+    def __contains__(self, id_) -> bool:
+        return str(id_) in self._row_of
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._row_of)
+
+    # -- persistence ----------------------------------------------------------------
+
+    _GENERATION_FILES = ("vocab.json", "df.npy", "doc_len.npy", "norms.npy", "alive.npy", "ids.json")
+
+    def _file(self, name: str, generation: int) -> Path:
+        stem, ext = name.split(".")
+        return self.path / (f"{stem}.{generation}.{ext}" if generation else name)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            for name, ptr, doc, tf in self._segments:
+                if name in self._unsaved:
+                    seg = self.path / name
+                    seg.mkdir(exist_ok=True)
+                    np.save(seg / "ptr.npy", ptr)
+                    np.save(seg / "doc.npy", doc)
+                    np.save(seg / "tf.npy", tf)
+            self._unsaved.clear()
+
+            # A new generation: the files meta.json currently lists are never touched
+            gen = self._generation + 1
+            for name, arr in (("df.npy", self._df), ("doc_len.npy", self._doc_len), ("norms.npy", self._norms),
+                              ("alive.npy", self._alive)):
+                np.save(self._file(name, gen), arr)
+            self._file("vocab.json", gen).write_text(json.dumps(self._vocab, ensure_ascii=False), encoding="utf-8")
+            self._file("ids.json", gen).write_text(json.dumps(self.ids, ensure_ascii=False), encoding="utf-8")
+            segments = [name for name, *_ in self._segments]
+            meta = {"n_docs": len(self.ids), "k1": self.k1, "b": self.b, "generation": gen, "segments": segments,
+                    "next_segment": self._next_segment}
+            tmp = self.path / "meta.json.tmp"
+            tmp.write_text(json.dumps(meta))
+            os.replace(tmp, self.path / "meta.json")
+            self._generation = gen
+            # Earlier generations and merged-away segments go only once meta.json no longer lists them
+            current = {self._file(name, gen).name for name in self._GENERATION_FILES}
+            for name in self._GENERATION_FILES:
+                stem, ext = name.split(".")
+                for old in [self.path / name, *self.path.glob(f"{stem}.*.{ext}")]:
+                    if old.name not in current and old.exists():
+                        old.unlink()
+            for old in self.path.glob("seg_*"):
+                if old.name not in segments:
+                    shutil.rmtree(old, ignore_errors=True)
+
+    def _load(self):
+        meta = json.loads((self.path / "meta.json").read_text())
+        n = meta["n_docs"]
+        self.k1, self.b, self._next_segment = meta["k1"], meta["b"], meta["next_segment"]
+        gen = self._generation = meta.get("generation", 0)
+        self._vocab = json.loads(self._file("vocab.json", gen).read_text(encoding="utf-8"))
+        self.ids = json.loads(self._file("ids.json", gen).read_text(encoding="utf-8"))[:n]
+        self._df = np.load(self._file("df.npy", gen), mmap_mode="r")
+        self._doc_len = np.load(self._file("doc_len.npy", gen), mmap_mode="r")[:n]
+        self._norms = np.load(self._file("norms.npy", gen), mmap_mode="r")[:n]
+        self._alive = np.array(np.load(self._file("alive.npy", gen))[:n])
+        for name in meta["segments"]:
+            seg = self.path / name
+            self._segments.append((name, *(np.load(seg / f, mmap_mode="r") for f in ("ptr.npy", "doc.npy", "tf.npy"))))
+        self._row_of = {self.ids[r]: int(r) for r in np.flatnonzero(self._alive)}
+
+    # -- updates --------------------------------------------------------------------
+
+    def _refresh_norms(self):
+        lengths = self._doc_len[self._alive] if self._alive.any() else self._doc_len
+        avgdl = float(lengths.mean()) if len(lengths) else 1.0
+        self._norms = (self.k1 * (1 - self.b + self.b * self._doc_len / max(avgdl, 1e-9))).astype(np.float32)
+
+    def add(self, docs: Iterable[Tuple[str, str]]) -> int:
+        """Index (id, text) pairs as one new segment; an id already indexed is replaced. Call save() to persist."""
+        with self._lock:
+            terms, doc_nums, tfs = array("i"), array("i"), array("H")
+            lengths: List[int] = []
+            new_ids: List[str] = []
+            df_delta: Counter = Counter()
+            start = len(self.ids)
+            for id_, text in docs:
+                id_ = str(id_)
+                if id_ in self._row_of:
+                    self.delete([id_])
+                tokens = tokenize(text)
+                counts = Counter(self._vocab.setdefault(t, len(self._vocab)) for t in tokens)
+                doc = start + len(new_ids)
+                for t, c in counts.items():
+                    terms.append(t)
+                    doc_nums.append(doc)
+                    tfs.append(min(c, 0xFFFF))
+                df_delta.update(counts.keys())
+                lengths.append(len(tokens))
+                new_ids.append(id_)
+            if not new_ids:
+                return 0
+            # A later id in the same batch replaces an earlier one
+            alive_new = np.ones(len(new_ids), bool)
+            for i, id_ in enumerate(new_ids):
+                if id_ in self._row_of:
+                    alive_new[self._row_of[id_] - start] = False
+                self._row_of[id_] = start + i
+            self.ids.extend(new_ids)
+            vocab_size = len(self._vocab)
+            df = np.zeros(vocab_size, np.int32)
+            df[:len(self._df)] = self._df
+            np.add.at(df, np.fromiter(df_delta.keys(), np.int64, len(df_delta)),
+                      np.fromiter(df_delta.values(), np.int32, len(df_delta)))
+            self._df = df
+            self._doc_len = np.concatenate([self._doc_len, np.asarray(lengths, np.int32)])
+            self._alive = np.concatenate([self._alive, alive_new])
+            self._add_segment(np.frombuffer(terms, np.int32), np.frombuffer(doc_nums, np.int32),
+                              np.frombuffer(tfs, np.uint16))
+            self._refresh_norms()
+            if len(self._segments) > MAX_SEGMENTS:
+                self.merge()
+            return len(new_ids)
+
+    def _add_segment(self, terms: np.ndarray, docs: np.ndarray, tfs: np.ndarray):
+        order = np.lexsort((docs, terms))
+        ptr = np.searchsorted(terms[order], np.arange(len(self._vocab) + 1)).astype(np.int64)
+        name = f"seg_{self._next_segment:05d}"
+        self._next_segment += 1
+        self._segments.append((name, ptr, docs[order], tfs[order]))
+        self._unsaved.add(name)
+
+    def delete(self, ids: Sequence[str]) -> int:
+        with self._lock:
+            rows = [self._row_of.pop(str(i)) for i in ids if str(i) in self._row_of]
+            if rows:
+                if not self._alive.flags.writeable:
+                    self._alive = np.array(self._alive)
+                self._alive[rows] = False
+            return len(rows)
+
+    def merge(self):
+        """Merge all segments into one. Deleted documents are dropped, the rest renumbered, df recounted."""
+        with self._lock:
+            if not self._segments:
+                return
+            keep = np.flatnonzero(self._alive)
+            remap = np.full(len(self.ids), -1, np.int32)
+            remap[keep] = np.arange(len(keep), dtype=np.int32)
+            parts_t, parts_d, parts_f = [], [], []
+            for _, ptr, doc, tf in self._segments:
+                t = np.repeat(np.arange(len(ptr) - 1, dtype=np.int32), np.diff(ptr))
+                d = remap[doc]
+                live = d >= 0
+                parts_t.append(t[live])
+                parts_d.append(d[live])
+                parts_f.append(np.asarray(tf)[live])
+            terms = np.concatenate(parts_t)
+            self.ids = [self.ids[r] for r in keep]
+            self._row_of = {id_: r for r, id_ in enumerate(self.ids)}
+            self._doc_len = np.asarray(self._doc_len)[keep]
+            self._alive = np.ones(len(keep), bool)
+            self._segments = []
+            self._unsaved.clear()
+            self._add_segment(terms, np.concatenate(parts_d), np.concatenate(parts_f))
+            self._df = np.bincount(terms, minlength=len(self._vocab)).astype(np.int32)
+            self._refresh_norms()
+
+    # -- search ---------------------------------------------------------------------
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Top-k (doc id, BM25 score), best first."""
+        with self._lock:
+            n = len(self.ids)
+            term_ids = {self._vocab[t] for t in tokenize(query) if t in self._vocab}
+            if not term_ids or n == 0:
+                return []
+            docs, weights = [], []
+            for t in term_ids:
+                df = int(self._df[t])
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for _, ptr, doc, tf in self._segments:
+                    if t + 1 >= len(ptr) or ptr[t] == ptr[t + 1]:
+                        continue
+                    d = doc[ptr[t]:ptr[t + 1]]
+                    f = tf[ptr[t]:ptr[t + 1]].astype(np.float32)
+                    docs.append(d)
+                    weights.append(idf * (self.k1 + 1) * f / (f + self._norms[d]))
+            if not docs:
+                return []
+            docs = np.concatenate(docs)
+            weights = np.concatenate(weights)
+            if len(docs) > n // 8:
+                # Long postings (common terms): a dense accumulator is cheaper than sorting
+                scores = np.bincount(docs, weights=weights, minlength=n)
+                cand = np.flatnonzero((scores > 0) & self._alive)
+                cand_scores = scores[cand]
+            else:
+                cand, inverse = np.unique(docs, return_inverse=True)
+                cand_scores = np.bincount(inverse, weights=weights)
+                alive = self._alive[cand]
+                cand, cand_scores = cand[alive], cand_scores[alive]
+            if len(cand) > k:
+                top = np.argpartition(-cand_scores, k - 1)[:k]
+                cand, cand_scores = cand[top], cand_scores[top]
+            order = np.argsort(-cand_scores, kind="stable")
+            return [(self.ids[cand[i]], float(cand_scores[i])) for i in order]
+
+    def stats(self) -> dict:
+        return {
+            "docs": len(self),
+            "deleted": len(self.ids) - len(self),
+            "terms": len(self._vocab),
+            "segments": len(self._segments),
+            "postings": int(sum(len(doc) for _, _, doc, _ in self._segments)),
+            "avgdl": round(float(self._doc_len[self._alive].mean()), 1) if len(self) else 0.0,
+        }
+
+
+def update_from_samples(paths: Iterable[Path] = INPUT_PATHS, index_path: Path = BM25_PATH) -> dict:
+    """Bring the index in line with the processed samples: new ones are added as a segment,
+    ones that disappeared are deleted; unchanged documents are not re-indexed."""
+    t0 = time.perf_counter()
+    index = BM25Index(index_path)
+    stats = {"samples": 0, "duplicates": 0, "existing": 0, "added": 0}
+    seen = set()
+    pending: List[Tuple[str, str]] = []
+    Path(index_path).mkdir(parents=True, exist_ok=True)
+    docs_path = Path(index_path) / DOCS_NAME
+    tmp = docs_path.with_suffix(".jsonl.tmp")
+    with open(tmp, "w", encoding="utf-8") as docs:
+        for path in paths:
+            if not Path(path).exists():
+                print(f"⚠️ Skipping missing {path}")
+                continue
+            for sample in iter_json_records(path):
+                pair = window_and_reply(sample)
+                if pair is None or not pair[0].strip():
+                    continue
+                stats["samples"] += 1
+                window, reply = pair
+                id_ = window_id(window, reply)
+                if id_ in seen:
+                    stats["duplicates"] += 1
+                    continue
+                seen.add(id_)
+                docs.write(json.dumps({"id": id_, "kind": "window", "text": window, "reply": reply},
+                                      ensure_ascii=False) + "\n")
+                if id_ in index:
+                    stats["existing"] += 1
+                    continue
+                pending.append((id_, f"{window}\n{reply}"))
+                if len(pending) >= ADD_BATCH:
+                    stats["added"] += index.add(pending)
+                    pending.clear()
+    stats["added"] += index.add(pending)
+    os.replace(tmp, docs_path)
+    stats["deleted"] = index.delete([id_ for id_ in index.keys() if id_ not in seen])
+    index.save()
+    stats["seconds"] = round(time.perf_counter() - t0, 2)
+    print(f"✅ BM25 index {index_path}: {len(index):,} docs ({stats['added']:,} added, {stats['existing']:,} unchanged, "
+          f"{stats['deleted']:,} deleted) in {stats['seconds']}s")
+    return stats
+
+
+if __name__ == "__main__":
+    inputs = [Path(p) for p in sys.argv[1:]] or INPUT_PATHS
+    update_from_samples(inputs)
+    print(BM25Index(BM25_PATH).stats())
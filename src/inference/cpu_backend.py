@@ -0,0 +1,83 @@
+"""CPU backend for the chat model (the always-on bot boxes have no GPU).
+
+  - fp32 weights: fp16 matmuls are slow or unsupported on most CPUs
+  - int8 dynamic quantization of every nn.Linear (weights stored int8,
+    activations quantized per batch on the fly): ~4x smaller linear layers
+    and faster matmuls with the fbgemm/x86 kernels
+  - thread tuning: intra-op threads = cores available to this process,
+    inter-op threads = 1 (generation is a sequential chain of small ops)
+  - optional torch.compile of the forward pass (dynamic shapes, since prompt
+    and KV lengths change every call); falls back to eager if compilation fails
+
+Selected through model_loader: INFER_BACKEND=cpu (fp32) or cpu-int8, and
+TORCH_COMPILE=1 for the compiled graph.
+"""
+
+import gc
+import os
+import warnings
+from typing import Optional
+
+QUANT_ENGINES = ("x86", "fbgemm", "qnnpack")  # in order of preference
+
+
+def available_cores() -> int:
+    try:
+        # Respects taskset / container CPU pinning, unlike os.cpu_count()
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def configure_threads(threads: Optional[int] = None) -> int:
+    import torch
+
+    threads = threads or int(os.getenv("CPU_THREADS", "0")) or available_cores()
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before any parallel work has started in this process
+        pass
+    return threads
+
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of all Linear layers (in place where possible; returns the model)."""
+    import torch
+
+    engines = torch.backends.quantized.supported_engines
+    for engine in QUANT_ENGINES:
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            break
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao, but needs no extra dependency
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", UserWarning)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    # Release the replaced fp32 weights now rather than at some later collection
+    gc.collect()
+    return model
+
+
+def compile_forward(model):
+    import torch
+
+    try:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    except Exception as e:
+        print(f"⚠️ torch.compile unavailable ({e!r}); using eager mode")
+    return model
+
+
+def prepare_cpu_model(model, quantize: bool = True, compile: bool = False, threads: Optional[int] = None):
+    """Turn a freshly loaded fp32 CPU model into the serving model."""
+    n = configure_threads(threads)
+    model.eval()
+    if quantize:
+        model = quantize_int8(model)
+    if compile:
+        model = compile_forward(model)
+    print(f"🧮 CPU backend: {'int8' if quantize else 'fp32'}{' + compile' if compile else ''}, {n} threads")
+    return model
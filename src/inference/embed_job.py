@@ -0,0 +1,213 @@
+"""Embed every conversation window and every Anselm reply into the vector store.
+
+Streams processed samples (ChatML, or sft_*.json with the reply in "output").
+The reply is what Anselm said; the messages before it (minus the system prompt)
+are its window:
+  window   the conversation leading up to a reply, retrieved as a "window → reply" example
+  reply    the reply on its own, retrieved for phrasing
+
+Vectors are cached by content: a store id is `<kind>:<sha1 of the normalized
+text>`, so after a data refresh only new or changed texts reach the encoder.
+A window's id also hashes its reply (window_id), because the same window ("hi",
+"ok") is answered differently across samples; each window → reply pair is its
+own entry. Identical window texts in one buffer are encoded once. Ids that no
+longer occur are deleted. Switching the encoder re-embeds everything.
+
+Texts are batched by length: BUFFER pending texts are sorted by length and cut
+into batches of at most BATCH_SIZE texts and MAX_BATCH_CHARS padded characters,
+so short replies aren't padded to the longest window.
+
+docs.jsonl next to the store maps each id to its text (and a window's reply) for
+prompt building.
+
+Usage:
+    python embed_job.py [samples.jsonl ...]
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import unicodedata
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.embed_store import IVF_MIN_ROWS, STORE_PATH, EmbedStore
+from src.utils.json_stream import iter_json_records
+
+INPUT_PATHS = [REPO_ROOT / "data" / "processed" / "sft_train_chatml.jsonl"]
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+DOCS_NAME = "docs.jsonl"
+BATCH_SIZE = 64
+MAX_BATCH_CHARS = 32_000   # batch size × longest text in it
+BUFFER = 4096              # texts sorted together for length batching
+SAVE_EVERY = 50_000        # new vectors between store checkpoints
+COMPACT_RATIO = 0.25       # compact once this share of rows is deleted
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def text_id(kind: str, text: str) -> str:
+    return f"{kind}:{hashlib.sha1(normalize(text).encode('utf-8')).hexdigest()[:20]}"
+
+
+def window_id(window: str, reply: str) -> str:
+    return text_id("window", f"{window}\n→ {reply}")
+
+
+def window_and_reply(sample: dict) -> Optional[Tuple[str, str]]:
+    """(window, reply) of a processed sample: sft_*.json ("output" holds the reply) or
+    ChatML (the final assistant turn is the reply). None if there is no reply."""
+    msgs = [m for m in sample.get("messages", []) if m.get("role") != "system"]
+    if "output" in sample:
+        reply = sample["output"]
+    elif msgs and msgs[-1].get("role") == "assistant":
+        reply, msgs = msgs[-1].get("content", ""), msgs[:-1]
+    else:
+        return None
+    return "\n".join(m.get("content", "") for m in msgs), reply
+
+
+def iter_texts(paths: Iterable[Path]) -> Iterator[Tuple[str, str, str]]:
+    """(kind, text, reply) for every sample: its window, then its reply."""
+    for path in paths:
+        for sample in iter_json_records(path):
+            pair = window_and_reply(sample)
+            if pair is None:
+                continue
+            window, reply = pair
+            if normalize(window):
+                yield "window", window, reply
+            if normalize(reply):
+                yield "reply", reply, ""
+
+
+def load_docs(path: Path) -> Dict[str, dict]:
+    """id → {"kind", "text", "reply"} from a docs.jsonl; empty if there is none yet."""
+    if not Path(path).exists():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {d["id"]: d for d in map(json.loads, f)}
+
+
+def length_batches(items: List[Tuple[str, str]], batch_size: int = BATCH_SIZE,
+                   max_chars: int = MAX_BATCH_CHARS) -> Iterator[List[Tuple[str, str]]]:
+    """Sort (id, text) pairs by length and cut them into batches of similar length."""
+    batch = []
+    for item in sorted(items, key=lambda it: len(it[1])):
+        # Sorted ascending, so the new item is the longest of the batch
+        if batch and (len(batch) >= batch_size or len(item[1]) * (len(batch) + 1) > max_chars):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+
+def load_encoder(name: str = EMBED_MODEL) -> Callable[[List[str]], np.ndarray]:
+    """A local sentence-transformers model on CPU: texts → float32 [n, dim], L2-normalized."""
+    from sentence_transformers import SentenceTransformer
+
+    from src.inference.cpu_backend import configure_threads
+
+    threads = configure_threads()
+    model = SentenceTransformer(name, device="cpu")
+    print(f"🧮 Encoder {name} on CPU ({threads} threads)")
+
+    def encode(texts: List[str]):
+        return model.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True,
+                            show_progress_bar=False)
+
+    return encode
+
+
+def run(paths: Iterable[Path] = INPUT_PATHS, store_path: Path = STORE_PATH, model: str = EMBED_MODEL,
+        encode: Optional[Callable[[List[str]], np.ndarray]] = None) -> dict:
+    store = EmbedStore(store_path)
+    if len(store) and store.info.get("encoder") != model:
+        print(f"⚠️ Store was embedded with {store.info.get('encoder')}, not {model}: re-embedding everything")
+        store.clear()
+    store.info["encoder"] = model
+    stats = {"texts": 0, "duplicates": 0, "cached": 0, "embedded": 0, "encoded": 0, "batches": 0, "chars": 0,
+             "padded_chars": 0}
+    seen = set()
+    pending: List[Tuple[str, str]] = []
+    since_save = 0
+    t0 = time.perf_counter()
+
+    def flush():
+        nonlocal encode, since_save
+        if not pending:
+            return
+        if encode is None:
+            # Only load the model when something actually needs embedding
+            encode = load_encoder(model)
+        # One window text can stand for several window → reply ids: encode it once
+        by_text: Dict[str, List[str]] = {}
+        for id_, text in pending:
+            by_text.setdefault(text, []).append(id_)
+        for batch in length_batches([(ids, text) for text, ids in by_text.items()]):
+            texts = [text for _, text in batch]
+            store.add(np.repeat(encode(texts), [len(ids) for ids, _ in batch], axis=0),
+                      [id_ for ids, _ in batch for id_ in ids])
+            stats["encoded"] += len(texts)
+            stats["batches"] += 1
+            stats["chars"] += sum(map(len, texts))
+            stats["padded_chars"] += len(texts) * max(map(len, texts))
+        stats["embedded"] += len(pending)
+        since_save += len(pending)
+        pending.clear()
+        if since_save >= SAVE_EVERY:
+            store.save()
+            since_save = 0
+            print(f"   {stats['embedded']:,} embedded, {stats['cached']:,} cached")
+
+    docs_path = Path(store_path) / DOCS_NAME
+    docs_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = docs_path.with_suffix(".jsonl.tmp")
+    with open(tmp, "w", encoding="utf-8") as docs:
+        for kind, text, reply in iter_texts(paths):
+            stats["texts"] += 1
+            id_ = window_id(text, reply) if kind == "window" else text_id(kind, text)
+            if id_ in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(id_)
+            docs.write(json.dumps({"id": id_, "kind": kind, "text": text, "reply": reply}, ensure_ascii=False) + "\n")
+            if id_ in store:
+                stats["cached"] += 1
+                continue
+            pending.append((id_, text))
+            if len(pending) >= BUFFER:
+                flush()
+        flush()
+    os.replace(tmp, docs_path)
+
+    stats["deleted"] = store.delete([id_ for id_ in store.keys() if id_ not in seen])
+    if store.count and (store.count - len(store)) / store.count > COMPACT_RATIO:
+        store.compact()
+    if store.centroids is None and len(store) >= IVF_MIN_ROWS:
+        store.build_ivf()
+    store.save()
+    stats["seconds"] = round(time.perf_counter() - t0, 1)
+    stats["padding_overhead"] = round(stats["padded_chars"] / stats["chars"] - 1, 3) if stats["chars"] else 0.0
+    print(f"✅ {len(store):,} vectors in {store_path}: {stats['embedded']:,} embedded in {stats['batches']} batches, "
+          f"{stats['cached']:,} cached, {stats['deleted']:,} stale deleted ({stats['seconds']}s)")
+    return stats
+
+
+if __name__ == "__main__":
+    inputs = [Path(p) for p in sys.argv[1:]] or INPUT_PATHS
+    print(json.dumps(run(inputs), indent=1))
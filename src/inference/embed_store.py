@@ -1,19 +1,389 @@
-"""FAISS / vector store creation and simple search placeholder.
+"""Vector store for retrieval: a contiguous embedding matrix on disk, exact or IVF search.
+
+A store is a directory (VECTOR_STORE_PATH):
+  vectors.bin   float16/float32 [capacity, dim]  row-major, memory-mapped, so startup
+                                                 doesn't read it; rows past `count` are spare
+  alive.npy     bool [count]                     False = deleted (tombstone)
+  ids.json      row → external id
+  ivf.npz       k-means centroids + list of every row (only once build_ivf() ran)
+  meta.json     dim, dtype, count, normalize, generation; written last, so a crash
+                mid-save leaves the previous consistent state
+
+The row-numbered files belong to a generation (vectors.<gen>.bin, ...; generation
+0 has no suffix). compact() and clear() renumber rows, so they write a new
+generation next to the old one. Files of other generations are only removed
+once meta.json points at the new one.
+
+Search
+  exact   Q @ X.T over row chunks (one matmul per chunk for the whole query batch),
+          argpartition for each chunk's top-k, merged across chunks
+  ivf     each query scans only the rows of its `nprobe` nearest k-means lists.
+          Rows added after training join their nearest list, so adds never need
+          a rebuild; re-run build_ivf() once the data has drifted a lot
+
+Vectors are L2-normalized on the way in (normalize=True), so scores are cosine
+similarities. add() appends in place (the file grows by doubling), delete() only
+marks tombstones; compact() rewrites the matrix without them.
 """
 
-from typing import List
+import json
+import math
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+STORE_PATH = Path(os.getenv("VECTOR_STORE_PATH", REPO_ROOT / "data" / "embeddings" / "store"))
+DTYPE = "float32"            # float16 halves disk and RAM, but NumPy converts it back at every scan (several x slower)
+CHUNK_ROWS = 1 << 15         # rows per matmul block in exact search (~50 MB of float32 at dim 384)
+IVF_MIN_ROWS = 100_000       # build() trains an IVF index from this size on; below it exact search is fast enough
+NPROBE = 16
+KMEANS_ITERS = 10
+KMEANS_SAMPLE_PER_LIST = 64  # training sample = n_lists × this (capped at the store size)
+
+
+def _topk(scores: np.ndarray, k: int):
+    """Row-wise top-k of a [m, n] score matrix → (column indices, scores), best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((scores.shape[0], 0), np.int64), np.zeros((scores.shape[0], 0), scores.dtype)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-vals, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(vals, order, axis=1)
 
 
 class EmbedStore:
-    def __init__(self, path: str = None):
-        self.path = path
+    def __init__(self, path: Optional[str] = None, dim: Optional[int] = None, dtype: str = DTYPE,
+                 normalize: bool = True):
+        self.path = Path(path) if path else None
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.normalize = normalize
+        self.info: dict = {}            # free-form, saved in meta.json (e.g. which encoder made the vectors)
+        self.count = 0                  # rows in use, including deleted ones
+        self.generation = 0             # which set of row-numbered files meta.json points at
+        self.ids: List[str] = []
+        self.centroids: Optional[np.ndarray] = None
+        self._vectors = None            # [capacity, dim] ndarray or memmap
+        self._alive = np.zeros(0, bool)
+        self._assign = np.zeros(0, np.int32)
+        self._row_of: Dict[str, int] = {}
+        self._lists = None              # (rows ordered by IVF list, list offsets), rebuilt lazily
+        self._lock = threading.RLock()
+        if self.path and (self.path / "meta.json").exists():
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+    def __contains__(self, id_) -> bool:
+        return str(id_) in self._row_of
+
+    def keys(self) -> List[str]:
+        """Ids of the live (not deleted) vectors."""
+        with self._lock:
+            return list(self._row_of)
+
+    # -- storage --------------------------------------------------------------------
+
+    def _file(self, name: str, generation: Optional[int] = None) -> Path:
+        generation = self.generation if generation is None else generation
+        stem, ext = name.split(".")
+        return self.path / (f"{stem}.{generation}.{ext}" if generation else name)
+
+    def _open_vectors(self, capacity: int):
+        return np.memmap(self._file("vectors.bin"), dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+
+    def _reserve(self, n: int):
+        """Make room for n more rows (capacity doubles, so appends are amortized O(1))."""
+        cap = 0 if self._vectors is None else self._vectors.shape[0]
+        need = self.count + n
+        if need <= cap:
+            return
+        new_cap = max(need, 2 * cap, 1024)
+        if self.path is None:
+            grown = np.empty((new_cap, self.dim), self.dtype)
+            grown[:self.count] = self._vectors[:self.count] if cap else 0
+            self._vectors = grown
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._vectors = None
+            # Extending the file leaves a sparse zero tail; existing rows are untouched
+            with open(self._file("vectors.bin"), "ab") as f:
+                f.truncate(new_cap * self.dim * self.dtype.itemsize)
+            self._vectors = self._open_vectors(new_cap)
+        self._alive = np.concatenate([self._alive, np.zeros(new_cap - len(self._alive), bool)])
+        self._assign = np.concatenate([self._assign, np.zeros(new_cap - len(self._assign), np.int32)])
+
+    def _prepare(self, embeddings) -> np.ndarray:
+        vecs = np.asarray(embeddings, dtype=np.float32)
+        if vecs.ndim == 1:
+            vecs = vecs[None, :]
+        if self.dim is None:
+            self.dim = vecs.shape[1]
+        if vecs.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dim embeddings, got {vecs.shape[1]}")
+        if self.normalize:
+            norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+            vecs = vecs / np.maximum(norms, 1e-12)
+        return vecs
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            if self._vectors is not None:
+                self._vectors.flush()
+
+            def replace(path, write):
+                tmp = path.with_name(path.name + ".tmp")
+                with open(tmp, "wb") as f:
+                    write(f)
+                os.replace(tmp, path)
+
+            replace(self._file("alive.npy"), lambda f: np.save(f, self._alive[:self.count]))
+            replace(self._file("ids.json"), lambda f: f.write(json.dumps(self.ids, ensure_ascii=False).encode("utf-8")))
+            ivf = self._file("ivf.npz")
+            if self.centroids is not None:
+                replace(ivf, lambda f: np.savez(f, centroids=self.centroids, assign=self._assign[:self.count]))
+            elif ivf.exists():
+                ivf.unlink()
+            meta = {"dim": self.dim, "dtype": self.dtype.name, "count": self.count, "normalize": self.normalize,
+                    "capacity": 0 if self._vectors is None else self._vectors.shape[0], "info": self.info,
+                    "generation": self.generation}
+            replace(self.path / "meta.json", lambda f: f.write(json.dumps(meta).encode("utf-8")))
+            # Only now is no earlier generation referenced
+            current = {self._file(name).name for name in ("vectors.bin", "alive.npy", "ids.json", "ivf.npz")}
+            for name in ("vectors.bin", "alive.npy", "ids.json", "ivf.npz"):
+                stem, ext = name.split(".")
+                for old in [self.path / name, *self.path.glob(f"{stem}.*.{ext}")]:
+                    if old.name not in current and old.exists():
+                        old.unlink()
+
+    def _load(self):
+        meta = json.loads((self.path / "meta.json").read_text())
+        self.dim, self.dtype, self.normalize = meta["dim"], np.dtype(meta["dtype"]), meta["normalize"]
+        self.count = meta["count"]
+        self.info = meta.get("info", {})
+        self.generation = meta.get("generation", 0)
+        if meta["capacity"]:
+            self._vectors = self._open_vectors(meta["capacity"])
+        # Files written after meta.json by an interrupted save may be longer: cut them to `count`
+        self.ids = json.loads(self._file("ids.json").read_text(encoding="utf-8"))[:self.count]
+        cap = meta["capacity"]
+        self._alive = np.zeros(cap, bool)
+        self._alive[:self.count] = np.load(self._file("alive.npy"))[:self.count]
+        self._assign = np.zeros(cap, np.int32)
+        ivf = self._file("ivf.npz")
+        if ivf.exists():
+            with np.load(ivf) as z:
+                self.centroids = z["centroids"]
+                self._assign[:self.count] = z["assign"][:self.count]
+        self._row_of = {self.ids[r]: int(r) for r in np.flatnonzero(self._alive[:self.count])}
+
+    # -- updates --------------------------------------------------------------------
+
+    def build(self, embeddings, ids: Sequence[str]):
+        """Replace the whole store with these vectors (and train IVF if it's large enough)."""
+        with self._lock:
+            self.clear()
+            self.add(embeddings, ids)
+            if self.count >= IVF_MIN_ROWS:
+                self.build_ivf()
+            self.save()
+        print(f"✅ Vector store: {len(self)} vectors × {self.dim} ({self.dtype.name})"
+              f"{f', IVF {len(self.centroids)} lists' if self.centroids is not None else ''}")
+
+    def clear(self):
+        """Drop every vector and the IVF index; the next add() may use a different dim."""
+        with self._lock:
+            self.count, self.dim = 0, None
+            self.ids, self._row_of = [], {}
+            self.centroids, self._lists = None, None
+            self._vectors = None
+            self._alive = np.zeros(0, bool)
+            self._assign = np.zeros(0, np.int32)
+            # The rows are gone: refill a fresh generation, not the file meta.json still points at
+            self.generation += 1
+            if self.path is not None and self._file("vectors.bin").exists():
+                self._file("vectors.bin").unlink()
+
+    def add(self, embeddings, ids: Sequence[str]):
+        """Append vectors; an id that is already stored is replaced. Call save() to persist."""
+        vecs = self._prepare(embeddings)
+        ids = [str(i) for i in ids]
+        if len(ids) != len(vecs):
+            raise ValueError(f"{len(vecs)} embeddings but {len(ids)} ids")
+        if len(set(ids)) != len(ids):
+            raise ValueError("Duplicate ids in one add() call")
+        with self._lock:
+            self.delete([i for i in ids if i in self._row_of])
+            self._reserve(len(vecs))
+            start, end = self.count, self.count + len(vecs)
+            self._vectors[start:end] = vecs
+            self._alive[start:end] = True
+            if self.centroids is not None:
+                self._assign[start:end] = self._nearest_lists(vecs)
+                self._lists = None
+            self.ids.extend(ids)
+            self._row_of.update(zip(ids, range(start, end)))
+            self.count = end
+
+    def delete(self, ids: Sequence[str]) -> int:
+        """Tombstone these ids (unknown ones are ignored); returns how many were deleted."""
+        with self._lock:
+            rows = [self._row_of.pop(str(i)) for i in ids if str(i) in self._row_of]
+            self._alive[rows] = False
+            return len(rows)
+
+    def compact(self):
+        """Rewrite the matrix without deleted rows (IVF assignments are kept)."""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self.count])
+            n = len(rows)
+            if self.path is None:
+                vectors = self._vectors[rows] if self._vectors is not None else None
+            else:
+                # The renumbered matrix is a new generation; the old files stay valid until save() writes meta.json
+                new = self._file("vectors.bin", self.generation + 1)
+                with open(new, "wb") as f:
+                    f.truncate(max(n, 1) * self.dim * self.dtype.itemsize)
+                vectors = np.memmap(new, dtype=self.dtype, mode="r+", shape=(max(n, 1), self.dim))
+                for s in range(0, n, CHUNK_ROWS):
+                    vectors[s:s + CHUNK_ROWS] = self._vectors[rows[s:s + CHUNK_ROWS]]
+                vectors.flush()
+                self.generation += 1
+            self._vectors = vectors
+            self._assign = self._assign[rows]
+            self._alive = np.ones(len(rows), bool)
+            self.ids = [self.ids[r] for r in rows]
+            self._row_of = {i: r for r, i in enumerate(self.ids)}
+            self.count = n
+            self._lists = None
+            self.save()
+
+    # -- IVF ------------------------------------------------------------------------
+
+    def _nearest_lists(self, vecs: np.ndarray) -> np.ndarray:
+        # argmin ||x - c||² = argmax (x·c - ||c||²/2)
+        half_norms = 0.5 * (self.centroids ** 2).sum(1)
+        out = np.empty(len(vecs), np.int32)
+        for s in range(0, len(vecs), CHUNK_ROWS // 8):
+            block = np.asarray(vecs[s:s + CHUNK_ROWS // 8], dtype=np.float32)
+            out[s:s + len(block)] = (block @ self.centroids.T - half_norms).argmax(1)
+        return out
+
+    def build_ivf(self, n_lists: Optional[int] = None, iters: int = KMEANS_ITERS, seed: int = 0):
+        """Train k-means centroids on a sample of the live rows and assign every row to its nearest list."""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self.count])
+            if len(rows) == 0:
+                return
+            n_lists = min(n_lists or max(1, int(math.sqrt(len(rows)))), len(rows))
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(rows, min(len(rows), n_lists * KMEANS_SAMPLE_PER_LIST), replace=False))
+            x = np.asarray(self._vectors[sample], dtype=np.float32)
+            self.centroids = x[rng.choice(len(x), n_lists, replace=False)].copy()
+            for _ in range(iters):
+                assign = self._nearest_lists(x)
+                counts = np.bincount(assign, minlength=n_lists)
+                order = np.argsort(assign, kind="stable")
+                starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+                filled = counts > 0
+                sums = np.add.reduceat(x[order], starts[filled], axis=0)
+                self.centroids[filled] = sums / counts[filled, None]
+                # Empty lists restart from random sample points
+                self.centroids[~filled] = x[rng.choice(len(x), int((~filled).sum()))]
+                if self.normalize:
+                    self.centroids /= np.maximum(np.linalg.norm(self.centroids, axis=1, keepdims=True), 1e-12)
+            self._assign[:self.count] = self._nearest_lists(self._vectors[:self.count])
+            self._lists = None
+
+    def _inverted(self):
+        if self._lists is None:
+            order = np.argsort(self._assign[:self.count], kind="stable")
+            offsets = np.searchsorted(self._assign[:self.count][order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, offsets)
+        return self._lists
+
+    # -- search ---------------------------------------------------------------------
+
+    def _search_exact(self, q: np.ndarray, k: int):
+        best_rows = np.full((len(q), 0), -1, np.int64)
+        best = np.full((len(q), 0), -np.inf, np.float32)
+        for start in range(0, self.count, CHUNK_ROWS):
+            end = min(start + CHUNK_ROWS, self.count)
+            scores = q @ np.asarray(self._vectors[start:end], dtype=np.float32).T
+            scores[:, ~self._alive[start:end]] = -np.inf
+            idx, vals = _topk(scores, k)
+            cand_rows = np.concatenate([best_rows, idx + start], axis=1)
+            cand = np.concatenate([best, vals], axis=1)
+            idx, best = _topk(cand, k)
+            best_rows = np.take_along_axis(cand_rows, idx, axis=1)
+        return best_rows, best
+
+    def _search_ivf(self, q: np.ndarray, k: int, nprobe: int):
+        order, offsets = self._inverted()
+        probes, _ = _topk(q @ self.centroids.T - 0.5 * (self.centroids ** 2).sum(1), nprobe)
+        m = len(q)
+        cand_rows = np.full((m, nprobe, k), -1, np.int64)
+        cand = np.full((m, nprobe, k), -np.inf, np.float32)
+        # Visit each probed list once and score every query that probes it in one matmul
+        flat = probes.ravel()
+        by_list = np.argsort(flat, kind="stable")
+        for group in np.split(by_list, np.flatnonzero(np.diff(flat[by_list])) + 1):
+            lst = flat[group[0]]
+            rows = order[offsets[lst]:offsets[lst + 1]]
+            rows = rows[self._alive[rows]]
+            if len(rows) == 0:
+                continue
+            qi, slot = np.divmod(group, nprobe)
+            idx, vals = _topk(q[qi] @ np.asarray(self._vectors[rows], dtype=np.float32).T, k)
+            cand_rows[qi, slot, :idx.shape[1]] = rows[idx]
+            cand[qi, slot, :idx.shape[1]] = vals
+        idx, best = _topk(cand.reshape(m, -1), k)
+        return np.take_along_axis(cand_rows.reshape(m, -1), idx, axis=1), best
 
-    def build(self, embeddings: List[List[float]], ids: List[str]):
-        print("Building vector index (placeholder)")
+    def search(self, query_emb, k: int = 5, nprobe: Optional[int] = NPROBE, exact: bool = False):
+        """Top-k (id, score) pairs, best first. A single query gives one list; a [m, dim]
+        batch gives m lists. Uses IVF when it has been built, unless `exact`."""
+        q = np.asarray(query_emb, dtype=np.float32)
+        single = q.ndim == 1
+        with self._lock:
+            if self.count == 0 or self.dim is None:
+                return [] if single else [[] for _ in range(len(q))]
+            q = self._prepare(q)
+            if self.centroids is not None and not exact:
+                rows, scores = self._search_ivf(q, k, min(nprobe or NPROBE, len(self.centroids)))
+            else:
+                rows, scores = self._search_exact(q, k)
+            results = [[(self.ids[r], float(s)) for r, s in zip(rr, ss) if r >= 0 and np.isfinite(s)]
+                       for rr, ss in zip(rows, scores)]
+        return results[0] if single else results
 
-    def search(self, query_emb, k: int = 5):
-        return []
+    def stats(self) -> dict:
+        return {
+            "vectors": len(self),
+            "deleted": self.count - len(self),
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "ivf_lists": 0 if self.centroids is None else len(self.centroids),
+            "mb": round(self.count * (self.dim or 0) * self.dtype.itemsize / (1 << 20), 1),
+        }
 
 
 if __name__ == "__main__":
-    print("EmbedStore placeholder")
+    path = sys.argv[1] if len(sys.argv) > 1 else STORE_PATH
+    if not (Path(path) / "meta.json").exists():
+        print(f"⚠️ No vector store at {path}")
+        sys.exit(1)
+    print(EmbedStore(path).stats())
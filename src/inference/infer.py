@@ -1,46 +1,300 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
-import torch
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional
 
-base_model = "mistralai/Mistral-7B-v0.1"
-lora_path = "/home/a/anselm/almost-anselm/models/base"  # your checkpoint folder
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
 
-# Using mistral tokenizer
-tokenizer = AutoTokenizer.from_pretrained(base_model, trust_remote_code=True)
+from src.inference.model_loader import BACKEND, BASE_MODEL, LORA_PATH, get_model
+from src.inference.prefix_cache import get_prefix_cache
+from src.inference.response_cache import ResponseCache
+from src.inference.speculative import DRAFT_TOKENS, SpecStats, load_draft, speculative_generate
 
-model = AutoModelForCausalLM.from_pretrained(
-    base_model,
-    torch_dtype=torch.float16,
-    device_map="auto",
-    trust_remote_code=True
+base_model = BASE_MODEL
+lora_path = LORA_PATH  # your checkpoint folder
+backend = BACKEND      # "auto", "gpu", "cpu" or "cpu-int8" (see model_loader.py)
+
+# Every SFT sample starts with this system message, so inference does too
+SYSTEM_PROMPT = "You are Anselm. Reply with your real tone and typical phrasing, based on past messages."
+USE_PREFIX_CACHE = os.getenv("PREFIX_CACHE", "1") != "0"
+# Draft for speculative decoding of single prompts: a small model path, or "layers:N" for the
+# target truncated to N layers (see speculative.py). Unset = plain generate
+draft_model = os.getenv("SPECULATIVE_DRAFT") or None
+draft_tokens = int(os.getenv("SPECULATIVE_K", str(DRAFT_TOKENS)))
+spec_stats = SpecStats()
+# Set to a ResponseCache to answer repeated trivial prompts from earlier samples in chat()
+response_cache: Optional[ResponseCache] = None
+
+# Same format the SFT data is converted to (convert_template.py)
+CHATML_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
 )
 
-# 🚀 Load your LoRA adapter
-model = PeftModel.from_pretrained(model, lora_path)
 
-# (Optional) Merge lora weights for faster inference
-# model = model.merge_and_unload()
-model.eval()
+def _messages(prompt):
+    msgs = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else list(prompt)
+    if SYSTEM_PROMPT and (not msgs or msgs[0].get("role") != "system"):
+        msgs.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
+    return msgs
+
+
+def render_prompt(tokenizer, prompt) -> str:
+    """Chat messages (or a plain user string) → prompt text ending with the assistant header."""
+    template = None if tokenizer.chat_template else CHATML_TEMPLATE
+    return tokenizer.apply_chat_template(_messages(prompt), chat_template=template, add_generation_prompt=True,
+                                         tokenize=False)
+
+
+def encode_prompts(tokenizer, prompts):
+    # Left padding (set by model_loader) keeps every prompt's last token at the end of the row
+    texts = [render_prompt(tokenizer, p) for p in prompts]
+    return tokenizer(texts, padding=True, add_special_tokens=False, return_tensors="pt")
+
+
+@dataclass
+class StreamMetrics:
+    """Latency as the reader sees it: call mark() whenever a text increment arrives."""
+    start: float = field(default_factory=time.perf_counter)
+    arrivals: List[float] = field(default_factory=list)
+
+    def mark(self):
+        self.arrivals.append(time.perf_counter())
+
+    @property
+    def ttft_ms(self) -> Optional[float]:
+        return 1000 * (self.arrivals[0] - self.start) if self.arrivals else None
+
+    @property
+    def itl_ms(self) -> List[float]:
+        return [1000 * (b - a) for a, b in zip(self.arrivals, self.arrivals[1:])]
+
+    def as_dict(self) -> dict:
+        itl = self.itl_ms
+        return {
+            "ttft_ms": round(self.ttft_ms, 1) if self.ttft_ms is not None else None,
+            "itl_ms_mean": round(statistics.fmean(itl), 1) if itl else None,
+            "itl_ms_p50": round(statistics.median(itl), 1) if itl else None,
+            "increments": len(self.arrivals),
+            "total_ms": round(1000 * ((self.arrivals[-1] if self.arrivals else time.perf_counter()) - self.start), 1),
+        }
+
+
+class _BatchStreamer:
+    """transformers streamer for a whole batch: decodes each row incrementally and hands
+    new text to that row's callback. Rows stop at EOS or their own max_new_tokens."""
+
+    def __init__(self, tokenizer, callbacks: List[Optional[Callable[[str], None]]], limits: List[int], eos_ids):
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.limits = limits
+        self.eos_ids = set(eos_ids)
+        self.tokens: List[List[int]] = [[] for _ in callbacks]
+        self.sent = [0] * len(callbacks)       # chars already handed out
+        self.finished = [cb is None for cb in callbacks]
+        self._prompt = True
+
+    def _emit(self, i: int, final: bool = False):
+        text = self.tokenizer.decode(self.tokens[i], skip_special_tokens=True)
+        # A trailing U+FFFD is usually half a multi-byte character; wait for the next token
+        if not final and text.endswith("\ufffd"):
+            return
+        if len(text) > self.sent[i]:
+            self.callbacks[i](text[self.sent[i]:])
+            self.sent[i] = len(text)
+
+    def put(self, value):
+        if self._prompt:
+            # generate() first passes the prompt ids
+            self._prompt = False
+            return
+        for i, tok in enumerate(value.reshape(len(self.callbacks), -1)[:, -1].tolist()):
+            if self.finished[i]:
+                continue
+            if tok in self.eos_ids:
+                self.finished[i] = True
+                self._emit(i, final=True)
+                continue
+            self.tokens[i].append(tok)
+            self._emit(i)
+            if len(self.tokens[i]) >= self.limits[i]:
+                self.finished[i] = True
+                self._emit(i, final=True)
+
+    def end(self):
+        for i, done in enumerate(self.finished):
+            if not done:
+                self.finished[i] = True
+                self._emit(i, final=True)
+
+
+def _eos_ids(model, tokenizer):
+    eos = model.generation_config.eos_token_id
+    ids = set(eos if isinstance(eos, (list, tuple)) else [eos]) | {tokenizer.eos_token_id}
+    return {i for i in ids if i is not None}
+
+
+_warmed = set()
+
 
+def _prefix_cache_for(loaded):
+    cache = get_prefix_cache(loaded.key)
+    if loaded.key not in _warmed and SYSTEM_PROMPT:
+        _warmed.add(loaded.key)
+        tokenizer = loaded.tokenizer
+        template = None if tokenizer.chat_template else CHATML_TEMPLATE
+        text = tokenizer.apply_chat_template([{"role": "system", "content": SYSTEM_PROMPT}], chat_template=template,
+                                             tokenize=False)
+        cache.warm(loaded.model, tokenizer(text, add_special_tokens=False)["input_ids"])
+    return cache
 
-def chat(prompt: str):
-    formatted_string = tokenizer.apply_chat_template(prompt, tokenize=False)
-    token_ids = tokenizer.apply_chat_template(formatted_string, tokenize=True, add_generation_prompt=True, return_tensors="pt")
-    with torch.no_grad():
+
+_drafts = {}
+
+
+def _draft_for(loaded):
+    key = (loaded.key, draft_model)
+    if key not in _drafts:
+        _drafts[key] = load_draft(draft_model, loaded, backend=backend)
+    return _drafts[key]
+
+
+def chat_batch(prompts, max_new_tokens=100, temperature: float = 0.7, top_p: float = 0.9, on_text=None):
+    """Generate replies for several prompts in one padded generate call.
+
+    `max_new_tokens` may be one int or one per prompt; the batch runs to the largest
+    and each reply is cut to its own limit. `on_text`, if given, is a list with one
+    callback (or None) per prompt, called with each new piece of decoded text as it
+    is generated.
+
+    A single prompt reuses cached past-key-values for its longest already-seen
+    prefix (system prompt, earlier turns of the conversation), see prefix_cache.py,
+    and is decoded speculatively when `draft_model` is set.
+    """
+    import torch
+    from transformers import DynamicCache
+
+    # 🚀 Base model + LoRA, merged once and loaded on first use
+    loaded = get_model(base_model, lora_path, backend=backend)
+    model, tokenizer = loaded.model, loaded.tokenizer
+    limits = [max_new_tokens] * len(prompts) if isinstance(max_new_tokens, int) else list(max_new_tokens)
+    inputs = encode_prompts(tokenizer, prompts).to(model.device)
+    streamer = None
+    if on_text and any(cb is not None for cb in on_text):
+        streamer = _BatchStreamer(tokenizer, list(on_text), limits, _eos_ids(model, tokenizer))
+    cache = kv = None
+    if USE_PREFIX_CACHE and len(prompts) == 1:
+        cache = _prefix_cache_for(loaded)
+        _, kv = cache.lookup(inputs["input_ids"][0].tolist())
+        kv = kv if kv is not None else DynamicCache()
+    if draft_model and len(prompts) == 1:
+        return [_speculative_reply(loaded, inputs["input_ids"], limits[0], temperature, top_p, streamer, cache, kv)]
+    with torch.inference_mode():
         outputs = model.generate(
-            **token_ids,
+            **inputs,
+            past_key_values=kv,
             do_sample=True,
-            pad_token_id = tokenizer.eos_token_id,
-            max_new_tokens=100,
-            temperature=0.7,
-            top_p=0.9
+            pad_token_id=tokenizer.pad_token_id,
+            max_new_tokens=max(limits),
+            temperature=temperature,
+            top_p=top_p,
+            streamer=streamer,
         )
-    return tokenizer.decode(outputs[0], skip_special_tokens=True)
+    if cache is not None:
+        # The KV now covers prompt + reply (minus the last sampled token): the next turn's prefix
+        cache.store(outputs[0, :kv.get_seq_length()].tolist(), kv, prompt_len=inputs["input_ids"].shape[1])
+    # Only the replies, not the echoed prompts
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+    return [tokenizer.decode(row[:n], skip_special_tokens=True) for row, n in zip(new_tokens, limits)]
+
+
+def _speculative_reply(loaded, input_ids, max_new_tokens, temperature, top_p, streamer, cache, kv) -> str:
+    import torch
+
+    model, tokenizer = loaded.model, loaded.tokenizer
+    on_token = None
+    if streamer is not None:
+        streamer.put(input_ids)  # the streamer skips the prompt, as with generate()
+        on_token = lambda tok: streamer.put(torch.tensor([tok]))
+    out, kv = speculative_generate(model, _draft_for(loaded), input_ids, max_new_tokens, temperature, top_p,
+                                   k=draft_tokens, eos_ids=_eos_ids(model, tokenizer), target_cache=kv,
+                                   on_token=on_token, stats=spec_stats)
+    if streamer is not None:
+        streamer.end()
+    if cache is not None:
+        cache.store(input_ids[0].tolist() + out[:kv.get_seq_length() - input_ids.shape[1]], kv,
+                    prompt_len=input_ids.shape[1])
+    return tokenizer.decode(out, skip_special_tokens=True)
+
+
+def chat(prompt, max_new_tokens: int = 100, temperature: float = 0.7, top_p: float = 0.9) -> str:
+    params = {"max_new_tokens": max_new_tokens, "temperature": temperature, "top_p": top_p}
+    if response_cache is not None:
+        reply = response_cache.get(prompt, params)
+        if reply is not None:
+            return reply
+    t0 = time.perf_counter()
+    reply = chat_batch([prompt], max_new_tokens, temperature, top_p)[0]
+    if response_cache is not None:
+        response_cache.put(prompt, params, reply, time.perf_counter() - t0)
+    return reply
+
+
+class ChatStream:
+    """Iterate over a reply as it is generated; `.metrics` has TTFT / inter-token latency.
+
+        stream = stream_chat("hello")
+        for piece in stream:
+            print(piece, end="", flush=True)
+        print(stream.metrics.as_dict())
+    """
+
+    _DONE = object()
+
+    def __init__(self, prompt, max_new_tokens: int, temperature: float, top_p: float):
+        self.metrics = StreamMetrics()
+        self._q: "queue.Queue" = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, args=(prompt, max_new_tokens, temperature, top_p),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, prompt, max_new_tokens, temperature, top_p):
+        try:
+            chat_batch([prompt], max_new_tokens, temperature, top_p, on_text=[self._q.put])
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._q.put(self._DONE)
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            piece = self._q.get()
+            if piece is self._DONE:
+                break
+            self.metrics.mark()
+            yield piece
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def stream_chat(prompt, max_new_tokens: int = 100, temperature: float = 0.7, top_p: float = 0.9) -> ChatStream:
+    return ChatStream(prompt, max_new_tokens, temperature, top_p)
 
 if __name__ == "__main__":
     while True:
         user_input = input("\nYou: ")
         if user_input.lower() in ["exit", "quit"]:
             break
-        response = chat(user_input)
-        print("\nModel:", response)
+        print("\nModel: ", end="", flush=True)
+        for piece in stream_chat(user_input):
+            print(piece, end="", flush=True)
+        print()
@@ -0,0 +1,227 @@
+"""Lazy, cached model loading for inference.
+
+Nothing is loaded at import time. The first `get_model()` call for a given
+(base model, adapter, dtype) loads it and keeps it in a process-wide registry,
+so chat(), the server and the bot all share one copy.
+
+When a LoRA adapter is given, it is merged into the base weights once and the
+merged model is saved as safetensors under models/merged/<base>-<hash>/.
+Later starts load that checkpoint directly: the safetensors files are
+memory-mapped, nothing is merged again, and there is no per-token LoRA overhead
+because the adapter matmuls are folded into the base weights. The hash covers
+the base model name, the adapter files and the dtype, so retraining the adapter
+produces a new merged checkpoint instead of reusing a stale one.
+
+BASE_MODEL_NAME and ADAPTER_DIR (.env) choose the base model and the LoRA
+adapter directory (relative paths are relative to the repo root).
+
+INFER_BACKEND picks the runtime: "auto" (GPU if there is one, else plain fp32
+CPU), "gpu", "cpu" (fp32) or "cpu-int8" (dynamic int8 linears, see
+cpu_backend.py). TORCH_COMPILE=1 compiles the CPU forward pass.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+load_dotenv()
+
+BASE_MODEL = os.getenv("BASE_MODEL_NAME") or "mistralai/Mistral-7B-v0.1"
+LORA_PATH = str(REPO_ROOT / (os.getenv("ADAPTER_DIR") or "models/base"))  # your checkpoint folder
+MERGED_DIR = REPO_ROOT / "models" / "merged"
+BACKEND = os.getenv("INFER_BACKEND", "auto")
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+BACKENDS = ("auto", "gpu", "cpu", "cpu-int8")
+
+ADAPTER_FILES = ("adapter_config.json", "adapter_model.safetensors", "adapter_model.bin")
+
+
+@dataclass
+class LoadedModel:
+    model: object
+    tokenizer: object
+    source: str          # directory or hub id the weights were loaded from
+    load_seconds: float
+    variant: str = ""    # backend (+compile) and dtype, e.g. "cpu-int8/float32"
+
+    @property
+    def key(self) -> str:
+        """Identifies these exact weights/numerics, e.g. for per-model caches."""
+        return f"{self.source}|{self.variant}"
+
+
+_registry: Dict[Tuple[str, Optional[str], str], LoadedModel] = {}
+_registry_lock = threading.Lock()
+
+
+def _default_dtype(torch, backend: str = "auto"):
+    # fp16 matmuls are slow (or missing) on CPU
+    return torch.float16 if _resolve_backend(torch, backend) == "gpu" else torch.float32
+
+
+def _resolve_backend(torch, backend: str) -> str:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {BACKENDS}")
+    if backend == "auto":
+        return "gpu" if torch.cuda.is_available() else "cpu"
+    return backend
+
+
+def _dtype_name(dtype) -> str:
+    return str(dtype).replace("torch.", "")
+
+
+def _variant(backend: str, compile: bool, dtype) -> str:
+    return backend + ("+compile" if compile and backend.startswith("cpu") else "") + f"/{_dtype_name(dtype)}"
+
+
+def has_adapter(lora_path) -> bool:
+    return lora_path is not None and (Path(lora_path) / "adapter_config.json").exists()
+
+
+def adapter_base_model(lora_path) -> Optional[str]:
+    """The base model an adapter was trained on, as recorded by PEFT."""
+    config = json.loads((Path(lora_path) / "adapter_config.json").read_text())
+    return config.get("base_model_name_or_path")
+
+
+def adapter_fingerprint(base_model: str, lora_path, dtype_name: str) -> str:
+    h = hashlib.sha256()
+    h.update(base_model.encode())
+    h.update(dtype_name.encode())
+    for name in ADAPTER_FILES:
+        p = Path(lora_path) / name
+        if not p.exists():
+            continue
+        h.update(name.encode())
+        with open(p, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+
+def merged_path(base_model: str, lora_path, dtype_name: str) -> Path:
+    base_name = base_model.rstrip("/").split("/")[-1]
+    return MERGED_DIR / f"{base_name}-{adapter_fingerprint(base_model, lora_path, dtype_name)}"
+
+
+def merge_lora(base_model: str = BASE_MODEL, lora_path=LORA_PATH, dtype=None, out_dir: Optional[Path] = None) -> Path:
+    """Merge a LoRA adapter into its base model and save it as safetensors (skipped if already done)."""
+    import torch
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    dtype = dtype or _default_dtype(torch)
+    out_dir = Path(out_dir or merged_path(base_model, lora_path, _dtype_name(dtype)))
+    if (out_dir / "merge_info.json").exists():
+        return out_dir
+
+    t0 = time.perf_counter()
+    print(f"🔧 Merging {lora_path} into {base_model} (one-off)...")
+    # Merge on CPU: no device_map sharding, and the result is saved, not used
+    model = AutoModelForCausalLM.from_pretrained(base_model, dtype=dtype, trust_remote_code=True,
+                                                 low_cpu_mem_usage=True)
+    model = PeftModel.from_pretrained(model, str(lora_path))
+    model = model.merge_and_unload()
+    tokenizer_src = lora_path if (Path(lora_path) / "tokenizer_config.json").exists() else base_model
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_src, trust_remote_code=True)
+
+    tmp = out_dir.with_name(out_dir.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    model.save_pretrained(tmp, safe_serialization=True)
+    tokenizer.save_pretrained(tmp)
+    (tmp / "merge_info.json").write_text(json.dumps({
+        "base_model": base_model, "lora_path": str(lora_path), "dtype": _dtype_name(dtype),
+        "merge_seconds": round(time.perf_counter() - t0, 2),
+    }, indent=2))
+    shutil.rmtree(out_dir, ignore_errors=True)
+    # Rename last, so an interrupted merge is never picked up
+    tmp.rename(out_dir)
+    print(f"✅ Merged checkpoint → {out_dir}")
+    return out_dir
+
+
+def _load(base_model: str, lora_path, dtype, backend: str, compile: bool) -> LoadedModel:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    t0 = time.perf_counter()
+    source = str(merge_lora(base_model, lora_path, dtype)) if has_adapter(lora_path) else base_model
+    kwargs = {"dtype": dtype, "trust_remote_code": True, "low_cpu_mem_usage": True}
+    if backend == "gpu":
+        kwargs["device_map"] = "auto"
+    model = AutoModelForCausalLM.from_pretrained(source, **kwargs)
+    model.eval()
+    if backend.startswith("cpu"):
+        from src.inference.cpu_backend import prepare_cpu_model
+
+        model = prepare_cpu_model(model, quantize=backend == "cpu-int8", compile=compile)
+    tokenizer = AutoTokenizer.from_pretrained(source, trust_remote_code=True)
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # Decoder-only batches must be left-padded so generation continues from each prompt's end
+    tokenizer.padding_side = "left"
+    return LoadedModel(model, tokenizer, source, time.perf_counter() - t0, _variant(backend, compile, dtype))
+
+
+def get_model(base_model: str = BASE_MODEL, lora_path=LORA_PATH, dtype=None, backend: Optional[str] = None,
+              compile: Optional[bool] = None) -> LoadedModel:
+    """Load (once per process) and return the model + tokenizer. Pass lora_path=None for the plain base model."""
+    import torch
+
+    backend = _resolve_backend(torch, backend or BACKEND)
+    compile = TORCH_COMPILE if compile is None else compile
+    dtype = dtype or _default_dtype(torch, backend)
+    missing_adapter = lora_path is not None and not has_adapter(lora_path)
+    if missing_adapter:
+        missing_adapter, lora_path = lora_path, None
+    key = (base_model, str(lora_path) if lora_path else None, _variant(backend, compile, dtype))
+    loaded = _registry.get(key)
+    if loaded is not None:
+        return loaded
+    # One lock for all loads: two 7B models loading at once would just thrash memory
+    with _registry_lock:
+        loaded = _registry.get(key)
+        if loaded is None:
+            if missing_adapter:
+                print(f"⚠️ No LoRA adapter in {missing_adapter} (adapter_config.json); loading the plain base model")
+            loaded = _load(base_model, lora_path, dtype, backend, compile)
+            _registry[key] = loaded
+            print(f"✅ Loaded {loaded.source} ({loaded.variant}) in {loaded.load_seconds:.1f}s")
+    return loaded
+
+
+def loaded_models() -> Dict[Tuple[str, Optional[str], str], LoadedModel]:
+    return dict(_registry)
+
+
+def unload(base_model: Optional[str] = None):
+    """Drop models from the registry (all of them, or those built on `base_model`)."""
+    with _registry_lock:
+        for key in [k for k in _registry if base_model is None or k[0] == base_model]:
+            del _registry[key]
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+if __name__ == "__main__":
+    # Pre-build the merged checkpoint, e.g. right after training
+    args = sys.argv[1:]
+    merge_lora(args[0] if len(args) > 0 else BASE_MODEL, args[1] if len(args) > 1 else LORA_PATH)
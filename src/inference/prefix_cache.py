@@ -0,0 +1,165 @@
+"""Prefix KV-cache: reuse past-key-values for prompt prefixes we have already prefilled.
+
+Every prompt starts with the same persona system prompt, and each turn of a live
+chat repeats the whole earlier conversation. This cache keeps the
+past-key-values of
+  - the system prompt (pinned, computed once by warm()), and
+  - every conversation's last state: prompt + generated reply, stored after
+    each generation so the next turn only prefills what the user added. It
+    replaces that conversation's previous state: an entry whose whole prompt
+    is a prefix of the new ids. Its reply is not compared, since a reply may
+    re-tokenize differently once it is part of the next prompt. Other
+    conversations only share the system prompt and the first role header, so
+    they stay cached side by side.
+
+Lookups take the entry sharing the longest token prefix with the new prompt and
+crop its KV to that length. A reply that re-tokenizes slightly differently then
+still reuses everything up to the first differing token. Entries are evicted
+least-recently-used once their tensors exceed MAX_BYTES.
+
+Only single-prompt generation uses it: batched prompts are left-padded to a
+common length, which shifts every prefix.
+"""
+
+import copy
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+MAX_BYTES = int(os.getenv("PREFIX_CACHE_MB", "512")) << 20
+MIN_PREFIX = 8  # shorter shared prefixes aren't worth a cache copy
+
+
+def kv_nbytes(kv) -> int:
+    layers = getattr(kv, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        # transformers 4.x DynamicCache
+        tensors = list(getattr(kv, "key_cache", [])) + list(getattr(kv, "value_cache", []))
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None and hasattr(t, "numel"))
+
+
+def _common_prefix(a: np.ndarray, b: np.ndarray) -> int:
+    m = min(len(a), len(b))
+    diff = np.flatnonzero(a[:m] != b[:m])
+    return int(diff[0]) if len(diff) else m
+
+
+@dataclass
+class _Entry:
+    ids: np.ndarray
+    kv: object
+    nbytes: int
+    pinned: bool = False
+    prompt_len: int = 0   # ids[:prompt_len] was the prompt, the rest generated
+
+
+class PrefixCache:
+    def __init__(self, max_bytes: int = MAX_BYTES, min_prefix: int = MIN_PREFIX):
+        self.max_bytes = max_bytes
+        self.min_prefix = min_prefix
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def lookup(self, ids: List[int]) -> Tuple[int, Optional[object]]:
+        """→ (number of cached tokens, a private copy of their KV) for the longest cached prefix of `ids`.
+
+        At least one token is always left to prefill, since generate needs logits for it.
+        """
+        arr = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            best_key, best_len = None, 0
+            for key, e in self._entries.items():
+                n = _common_prefix(arr, e.ids)
+                if n > best_len:
+                    best_key, best_len = key, n
+            best_len = min(best_len, len(ids) - 1)
+            if best_key is None or best_len < self.min_prefix:
+                self.misses += 1
+                self.prefilled_tokens += len(ids)
+                return 0, None
+            entry = self._entries[best_key]
+            self._entries.move_to_end(best_key)
+            # generate() appends to the cache in place, so hand out a copy
+            kv = copy.deepcopy(entry.kv)
+            self.hits += 1
+            self.reused_tokens += best_len
+            self.prefilled_tokens += len(ids) - best_len
+        if kv.get_seq_length() > best_len:
+            # Negative = drop that many trailing tokens (positive lengths are deprecated)
+            kv.crop(best_len - kv.get_seq_length())
+        return best_len, kv
+
+    def store(self, ids: List[int], kv, pinned: bool = False, prompt_len: Optional[int] = None):
+        """Keep `kv` (covering exactly `ids`, of which the first `prompt_len` were the prompt);
+        the caller must not modify it afterwards."""
+        if len(ids) < self.min_prefix:
+            return
+        arr = np.asarray(ids, dtype=np.int64)
+        size = kv_nbytes(kv)
+        if size > self.max_bytes and not pinned:
+            return
+        with self._lock:
+            # An entry whose whole prompt starts the new ids is an older state of the same conversation
+            for key, e in list(self._entries.items()):
+                if not e.pinned and _common_prefix(arr, e.ids) >= e.prompt_len:
+                    self._drop(key)
+            prompt_len = len(ids) if prompt_len is None else min(prompt_len, len(ids))
+            self._entries[self._next_key] = _Entry(arr, kv, size, pinned, prompt_len)
+            self._next_key += 1
+            self.nbytes += size
+            for key in [k for k, e in self._entries.items() if not e.pinned]:
+                if self.nbytes <= self.max_bytes:
+                    break
+                self._drop(key)
+
+    def _drop(self, key: int):
+        self.nbytes -= self._entries.pop(key).nbytes
+
+    def warm(self, model, ids: List[int]):
+        """Prefill `ids` once (e.g. the system prompt) and pin the result."""
+        import torch
+        from transformers import DynamicCache
+
+        kv = DynamicCache()
+        with torch.inference_mode():
+            model(input_ids=torch.tensor([ids], device=model.device), past_key_values=kv, use_cache=True)
+        self.store(ids, kv, pinned=True)
+
+    def clear(self, keep_pinned: bool = True):
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if not (keep_pinned and e.pinned)]:
+                self._drop(key)
+
+    def stats(self) -> dict:
+        total = self.reused_tokens + self.prefilled_tokens
+        return {
+            "entries": len(self._entries),
+            "mb": round(self.nbytes / (1 << 20), 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_token_share": round(self.reused_tokens / total, 3) if total else 0.0,
+        }
+
+
+_caches: Dict[str, PrefixCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_prefix_cache(model_key: str) -> PrefixCache:
+    """One cache per loaded model (keyed by model_loader's LoadedModel.key)."""
+    with _caches_lock:
+        if model_key not in _caches:
+            _caches[model_key] = PrefixCache()
+        return _caches[model_key]
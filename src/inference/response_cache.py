@@ -0,0 +1,178 @@
+"""Response cache for repeated and near-identical prompts.
+
+Most incoming messages are trivial ("ok", "lol", "haha", stickers), yet every one
+costs a full sampled generation. This cache sits in front of generation:
+
+  scope    only prompts whose last message is at most MAX_TRIVIAL_CHARS once
+           normalized; anything longer always goes to the model
+  key      sha1 of the last WINDOW non-system messages, normalized (lowercase,
+           punctuation dropped, whitespace collapsed, letter runs capped so
+           "loooool" == "lool"), plus the generation parameters. The window
+           makes "lol" after a joke a different key from "lol" after bad news
+  value    a pool of up to POOL_SIZE sampled replies. Until the pool is full,
+           every request misses and its reply joins the pool; after that,
+           requests get a random variant, so replies stay varied without the model
+  bounds   each variant expires after TTL_S; keys are evicted least-recently-used
+           beyond MAX_KEYS
+  disk     optional JSON file, loaded on start and saved every SAVE_EVERY new
+           replies (and by save())
+
+stats() reports hit rate and an estimate of model time saved (hits × mean
+generation time of misses).
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+TTL_S = 24 * 3600
+MAX_KEYS = 10_000
+POOL_SIZE = 4
+WINDOW = 4           # trailing messages in the key: the reply to "lol" depends on what it answers
+MAX_TRIVIAL_CHARS = 24
+SAVE_EVERY = 50
+
+_PUNCT = re.compile(r"[^\w\s\[\]]+")
+_SPACES = re.compile(r"\s+")
+_RUNS = re.compile(r"(\w)\1{2,}")
+
+
+def normalize(text: str) -> str:
+    text = _PUNCT.sub(" ", text.lower())
+    text = _RUNS.sub(r"\1\1", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def cache_key(messages, params: dict, window: int = WINDOW) -> str:
+    if isinstance(messages, str):
+        messages = [{"role": "user", "content": messages}]
+    recent = [m for m in messages if m.get("role") != "system"][-window:]
+    payload = {
+        "messages": [[m.get("role"), normalize(m.get("content", ""))] for m in recent],
+        "params": {k: params[k] for k in sorted(params)},
+    }
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: Optional[Path] = None, ttl_s: float = TTL_S, max_keys: int = MAX_KEYS,
+                 pool_size: int = POOL_SIZE, window: int = WINDOW, max_chars: int = MAX_TRIVIAL_CHARS,
+                 seed: Optional[int] = None):
+        self.path = Path(path) if path else None
+        self.ttl_s = ttl_s
+        self.max_keys = max_keys
+        self.pool_size = pool_size
+        self.window = window
+        self.max_chars = max_chars
+        self._rng = random.Random(seed)
+        self._pools: "OrderedDict[str, list]" = OrderedDict()  # key → [[reply, created_at], ...]
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.generated = 0
+        self.gen_seconds = 0.0
+        self.lookup_seconds = 0.0
+        if self.path and self.path.exists():
+            self._load()
+
+    def _fresh(self, pool: list, now: float) -> list:
+        return [v for v in pool if now - v[1] < self.ttl_s]
+
+    def cacheable(self, messages) -> bool:
+        """Only short, trivial last messages ("ok", "lol", a sticker) are worth a cached reply."""
+        if isinstance(messages, str):
+            last = messages
+        else:
+            turns = [m for m in messages if m.get("role") != "system"]
+            last = turns[-1].get("content", "") if turns else ""
+        return len(normalize(last)) <= self.max_chars
+
+    def get(self, messages, params: dict) -> Optional[str]:
+        """A cached reply once the key's variant pool is full, else None (caller generates and put()s)."""
+        if not self.cacheable(messages):
+            self.skipped += 1
+            return None
+        t0 = time.perf_counter()
+        key = cache_key(messages, params, self.window)
+        now = time.time()
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None:
+                pool[:] = self._fresh(pool, now)
+                self._pools.move_to_end(key)
+            if not pool or len(pool) < self.pool_size:
+                self.misses += 1
+                reply = None
+            else:
+                self.hits += 1
+                reply = self._rng.choice(pool)[0]
+        self.lookup_seconds += time.perf_counter() - t0
+        return reply
+
+    def put(self, messages, params: dict, reply: str, gen_seconds: float = 0.0):
+        if not self.cacheable(messages):
+            return
+        key = cache_key(messages, params, self.window)
+        with self._lock:
+            self.generated += 1
+            self.gen_seconds += gen_seconds
+            pool = self._pools.setdefault(key, [])
+            self._pools.move_to_end(key)
+            if len(pool) >= self.pool_size:
+                pool.pop(0)
+            pool.append([reply, time.time()])
+            while len(self._pools) > self.max_keys:
+                self._pools.popitem(last=False)
+            self._unsaved += 1
+            save = self.path is not None and self._unsaved >= SAVE_EVERY
+        if save:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        now = time.time()
+        with self._lock:
+            data = {k: self._fresh(pool, now) for k, pool in self._pools.items()}
+            self._unsaved = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps({k: v for k, v in data.items() if v}, ensure_ascii=False))
+        os.replace(tmp, self.path)
+
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            print(f"⚠️ Ignoring unreadable response cache {self.path}")
+            return
+        now = time.time()
+        for key, pool in data.items():
+            fresh = self._fresh(pool, now)[-self.pool_size:]
+            if fresh:
+                self._pools[key] = fresh
+        while len(self._pools) > self.max_keys:
+            self._pools.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        mean_gen = self.gen_seconds / self.generated if self.generated else 0.0
+        return {
+            "keys": len(self._pools),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "mean_lookup_ms": round(1000 * self.lookup_seconds / total, 3) if total else 0.0,
+            "mean_generate_ms": round(1000 * mean_gen, 1),
+            "saved_s": round(self.hits * mean_gen, 1),
+        }
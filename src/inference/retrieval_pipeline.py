@@ -1,15 +1,294 @@
-"""Build prompt with memory and examples for retrieval-augmented generation.
+"""Build the chat prompt for retrieval-augmented generation under a hard token budget.
+
+The result is the message list infer.chat() takes:
+  system   persona prompt, then MEMORY (things to remember about the chat) and
+           EXAMPLES (similar past windows with Anselm's reply to them)
+  ...      the live conversation
+
+Packing order:
+  1. persona prompt + newest conversation turn (its head is cut if it alone is over budget)
+  2. older turns, newest first, up to CONTEXT_SHARE of the budget
+  3. memory items and examples ranked together by relevance + a recency bonus
+     (half-life RECENCY_HALF_LIFE_S), taken greedily: whatever fits is in; a
+     fragment that doesn't fit is skipped, and smaller ones further down may still fit
+  4. leftover budget goes to even older turns
+
+Token counts come from the shared cached TokenCounter, one per fragment, and are
+summed rather than counted on the joined text. The separators, section headers
+and ChatML markup of each message (and the trailing assistant header) are
+counted with the same tokenizer. They are whitespace and special tokens, so no
+merges happen across the joins. Fragments are counted in
+rank order, COUNT_CHUNK at a time, and the scan stops once less than
+MIN_FRAGMENT_TOKENS of budget is left. Most of a long candidate list is never
+even counted.
+
+Examples can come from a Retriever: the BM25 index (lexical: names, slang,
+in-jokes), the EmbedStore (paraphrases), or both ("hybrid"). In hybrid mode each
+source returns k × CANDIDATE_FACTOR hits. The scores are min-max normalized per
+source and mixed as HYBRID_ALPHA × dense + (1 - HYBRID_ALPHA) × BM25. A hit
+missing from one source gets 0 from it.
 """
 
-def build_prompt(context: str, examples: list = None, memory: list = None) -> str:
-    parts = []
-    if memory:
-        parts.append("\n".join(memory))
-    if examples:
-        parts.append("\n\nEXAMPLES:\n" + "\n".join(examples))
-    parts.append("\nCONTEXT:\n" + context)
-    return "\n\n".join(parts)
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.bm25_index import BM25Index
+from src.inference.embed_job import DOCS_NAME, load_docs
+from src.inference.embed_store import EmbedStore
+from src.inference.infer import SYSTEM_PROMPT
+from src.utils.token_counter import TokenCounter, get_token_counter
+
+# Training sequence length (1024) minus room for the reply
+PROMPT_BUDGET = int(os.getenv("PROMPT_TOKENS", "768"))
+CONTEXT_SHARE = 0.5
+RECENCY_WEIGHT = 0.2
+RECENCY_HALF_LIFE_S = 7 * 24 * 3600
+MIN_FRAGMENT_TOKENS = 8
+COUNT_CHUNK = 32
+MESSAGE_WRAP = "<|im_start|>{role}\n<|im_end|>\n"   # ChatML around each message (see infer.CHATML_TEMPLATE)
+GENERATION_HEADER = "<|im_start|>assistant\n"
+MEMORY_HEADER = "MEMORY:"
+EXAMPLES_HEADER = "EXAMPLES:"
+MEMORY_SEP = "\n"
+EXAMPLES_SEP = "\n\n"
+HYBRID_ALPHA = 0.5        # dense share of the fused score
+CANDIDATE_FACTOR = 4      # hits fetched per source for every example returned
+MAX_OVERFETCH = 128       # dense hits searched per example wanted, at most
+QUERY_TURNS = 3           # newest turns of the conversation that make up the query
+
+
+@dataclass
+class Fragment:
+    """A retrieved memory item or example. `score` is relevance (e.g. cosine similarity);
+    `timestamp` (unix seconds) adds a recency bonus; examples render as text → reply."""
+    text: str
+    kind: str = "example"
+    score: float = 0.0
+    timestamp: Optional[float] = None
+    reply: str = ""
+
+    def render(self) -> str:
+        return f"{self.text}\n→ {self.reply}" if self.reply else self.text
+
+
+@dataclass
+class AssembledPrompt:
+    messages: List[dict]
+    tokens: int
+    budget: int
+    used: List[Fragment] = field(default_factory=list)
+    dropped_fragments: int = 0
+    dropped_turns: int = 0
+
+
+FragmentLike = Union[str, dict, Fragment]
+
+
+def _fragment(it: FragmentLike, kind: str, i: int, n: int) -> Fragment:
+    if isinstance(it, dict):
+        return Fragment(it.get("text", ""), it.get("kind", kind), float(it.get("score", 0.0)), it.get("timestamp"),
+                        it.get("reply", ""))
+    # Plain strings come pre-ranked: keep their order
+    return Fragment(str(it), kind, 1.0 - i / n)
+
+
+def _fragments(items: Optional[Sequence[FragmentLike]], kind: str) -> List[Fragment]:
+    n = len(items or ())
+    return [it if isinstance(it, Fragment) else _fragment(it, kind, i, n) for i, it in enumerate(items or ())]
+
+
+def rank(fragments: List[Fragment], now: Optional[float] = None) -> List[Fragment]:
+    """Best first by relevance + RECENCY_WEIGHT × 0.5^(age / half-life)."""
+    if not fragments:
+        return []
+    now = time.time() if now is None else now
+    keys = np.array([f.score for f in fragments], dtype=np.float64)
+    ts = np.array([np.nan if f.timestamp is None else f.timestamp for f in fragments], dtype=np.float64)
+    dated = ~np.isnan(ts)
+    if dated.any():
+        age = np.maximum(0.0, now - ts[dated])
+        keys[dated] += RECENCY_WEIGHT * np.exp2(-age / RECENCY_HALF_LIFE_S)
+    return [fragments[i] for i in np.argsort(-keys, kind="stable").tolist()]
+
+
+def _fit_tail(text: str, max_tokens: int, counter: TokenCounter) -> str:
+    """Drop the head of `text` until it fits (the end of a message matters most for a reply)."""
+    n = counter.count(text)
+    while n > max_tokens and text:
+        text = text[-max(1, int(len(text) * max_tokens / n * 0.95)):] if max_tokens > 0 else ""
+        n = counter.count(text) if text else 0
+    return text
+
+
+def assemble_prompt(context: Union[str, List[dict]], examples: Optional[Sequence[FragmentLike]] = None,
+                    memory: Optional[Sequence[FragmentLike]] = None, budget: int = PROMPT_BUDGET,
+                    system: str = SYSTEM_PROMPT, counter: Optional[TokenCounter] = None,
+                    now: Optional[float] = None) -> AssembledPrompt:
+    counter = counter or get_token_counter()
+    turns = [{"role": "user", "content": context}] if isinstance(context, str) else \
+        [m for m in context if m.get("role") != "system"]
+    frags = rank(_fragments(memory, "memory") + _fragments(examples, "example"), now)
+
+    roles = ["system"] + [m.get("role", "user") for m in turns]
+    wraps = [MESSAGE_WRAP.format(role=r) for r in roles]
+    fixed = [system, GENERATION_HEADER, f"\n\n{MEMORY_HEADER}\n", f"\n\n{EXAMPLES_HEADER}\n", MEMORY_SEP, EXAMPLES_SEP]
+    counts = counter.count_batch(fixed + wraps + [m.get("content", "") for m in turns])
+    n_sys, n_gen, n_mem_header, n_ex_header, n_mem_sep, n_ex_sep = counts[:len(fixed)]
+    wrap_counts = counts[len(fixed):len(fixed) + len(roles)]
+    turn_counts = [w + n for w, n in zip(wrap_counts[1:], counts[len(fixed) + len(roles):])]
+
+    used = n_gen + wrap_counts[0] + n_sys
+    # 1. the newest turn, cut to fit if need be
+    kept = 0
+    if turns:
+        last = turns[-1]
+        room = budget - used - wrap_counts[-1]
+        if turn_counts[-1] > budget - used:
+            last = dict(last, content=_fit_tail(last.get("content", ""), room, counter))
+            turn_counts[-1] = wrap_counts[-1] + counter.count(last["content"])
+            turns[-1] = last
+        used += turn_counts[-1]
+        kept = 1
+
+    # 2. older turns up to the context share
+    def take_turns(limit: int) -> None:
+        nonlocal used, kept
+        while kept < len(turns):
+            cost = turn_counts[-1 - kept]
+            if used + cost > limit:
+                break
+            used += cost
+            kept += 1
+
+    take_turns(int(budget * CONTEXT_SHARE))
+
+    # 3. fragments by rank, greedily
+    chosen = []
+    header = {"memory": n_mem_header, "example": n_ex_header}  # before the first fragment of a kind
+    sep = {"memory": n_mem_sep, "example": n_ex_sep}           # before every later one
+    for start in range(0, len(frags), COUNT_CHUNK):
+        if budget - used < MIN_FRAGMENT_TOKENS:
+            break
+        chunk = frags[start:start + COUNT_CHUNK]
+        for f, n in zip(chunk, counter.count_batch([f.render() for f in chunk])):
+            kind = "memory" if f.kind == "memory" else "example"
+            cost = n + header[kind]
+            if used + cost > budget:
+                continue
+            used += cost
+            header[kind] = sep[kind]
+            chosen.append(f)
+
+    # 4. leftovers to older turns
+    take_turns(budget)
+
+    content = system
+    mem = [f.render() for f in chosen if f.kind == "memory"]
+    ex = [f.render() for f in chosen if f.kind != "memory"]
+    if mem:
+        content += f"\n\n{MEMORY_HEADER}\n" + MEMORY_SEP.join(mem)
+    if ex:
+        content += f"\n\n{EXAMPLES_HEADER}\n" + EXAMPLES_SEP.join(ex)
+    messages = [{"role": "system", "content": content}] + (turns[len(turns) - kept:] if kept else [])
+    return AssembledPrompt(messages, used, budget, chosen, len(frags) - len(chosen), len(turns) - kept)
+
+
+def _minmax(hits: List[Tuple[str, float]]) -> Dict[str, float]:
+    if not hits:
+        return {}
+    scores = np.array([s for _, s in hits], dtype=np.float64)
+    span = scores.max() - scores.min()
+    norm = (scores - scores.min()) / span if span > 0 else np.ones_like(scores)
+    return {id_: float(s) for (id_, _), s in zip(hits, norm)}
+
+
+def fuse(dense: List[Tuple[str, float]], lexical: List[Tuple[str, float]],
+         alpha: float = HYBRID_ALPHA) -> List[Tuple[str, float]]:
+    """Convex combination of min-max normalized dense and BM25 scores, best first."""
+    d, l = _minmax(dense), _minmax(lexical)
+    fused = {id_: alpha * d.get(id_, 0.0) + (1 - alpha) * l.get(id_, 0.0) for id_ in {*d, *l}}
+    return sorted(fused.items(), key=lambda kv: -kv[1])
+
+
+class Retriever:
+    """Window → reply examples for build_prompt from a BM25Index, an EmbedStore, or both.
+
+    mode: "bm25", "dense" or "hybrid" (default: hybrid when both sources are given).
+    `encode` turns texts into query embeddings for the store (see embed_job.load_encoder).
+    """
+
+    def __init__(self, bm25: Optional[BM25Index] = None, store: Optional[EmbedStore] = None,
+                 encode: Optional[Callable[[List[str]], np.ndarray]] = None, mode: Optional[str] = None,
+                 alpha: float = HYBRID_ALPHA):
+        if store is not None and encode is None:
+            raise ValueError("A dense source needs an encode function")
+        self.bm25, self.store, self.encode, self.alpha = bm25, store, encode, alpha
+        self.mode = mode or ("hybrid" if bm25 is not None and store is not None else "bm25" if bm25 is not None
+                             else "dense")
+        if self.mode not in ("bm25", "dense", "hybrid"):
+            raise ValueError(f"Unknown retrieval mode {self.mode!r}")
+        if (self.mode != "dense" and bm25 is None) or (self.mode != "bm25" and store is None):
+            raise ValueError(f"Mode {self.mode!r} is missing its source")
+        self.docs: Dict[str, dict] = {}
+        for source in (store, bm25):
+            if source is not None and source.path is not None:
+                self.docs.update(load_docs(source.path / DOCS_NAME))
+
+    @staticmethod
+    def query_text(context: Union[str, List[dict]]) -> str:
+        if isinstance(context, str):
+            return context
+        turns = [m.get("content", "") for m in context if m.get("role") != "system"]
+        return "\n".join(turns[-QUERY_TURNS:])
+
+    def search(self, context: Union[str, List[dict]], k: int = 8, mode: Optional[str] = None) -> List[Fragment]:
+        mode = mode or self.mode
+        query = self.query_text(context)
+        n = k * CANDIDATE_FACTOR if mode == "hybrid" else k
+        lexical = self.bm25.search(query, n) if mode != "dense" else []
+        dense = []
+        if mode != "bm25":
+            # The store also holds bare replies and only windows make examples: widen the search until n turn up
+            q = self.encode([query])[0]
+            fetch = n * 2
+            while True:
+                hits = self.store.search(q, fetch)
+                dense = [(id_, s) for id_, s in hits if id_.startswith("window:")][:n]
+                if len(dense) == n or len(hits) < fetch or fetch >= n * MAX_OVERFETCH:
+                    break
+                fetch *= 4
+        ranked = fuse(dense, lexical, self.alpha) if mode == "hybrid" else dense or lexical
+        frags = []
+        for id_, score in ranked:
+            doc = self.docs.get(id_)
+            if doc is not None:
+                frags.append(Fragment(doc["text"], "example", score, None, doc.get("reply", "")))
+            if len(frags) == k:
+                break
+        return frags
+
+
+def build_prompt(context: Union[str, List[dict]], examples: Optional[Sequence[FragmentLike]] = None,
+                 memory: Optional[Sequence[FragmentLike]] = None, budget: int = PROMPT_BUDGET,
+                 retriever: Optional[Retriever] = None, k: int = 8) -> List[dict]:
+    """Chat messages (system with memory + examples, then the conversation) within `budget` tokens.
+    Without `examples`, a `retriever` supplies the top-k for the conversation."""
+    if examples is None and retriever is not None:
+        examples = retriever.search(context, k)
+    return assemble_prompt(context, examples, memory, budget).messages
 
 
 if __name__ == "__main__":
-    print(build_prompt("Example context", examples=["ex1 -> ans1"], memory=["user said hi"]))
+    for m in build_prompt("Example context", examples=[{"text": "ex1", "reply": "ans1", "score": 0.8}],
+                          memory=["user said hi"]):
+        print(f"[{m['role']}]\n{m['content']}\n")
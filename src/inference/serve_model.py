@@ -1,11 +1,424 @@
 """Serve the model for inference.
 
-Placeholder for running an inference server (vLLM / HF / Ollama).
+A small asyncio HTTP server (stdlib only) in front of infer.chat_batch. Concurrent
+requests are collected into dynamic batches: a batch is sent to the model once
+MAX_BATCH requests are waiting or the oldest has waited MAX_WAIT_MS, whichever
+comes first. Each batch is one padded `generate` call, run on a single worker
+thread so the event loop keeps accepting requests meanwhile.
+
+  - backpressure: at most MAX_QUEUE requests wait; beyond that → 503 right away
+  - timeouts: a request not answered within its timeout → 504 (if it has not
+    reached the model yet, it is dropped from the queue)
+  - requests in one generate call share temperature/top_p, so each batch is
+    split by those; max_new_tokens may differ per request
+  - response cache (opt-in, RESPONSE_CACHE=1): trivial repeated prompts ("ok",
+    "lol") in the same recent context are answered from a pool of earlier
+    sampled replies without queueing (response_cache.py)
+  - streaming: with "stream": true the reply comes back as server-sent events
+    while the batch is still generating; streamed and plain requests share batches
+
+Endpoints:
+    POST /chat    {"messages": [...]} or {"prompt": "..."}, optional max_new_tokens,
+                  temperature, top_p, timeout, stream  →  {"reply": "...", "batch_size": n, ...}
+                  with stream=true: `data: {"text": "<increment>"}` events, then
+                  `event: done` with the full reply, TTFT and inter-token latency
+    GET  /health  queue depth, batching stats, streaming latency percentiles, cache stats
+
+Usage:
+    python serve_model.py [model_or_adapter_path] [port]
 """
 
-def start_server(model_path: str = None, port: int = 8080):
-    print(f"Starting inference server (placeholder) on port {port} with model {model_path}")
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Callable, List, Optional
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.infer import StreamMetrics
+from src.inference.response_cache import ResponseCache
+
+HOST = "127.0.0.1"
+PORT = 8080
+MAX_BATCH = 8
+MAX_WAIT_MS = 20
+MAX_QUEUE = 64
+REQUEST_TIMEOUT_S = 60.0
+MAX_BODY_BYTES = 1 << 20
+DEFAULT_MAX_NEW_TOKENS = 100
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_TOP_P = 0.9
+LATENCY_WINDOW = 1000  # recent streams kept for /health percentiles
+RESPONSE_CACHE_PATH = REPO_ROOT / "data" / ".cache" / "responses.json"
+USE_RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+
+# generate_fn(prompts, max_new_tokens_per_prompt, temperature, top_p, on_text) -> replies,
+# where on_text is None or one text callback (or None) per prompt
+GenerateFn = Callable[..., List[str]]
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class _Request:
+    prompt: object
+    max_new_tokens: int
+    temperature: float
+    top_p: float
+    deadline: float
+    future: asyncio.Future
+    on_text: Optional[Callable[[str], None]] = None
+    enqueued: float = field(default_factory=time.perf_counter)
+
+    @property
+    def params(self) -> dict:
+        # What a response cache entry is keyed on besides the messages
+        return {"max_new_tokens": self.max_new_tokens, "temperature": self.temperature, "top_p": self.top_p}
+
+
+class DynamicBatcher:
+    def __init__(self, generate_fn: GenerateFn, max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS,
+                 max_queue: int = MAX_QUEUE, response_cache: Optional[ResponseCache] = None):
+        self.generate_fn = generate_fn
+        self.response_cache = response_cache
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue: "asyncio.Queue[_Request]" = asyncio.Queue(maxsize=max_queue)
+        # One model, one generate at a time; the thread keeps the event loop free
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+        self._task: Optional[asyncio.Task] = None
+        self.stats = defaultdict(int)
+        self.ttft_ms = deque(maxlen=LATENCY_WINDOW)
+        self.itl_ms = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, prompt, max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS,
+                     temperature: float = DEFAULT_TEMPERATURE, top_p: float = DEFAULT_TOP_P,
+                     timeout: float = REQUEST_TIMEOUT_S, on_text: Optional[Callable[[str], None]] = None) -> dict:
+        loop = asyncio.get_running_loop()
+        req = _Request(prompt, max_new_tokens, temperature, top_p, loop.time() + timeout, loop.create_future(),
+                       on_text)
+        if self.response_cache is not None:
+            reply = self.response_cache.get(prompt, req.params)
+            if reply is not None:
+                if on_text is not None:
+                    on_text(reply)
+                return {"reply": reply, "batch_size": 0, "cached": True}
+        try:
+            self.queue.put_nowait(req)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise QueueFull(f"{self.queue.qsize()} requests already waiting")
+        try:
+            # shield: a timeout must not cancel the future the batch loop will resolve
+            return await asyncio.wait_for(asyncio.shield(req.future), timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            req.future.cancel()
+            raise
+
+    async def stream(self, prompt, metrics: Optional[StreamMetrics] = None, **kwargs) -> AsyncIterator[str]:
+        """Yield text increments of one reply; raises like submit() (QueueFull, TimeoutError)."""
+        loop = asyncio.get_running_loop()
+        metrics = metrics or StreamMetrics()
+        pieces: asyncio.Queue = asyncio.Queue()
+        done = object()
+        # on_text runs on the generate thread; hop back onto the loop
+        task = loop.create_task(self.submit(
+            prompt, on_text=lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text), **kwargs))
+        # Scheduled after any pending increments, so nothing is lost at the end
+        task.add_done_callback(lambda _: pieces.put_nowait(done))
+        try:
+            while True:
+                piece = await pieces.get()
+                if piece is done:
+                    break
+                metrics.mark()
+                yield piece
+            task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+            if metrics.ttft_ms is not None:
+                self.ttft_ms.append(metrics.ttft_ms)
+                self.itl_ms.extend(metrics.itl_ms)
+
+    async def _collect(self) -> List[_Request]:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        flush_at = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = flush_at - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # Drop requests that timed out while queued
+        now = loop.time()
+        return [r for r in batch if not r.future.done() and r.deadline > now]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            groups = defaultdict(list)
+            for r in batch:
+                groups[(r.temperature, r.top_p)].append(r)
+            for (temperature, top_p), reqs in groups.items():
+                t0 = time.perf_counter()
+                try:
+                    replies = await loop.run_in_executor(
+                        self._executor, self.generate_fn,
+                        [r.prompt for r in reqs], [r.max_new_tokens for r in reqs], temperature, top_p,
+                        [r.on_text for r in reqs] if any(r.on_text for r in reqs) else None)
+                except Exception as e:
+                    for r in reqs:
+                        if not r.future.done():
+                            r.future.set_exception(e)
+                    continue
+                seconds = time.perf_counter() - t0
+                self.stats["batches"] += 1
+                self.stats["batched_requests"] += len(reqs)
+                for r, reply in zip(reqs, replies):
+                    if self.response_cache is not None:
+                        self.response_cache.put(r.prompt, r.params, reply, seconds)
+                    if not r.future.done():
+                        r.future.set_result({
+                            "reply": reply,
+                            "batch_size": len(reqs),
+                            "queue_ms": round((t0 - r.enqueued) * 1000, 1),
+                            "generate_ms": round(seconds * 1000, 1),
+                        })
+
+    def health(self) -> dict:
+        s = dict(self.stats)
+        s["queued"] = self.queue.qsize()
+        s["avg_batch_size"] = round(s["batched_requests"] / s["batches"], 2) if s.get("batches") else 0.0
+        for name, window in (("ttft_ms", self.ttft_ms), ("itl_ms", self.itl_ms)):
+            if len(window) >= 2:
+                q = statistics.quantiles(window, n=20)
+                s[name] = {"p50": round(statistics.median(window), 1), "p95": round(q[18], 1)}
+        if self.response_cache is not None:
+            s["response_cache"] = self.response_cache.stats()
+        return s
+
+
+# ---------------------------------------------------------------- HTTP
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+            500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+def _response(status: int, body: dict, keep_alive: bool) -> bytes:
+    payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n")
+    if status == 503:
+        head += "Retry-After: 1\r\n"
+    return (head + "\r\n").encode("latin-1") + payload
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    """→ (method, path, headers, body) or None on a closed connection."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        return method, path, headers, None
+    try:
+        body = await reader.readexactly(length) if length else b""
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # Client went away mid-body
+        return None
+    return method, path, headers, body
+
+
+def _parse_chat(body: bytes):
+    """→ (prompt, submit kwargs, stream?) or raises ValueError."""
+    try:
+        req = json.loads(body or b"{}")
+        prompt = req.get("messages") or req.get("prompt")
+        if not prompt:
+            raise ValueError("need 'messages' or 'prompt'")
+        kwargs = {
+            "max_new_tokens": int(req.get("max_new_tokens", DEFAULT_MAX_NEW_TOKENS)),
+            "temperature": float(req.get("temperature", DEFAULT_TEMPERATURE)),
+            "top_p": float(req.get("top_p", DEFAULT_TOP_P)),
+            "timeout": min(float(req.get("timeout", REQUEST_TIMEOUT_S)), REQUEST_TIMEOUT_S),
+        }
+    except (TypeError, AttributeError) as e:
+        raise ValueError(e)
+    return prompt, kwargs, bool(req.get("stream"))
+
+
+def _error_status(e: Exception):
+    if isinstance(e, QueueFull):
+        return 503, {"error": f"server busy: {e}"}
+    if isinstance(e, asyncio.TimeoutError):
+        return 504, {"error": "timed out"}
+    return 500, {"error": repr(e)}
+
+
+async def _handle_chat(batcher: DynamicBatcher, prompt, kwargs: dict):
+    try:
+        return 200, await batcher.submit(prompt, **kwargs)
+    except Exception as e:
+        return _error_status(e)
+
+
+def _sse(data: dict, event: Optional[str] = None) -> bytes:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def _stream_chat(batcher: DynamicBatcher, prompt, kwargs: dict, writer: asyncio.StreamWriter):
+    """Answer with server-sent events. Errors before the first token still get a normal status code."""
+    metrics = StreamMetrics()
+    pieces = batcher.stream(prompt, metrics, **kwargs)
+    try:
+        first = await pieces.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except Exception as e:
+        status, out = _error_status(e)
+        writer.write(_response(status, out, keep_alive=False))
+        return
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n"
+                 b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+    reply = []
+    try:
+        if first is not None:
+            reply.append(first)
+            writer.write(_sse({"text": first}))
+            await writer.drain()
+            async for piece in pieces:
+                reply.append(piece)
+                writer.write(_sse({"text": piece}))
+                await writer.drain()
+        writer.write(_sse({"reply": "".join(reply), **metrics.as_dict()}, event="done"))
+    except (ConnectionError, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        writer.write(_sse({"error": repr(e)}, event="error"))
+    finally:
+        await pieces.aclose()
+
+
+def make_handler(batcher: DynamicBatcher):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                req = await _read_request(reader)
+                if req is None:
+                    break
+                method, path, headers, body = req
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if body is None:
+                    status, out, keep_alive = 413, {"error": "body too large"}, False
+                elif method == "POST" and path == "/chat":
+                    try:
+                        prompt, kwargs, stream = _parse_chat(body)
+                    except ValueError as e:
+                        status, out = 400, {"error": f"bad request: {e}"}
+                    else:
+                        if stream:
+                            # SSE responses end by closing the connection
+                            await _stream_chat(batcher, prompt, kwargs, writer)
+                            await writer.drain()
+                            break
+                        status, out = await _handle_chat(batcher, prompt, kwargs)
+                elif method == "GET" and path == "/health":
+                    status, out = 200, batcher.health()
+                else:
+                    status, out = 404, {"error": f"no route {method} {path}"}
+                writer.write(_response(status, out, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+def default_generate_fn(model_path: Optional[str] = None) -> GenerateFn:
+    from src.inference import infer
+    from src.inference.model_loader import adapter_base_model, has_adapter
+
+    if model_path:
+        # An adapter dir is merged onto the base it was trained on; anything else is a full model
+        if has_adapter(model_path):
+            infer.base_model, infer.lora_path = adapter_base_model(model_path) or infer.base_model, model_path
+        else:
+            infer.base_model, infer.lora_path = model_path, None
+
+    def generate(prompts, max_new_tokens, temperature, top_p, on_text=None):
+        return infer.chat_batch(prompts, max_new_tokens, temperature, top_p, on_text)
+    return generate
+
+
+async def serve(generate_fn: GenerateFn, host: str = HOST, port: int = PORT, max_batch: int = MAX_BATCH,
+                max_wait_ms: float = MAX_WAIT_MS, max_queue: int = MAX_QUEUE, ready: Optional[asyncio.Event] = None,
+                response_cache: Optional[ResponseCache] = None):
+    batcher = DynamicBatcher(generate_fn, max_batch, max_wait_ms, max_queue, response_cache)
+    batcher.start()
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    print(f"🚀 Serving on http://{host}:{port} (max_batch={max_batch}, max_wait={max_wait_ms}ms)")
+    if ready is not None:
+        ready.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        if response_cache is not None:
+            response_cache.save()
+
+
+def start_server(model_path: str = None, port: int = PORT):
+    generate_fn = default_generate_fn(model_path)
+    # Load (and merge, if needed) before accepting traffic, not on the first request
+    generate_fn(["hi"], [1], DEFAULT_TEMPERATURE, DEFAULT_TOP_P)
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH) if USE_RESPONSE_CACHE else None
+    asyncio.run(serve(generate_fn, port=port, response_cache=response_cache))
 
 
 if __name__ == "__main__":
-    start_server()
+    args = sys.argv[1:]
+    start_server(args[0] if len(args) > 0 else None, int(args[1]) if len(args) > 1 else PORT)
@@ -0,0 +1,235 @@
+"""Speculative decoding: a cheap draft proposes K tokens, the target checks them in one forward.
+
+At batch size 1 the 7B target is memory-bandwidth bound: one forward over K+1
+tokens costs about the same as over 1. Each round:
+
+  1. the draft samples x1..xK autoregressively from its distribution q
+  2. the target scores [last token, x1..xK] in one forward → p1..pK+1
+  3. x_i is accepted with probability min(1, p_i(x_i) / q_i(x_i)); at the first
+     rejection a replacement is drawn from norm(max(0, p_i - q_i)) and the round
+     ends; if all K are accepted a bonus token is drawn from pK+1
+
+This rejection rule makes every emitted token an exact sample from the target's
+(temperature / top-k / top-p processed) distribution, whatever the draft does
+(Leviathan et al. 2023, Chen et al. 2023). A bad draft costs speed, never quality.
+With temperature 0 it reduces to "accept while the argmaxes agree".
+
+Drafts:
+  - a small model with the same tokenizer (a path or hub id), or
+  - "layers:N": the target itself truncated to its first N decoder layers
+    (shares the weights, so no extra memory; the LoRA is already merged in)
+
+Both models keep their own KV cache; rejected positions are cropped away.
+"""
+
+import copy
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+DRAFT_TOKENS = 4
+DEFAULT_TOP_K = 50   # what generate() uses when the generation config sets no top_k
+
+
+@dataclass
+class SpecStats:
+    rounds: int = 0
+    proposed: int = 0
+    accepted: int = 0
+    emitted: int = 0
+    seconds: float = 0.0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_round(self) -> float:
+        # ≈ tokens per target forward (the prefill forward is not counted)
+        return self.emitted / self.rounds if self.rounds else 0.0
+
+    def as_dict(self) -> dict:
+        return {"rounds": self.rounds, "proposed": self.proposed, "accepted": self.accepted,
+                "emitted": self.emitted, "acceptance_rate": round(self.acceptance_rate, 3),
+                "tokens_per_round": round(self.tokens_per_round, 2), "seconds": round(self.seconds, 3)}
+
+
+def truncated_draft(model, n_layers: int):
+    """The first `n_layers` decoder layers of `model` (+ its final norm and LM head), sharing weights."""
+    import torch.nn as nn
+
+    inner = model.get_decoder() if hasattr(model, "get_decoder") else model.model
+    draft_inner = copy.copy(inner)
+    draft_inner._modules = dict(inner._modules)
+    draft_inner.layers = nn.ModuleList(list(inner.layers)[:n_layers])
+    draft = copy.copy(model)
+    draft._modules = dict(model._modules)
+    draft.config = copy.deepcopy(model.config)
+    draft.config.num_hidden_layers = n_layers
+    draft_inner.config = draft.config
+    for name, module in draft._modules.items():
+        if module is inner:
+            draft._modules[name] = draft_inner
+    return draft
+
+
+def load_draft(spec: str, target_loaded, backend: Optional[str] = None):
+    """"layers:N" → truncated target; anything else → a separately loaded model (must share the tokenizer)."""
+    if spec.startswith("layers:"):
+        return truncated_draft(target_loaded.model, int(spec.split(":", 1)[1]))
+    from src.inference.model_loader import get_model
+
+    draft = get_model(spec, None, backend=backend)
+    if len(draft.tokenizer) != len(target_loaded.tokenizer):
+        print(f"⚠️ Draft tokenizer has {len(draft.tokenizer)} tokens, target {len(target_loaded.tokenizer)}; "
+              "acceptance will suffer if the vocabularies differ")
+    return draft.model
+
+
+def sampling_top_k(model) -> int:
+    """The top_k model.generate(do_sample=True) applies when none is passed (0 = off)."""
+    top_k = getattr(getattr(model, "generation_config", None), "top_k", None)
+    return DEFAULT_TOP_K if top_k is None else top_k
+
+
+def _probs(logits, temperature: float, top_p: float, top_k: int = DEFAULT_TOP_K):
+    """Logits [n, V] → the sampling distribution generate() would use (temperature, top-k, then top-p).
+
+    Uses generate()'s own logits warpers, so ties and cut-offs match it exactly.
+    """
+    import torch
+    from transformers import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+    logits = logits.float()
+    if temperature <= 0:
+        return torch.nn.functional.one_hot(logits.argmax(-1), logits.shape[-1]).float()
+    if temperature != 1.0:
+        logits = TemperatureLogitsWarper(temperature)(None, logits)
+    if top_k:
+        logits = TopKLogitsWarper(top_k)(None, logits)
+    if top_p < 1.0:
+        logits = TopPLogitsWarper(top_p)(None, logits)
+    return torch.softmax(logits, dim=-1)
+
+
+def _forward(model, ids, cache):
+    out = model(input_ids=ids, past_key_values=cache, use_cache=True)
+    return out.logits[0]
+
+
+def _align_vocab(logits, size: int):
+    import torch
+
+    # Draft and target vocabularies can be padded differently: the draft may only
+    # propose target tokens, and target-only tokens get q = 0
+    if logits.shape[-1] > size:
+        return logits[..., :size]
+    if logits.shape[-1] < size:
+        pad = logits.new_full((*logits.shape[:-1], size - logits.shape[-1]), float("-inf"))
+        return torch.cat([logits, pad], dim=-1)
+    return logits
+
+
+def speculative_generate(target, draft, input_ids, max_new_tokens: int = 100, temperature: float = 0.7,
+                         top_p: float = 0.9, k: int = DRAFT_TOKENS, eos_ids=(), target_cache=None,
+                         on_token: Optional[Callable[[int], None]] = None, generator=None,
+                         stats: Optional[SpecStats] = None, top_k: Optional[int] = None):
+    """Sample up to `max_new_tokens` for one prompt (input_ids [1, L]); returns (new token ids, target cache).
+
+    `top_k` defaults to the target's generation config, as with model.generate().
+
+    `target_cache` may already cover a prefix of the prompt (e.g. from the prefix
+    cache); it is extended in place. The returned cache covers prompt + output
+    minus the last token.
+    """
+    import torch
+    from transformers import DynamicCache
+
+    stats = stats if stats is not None else SpecStats()
+    t0 = time.perf_counter()
+    device = input_ids.device
+    eos_ids = set(eos_ids)
+    top_k = sampling_top_k(target) if top_k is None else top_k
+    vocab = target.config.vocab_size
+    seq = input_ids[0].tolist()
+    tcache = target_cache if target_cache is not None else DynamicCache()
+    dcache = DynamicCache()
+    out = []
+
+    def rand():
+        return torch.rand((), device=device, generator=generator).item()
+
+    def sample(p):
+        return int(torch.multinomial(p, 1, generator=generator).item())
+
+    with torch.inference_mode():
+        # Prefill everything but the last prompt token; each round starts by feeding it
+        done = tcache.get_seq_length()
+        if len(seq) - 1 > done:
+            _forward(target, torch.tensor([seq[done:-1]], device=device), tcache)
+        if len(seq) > 1:
+            _forward(draft, torch.tensor([seq[:-1]], device=device), dcache)
+
+        while len(out) < max_new_tokens:
+            n = min(k, max_new_tokens - len(out))
+            # 1. Draft proposes n tokens
+            proposal, qs = [], []
+            last = seq[-1]
+            for _ in range(n):
+                logits = _align_vocab(_forward(draft, torch.tensor([[last]], device=device), dcache)[-1:], vocab)
+                q = _probs(logits, temperature, top_p, top_k)[0]
+                last = sample(q)
+                proposal.append(last)
+                qs.append(q)
+            # 2. Target scores all of them at once
+            logits = _forward(target, torch.tensor([[seq[-1]] + proposal], device=device), tcache)
+            ps = _probs(logits, temperature, top_p, top_k)
+            # 3. Accept / reject
+            accepted = []
+            new_token = None
+            for i, x in enumerate(proposal):
+                p_i, q_i = ps[i], qs[i]
+                if temperature <= 0:
+                    ok = p_i[x] > 0
+                else:
+                    ok = rand() * q_i[x].item() <= p_i[x].item()
+                if ok:
+                    accepted.append(x)
+                    if x in eos_ids:
+                        break
+                    continue
+                residual = torch.clamp(p_i - q_i, min=0)
+                new_token = sample(residual / residual.sum() if residual.sum() > 0 else p_i)
+                break
+            else:
+                new_token = sample(ps[n])
+            if accepted and accepted[-1] in eos_ids:
+                new_token = None
+
+            stats.rounds += 1
+            stats.proposed += n
+            stats.accepted += len(accepted)
+            emitted = accepted + ([new_token] if new_token is not None else [])
+            emitted = emitted[:max_new_tokens - len(out)]
+            finished = False
+            for tok in emitted:
+                out.append(tok)
+                seq.append(tok)
+                stats.emitted += 1
+                if on_token is not None:
+                    on_token(tok)
+                if tok in eos_ids:
+                    finished = True
+                    break
+            # Both caches must cover exactly seq[:-1]
+            for cache in (tcache, dcache):
+                extra = cache.get_seq_length() - (len(seq) - 1)
+                if extra > 0:
+                    cache.crop(-extra)
+            if dcache.get_seq_length() < len(seq) - 1:
+                # The draft never saw its own last proposal (or the replacement): catch it up
+                _forward(draft, torch.tensor([seq[dcache.get_seq_length():-1]], device=device), dcache)
+            if finished:
+                break
+    stats.seconds += time.perf_counter() - t0
+    return out, tcache
@@ -0,0 +1,79 @@
+"""Incremental JSON readers for large exports.
+
+Parse a top-level JSON array or NDJSON / concatenated JSON values one
+record at a time, so a multi-GB file never has to be held in memory.
+"""
+
+import json
+import re
+from pathlib import Path
+from typing import Any, Iterator, Union
+
+CHUNK_SIZE = 1 << 20  # characters read per refill
+
+_WS = re.compile(r"\s*")
+_WS_OR_COMMA = re.compile(r"[\s,]*")
+
+
+def iter_json_records(path: Union[str, Path], *, chunk_size: int = CHUNK_SIZE, replace_invalid: bool = False) -> Iterator[Any]:
+    """Yield records from `path` without loading the whole file.
+
+    Accepts either a top-level JSON array (`[{...}, {...}]`) or NDJSON /
+    whitespace-separated JSON values. Memory stays at roughly one chunk plus
+    the largest single record.
+    """
+    p = Path(path)
+    if not p.exists():
+        raise FileNotFoundError(f"JSON input file not found: {p}")
+
+    decoder = json.JSONDecoder()
+    errors = "replace" if replace_invalid else "strict"
+    # utf-8-sig strips a leading BOM if present
+    with p.open("r", encoding="utf-8-sig", errors=errors) as f:
+        buf = ""
+        pos = 0
+        eof = False
+        in_array = None
+        while True:
+            # Skip whitespace (and element separators inside an array), refilling as needed
+            skip = _WS_OR_COMMA if in_array else _WS
+            while True:
+                pos = skip.match(buf, pos).end()
+                if pos < len(buf) or eof:
+                    break
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+            if pos >= len(buf):
+                return
+
+            if in_array is None:
+                in_array = buf[pos] == "["
+                if in_array:
+                    pos += 1
+                continue
+            if in_array and buf[pos] == "]":
+                return
+
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                obj, end = None, None
+            # A bare number at the buffer edge may be truncated; read more before trusting it
+            if end is None or (end == len(buf) and not eof and not isinstance(obj, (dict, list, str))):
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+
+            pos = end
+            yield obj
+
+
+if __name__ == "__main__":
+    import sys
+
+    n = sum(1 for _ in iter_json_records(sys.argv[1]))
+    print(f"{n} records")
@@ -0,0 +1,65 @@
+"""Single-pass PII masking.
+
+All enabled patterns are combined into one compiled alternation with a named
+group per kind, so each message is scanned once instead of once per pattern.
+Alternatives are tried in PII_PATTERNS order at each position, so the more
+specific kinds (URLs, emails) win over the looser ones (handles, phones).
+Patterns must only use non-capturing groups `(?:...)`: the replacement is
+looked up from `match.lastgroup`.
+"""
+
+import re
+from typing import Dict, Iterable, Optional
+
+PII_PATTERNS: Dict[str, str] = {
+    "url": r"(?:https?://|www\.)\S+",
+    "email": r"\S+@\S+",
+    "handle": r"(?<![\w@])@[A-Za-z]\w{3,31}\b",
+    "nric": r"\b[STFGMstfgm]\d{7}[A-Za-z]\b",
+    "phone": r"\+?\d[\d\-\s]{7,}\d",
+}
+
+PII_TOKENS: Dict[str, str] = {
+    "url": "[URL]",
+    "email": "[EMAIL]",
+    "handle": "[HANDLE]",
+    "nric": "[NRIC]",
+    "phone": "[PHONE]",
+}
+
+# What build_dataset.py has always masked
+DEFAULT_KINDS = ("email", "phone")
+
+
+class PiiMasker:
+    def __init__(self, kinds: Iterable[str] = DEFAULT_KINDS, patterns: Optional[Dict[str, str]] = None,
+                 tokens: Optional[Dict[str, str]] = None):
+        patterns = patterns or PII_PATTERNS
+        tokens = tokens or PII_TOKENS
+        kinds = set(kinds)
+        unknown = kinds - set(patterns)
+        if unknown:
+            raise ValueError(f"Unknown PII kinds: {sorted(unknown)} (available: {list(patterns)})")
+        # Keep priority order from `patterns`, not from `kinds`
+        self.kinds = [k for k in patterns if k in kinds]
+        self._tokens = {k: tokens.get(k, f"[{k.upper()}]") for k in self.kinds}
+        self._re = re.compile("|".join(f"(?P<{k}>{patterns[k]})" for k in self.kinds)) if self.kinds else None
+
+    def _repl(self, m: "re.Match") -> str:
+        return self._tokens[m.lastgroup]
+
+    def mask(self, text: str) -> str:
+        if self._re is None or not text:
+            return text
+        return self._re.sub(self._repl, text)
+
+    def find(self, text: str):
+        """(kind, matched text) pairs, useful for auditing what gets masked."""
+        if self._re is None:
+            return []
+        return [(m.lastgroup, m.group()) for m in self._re.finditer(text)]
+
+
+if __name__ == "__main__":
+    masker = PiiMasker(PII_PATTERNS)
+    print(masker.mask("ping @anselm_l or a@b.com, +65 9123 4567, S1234567D, https://t.me/x"))
@@ -0,0 +1,133 @@
+"""Shared, cached token counter.
+
+Loads the tokenizer once per process and memoizes counts for repeated strings
+(Telegram chats are full of "ok" / "lol" / "haha"). Used by dataset grouping,
+prompt assembly and context trimming so they all agree on what a token is.
+
+Backends, in order of preference:
+  - a locally cached HF tokenizer (`TOKENIZER_PATH`, e.g. the Mistral one we train with)
+  - tiktoken `cl100k_base`
+  - a words * 1.3 heuristic when neither is installed
+"""
+
+import math
+import os
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+DEFAULT_ENCODING = "cl100k_base"
+DEFAULT_CACHE_SIZE = 200_000
+
+
+class TokenCounter:
+    def __init__(self, tokenizer_path: Optional[str] = None, encoding: str = DEFAULT_ENCODING,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        self.tokenizer_path = tokenizer_path
+        self.encoding = encoding
+        self.cache_size = cache_size
+        self.backend: Optional[str] = None
+        self._tok = None
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        if self.backend is not None:
+            return
+        if self.tokenizer_path:
+            from transformers import AutoTokenizer
+
+            # Never hit the network from the data pipeline
+            self._tok = AutoTokenizer.from_pretrained(self.tokenizer_path, local_files_only=True)
+            self.backend = "hf"
+            return
+        try:
+            import tiktoken
+
+            self._tok = tiktoken.get_encoding(self.encoding)
+            self.backend = "tiktoken"
+        except Exception:
+            self.backend = "heuristic"
+
+    @property
+    def tokenizer(self):
+        """The underlying tokenizer object (None for the heuristic backend)."""
+        self._load()
+        return self._tok
+
+    def _encode_batch(self, texts: List[str]) -> List[int]:
+        if self.backend == "hf":
+            ids = self._tok(texts, add_special_tokens=False)["input_ids"]
+            return [len(x) for x in ids]
+        if self.backend == "tiktoken":
+            return [len(x) for x in self._tok.encode_batch(texts, disallowed_special=())]
+        # Fallback: conservative estimate: token ~= words * 1.3, at least 1
+        return [max(1, math.ceil(len(t.split()) * 1.3)) for t in texts]
+
+    def _remember(self, text: str, n: int):
+        self._cache[text] = n
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def count(self, text: str) -> int:
+        n = self._cache.get(text)
+        if n is not None:
+            self.hits += 1
+            self._cache.move_to_end(text)
+            return n
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: Iterable[str]) -> List[int]:
+        """Count tokens for many texts; cache misses are encoded in one batched call."""
+        texts = list(texts)
+        out: List[Optional[int]] = [None] * len(texts)
+        missing: "OrderedDict[str, List[int]]" = OrderedDict()
+        for i, t in enumerate(texts):
+            n = self._cache.get(t)
+            if n is not None:
+                self.hits += 1
+                self._cache.move_to_end(t)
+                out[i] = n
+            else:
+                missing.setdefault(t, []).append(i)
+
+        if missing:
+            self._load()
+            uniq = list(missing)
+            self.misses += len(uniq)
+            for t, n in zip(uniq, self._encode_batch(uniq)):
+                self._remember(t, n)
+                for i in missing[t]:
+                    out[i] = n
+        return out
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "cache_entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_default: Optional[TokenCounter] = None
+
+
+def get_token_counter() -> TokenCounter:
+    """Process-wide counter configured from the environment (`TOKENIZER_PATH`)."""
+    global _default
+    if _default is None:
+        _default = TokenCounter(tokenizer_path=os.getenv("TOKENIZER_PATH") or None)
+    return _default
+
+
+def count_tokens(text: str) -> int:
+    return get_token_counter().count(text)
+
+
+if __name__ == "__main__":
+    tc = get_token_counter()
+    print(tc.count_batch(["hello there", "ok", "ok", "lol"]))
+    print(tc.stats())
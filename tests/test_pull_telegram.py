@@ -0,0 +1,98 @@
+"""pull_selected / merge_chat_files against a stub client (no network, no Telegram session)."""
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from telethon.errors import FloodWaitError
+
+from src.data import pull_telegram
+from src.utils.json_stream import iter_json_records
+
+_yield = asyncio.sleep  # the real one; tests patch asyncio.sleep to skip flood waits
+
+
+class StubClient:
+    """Telethon's iter_messages(chat_id, reverse=, min_id=, limit=) over in-memory chats.
+
+    Chats in `flood_once` raise FloodWaitError after `flood_after` messages the first
+    time they are iterated. Tracks how many chats are being pulled at once.
+    """
+
+    def __init__(self, chats, flood_once=(), flood_after=2):
+        self.chats = chats
+        self.flood_pending = set(flood_once)
+        self.flood_after = flood_after
+        self.active = self.max_active = 0
+        self.calls = []
+
+    async def iter_messages(self, chat_id, reverse=True, min_id=0, limit=None):
+        self.calls.append((chat_id, min_id))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            msgs = [m for m in self.chats[chat_id] if m.id > min_id][:limit]
+            for i, msg in enumerate(msgs):
+                if chat_id in self.flood_pending and i == self.flood_after:
+                    self.flood_pending.discard(chat_id)
+                    raise FloodWaitError(request=None, capture=0)
+                await _yield(0)  # let the other pulls interleave
+                yield msg
+        finally:
+            self.active -= 1
+
+
+def _chat(chat_id, n):
+    return [SimpleNamespace(id=i, sender_id=chat_id, text=f"{chat_id}:{i}", date=f"2025-01-01 00:00:{i:02d}",
+                            out=i % 2 == 0) for i in range(1, n + 1)]
+
+
+def test_pull_selected_concurrency_flood_retry_and_merge(tmp_path, monkeypatch):
+    sleeps = []
+
+    async def no_sleep(seconds):
+        sleeps.append(seconds)
+
+    # Only the flood-wait back-off sleeps in pull_telegram; skip the wait
+    monkeypatch.setattr(pull_telegram.asyncio, "sleep", no_sleep)
+    chats = {cid: _chat(cid, n) for cid, n in ((101, 7), (102, 3), (103, 5), (104, 4), (105, 6))}
+    client = StubClient(chats, flood_once={103})
+    chats_dir, checkpoints = tmp_path / "chats", tmp_path / "checkpoints.json"
+    selected = [105, 101, 103, 102, 104]
+
+    result = asyncio.run(pull_telegram.pull_selected(client, selected, concurrency=2, chats_dir=chats_dir,
+                                                     checkpoint_path=checkpoints))
+
+    assert result == {cid: len(chats[cid]) for cid in selected}
+    assert client.max_active == 2  # pulls overlapped, but never more than the semaphore allows
+    # The flood wait was honoured (seconds + 1) and the retry resumed after the last pulled id
+    assert sleeps == [1]
+    assert [c for c in client.calls if c[0] == 103] == [(103, 0), (103, 2)]
+    assert json.loads(checkpoints.read_text()) == {str(cid): len(chats[cid]) for cid in selected}
+
+    out = tmp_path / "messages.json"
+    n = pull_telegram.merge_chat_files(selected, out, chats_dir)
+    merged = json.loads(out.read_text())  # a real JSON array
+    assert n == len(merged) == sum(len(v) for v in chats.values())
+    # Chats in selection order, each oldest → newest, no duplicates from the retry
+    assert [(m["chat_id"], m["id"]) for m in merged] == [(cid, m.id) for cid in selected for m in chats[cid]]
+    assert list(iter_json_records(out)) == merged
+
+
+def test_pull_resumes_from_checkpoint(tmp_path, monkeypatch):
+    chats = {201: _chat(201, 5)}
+    chats_dir, checkpoints = tmp_path / "chats", tmp_path / "checkpoints.json"
+    asyncio.run(pull_telegram.pull_selected(StubClient({201: chats[201][:3]}), [201], chats_dir=chats_dir,
+                                            checkpoint_path=checkpoints))
+    client = StubClient(chats)
+    result = asyncio.run(pull_telegram.pull_selected(client, [201], chats_dir=chats_dir, checkpoint_path=checkpoints))
+
+    assert result == {201: 2}
+    assert client.calls == [(201, 3)]
+    lines = (chats_dir / "201.jsonl").read_text().splitlines()
+    assert [json.loads(line)["id"] for line in lines] == [1, 2, 3, 4, 5]
@@ -0,0 +1,47 @@
+"""serve_model's HTTP handler on in-memory streams (no sockets, no model)."""
+
+import asyncio
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+from src.inference.serve_model import DynamicBatcher, make_handler
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data, self.closed = b"", False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def _handle(raw: bytes) -> FakeWriter:
+    async def run():
+        reader, writer = asyncio.StreamReader(), FakeWriter()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        batcher = DynamicBatcher(lambda prompts, *args: ["ok"] * len(prompts))
+        await make_handler(batcher)(reader, writer)
+        return writer
+    return asyncio.run(run())
+
+
+def test_client_disconnect_mid_body_closes_quietly():
+    writer = _handle(b"POST /chat HTTP/1.1\r\nContent-Length: 100\r\n\r\n{\"prompt\": \"hi")
+    assert writer.closed
+    assert writer.data == b""
+
+
+def test_health_then_close():
+    writer = _handle(b"GET /health HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert writer.closed
+    assert writer.data.startswith(b"HTTP/1.1 200")